@@ -29,10 +29,24 @@ from options import *
 from utils import fatal_error
 
 def print_help():
-    print("Usage: mcell_git [clone|checkout|pull|push|reset-hard])")
+    print("Usage: mcell_git [-j JOBS] [clone|checkout|pull|push|reset-hard|tag|merge|maintain])")
+    print("  -j JOBS  number of repositories processed in parallel, default is " + str(DEFAULT_BULK_REPO_JOBS))
+
+
+def extract_jobs_arg(argv):
+    # removes optional '-j JOBS' from argv and returns the number of jobs 
+    jobs = DEFAULT_BULK_REPO_JOBS
+    if '-j' in argv:
+        i = argv.index('-j')
+        if i + 1 >= len(argv) or not argv[i + 1].isdigit() or int(argv[i + 1]) < 1:
+            fatal_error("Option -j requires a positive number of jobs")
+        jobs = int(argv[i + 1])
+        del argv[i:i + 2]
+    return jobs
 
 
 if __name__ == "__main__":
+    repo_jobs = extract_jobs_arg(sys.argv)
     argc = len(sys.argv) 
     if argc == 1 or sys.argv[1] == "help":
         print_help()
@@ -42,6 +56,7 @@ if __name__ == "__main__":
     
     opts = Options()
     opts.use_private_repos = True
+    opts.repo_jobs = repo_jobs
     if a1 == 'clone' or a1 == 'checkout': 
         if argc == 3:
             opts.branch = sys.argv[2]
@@ -84,6 +99,12 @@ if __name__ == "__main__":
         print("Merging all repositories")
         repositories.merge(opts)
         
+    elif a1 == 'maintain':
+        if argc > 2:
+            fatal_error("Command maintain does not have any extra arguments")
+        print("Running maintenance of all repositories")
+        repositories.maintain(opts)
+        
     else:
         print("Error: unknown command '" + a1 + "'")
         print_help()
@@ -12,6 +12,7 @@ https://opensource.org/licenses/MIT.
 
 import os
 import sys
+import json
 import subprocess
 
 
@@ -25,6 +26,15 @@ import bundle
 import cellblender_mcell_plugin
 import pypi_wheel
 import cmake_builder
+import jobserver
+import artifact_cache
+import compiler_cache
+import profiling
+import benchmark
+import compile_times
+import linker
+import stamps
+import flag_tuning
 
 from utils import log, fatal_error, get_cwd_no_link
 from build_settings import *
@@ -37,8 +47,20 @@ def check_prerequisites(opts):
         fatal_error("Required Python version is at least 3.11")
 
 
-    # also check cmake (although it is not needed for all task types)
-    opts.cmake_executable = cmake_builder.build_cmake_if_version_is_insufficient(opts.work_dir)
+    # also check cmake (although it is not needed for all task types),
+    # a locally built cmake is shared by all worktrees
+    opts.cmake_executable = cmake_builder.build_cmake_if_version_is_insufficient(
+        opts.main_work_dir, artifact_cache.get_artifact_cache(opts))
+
+    compiler_cache.setup_compiler_cache(opts)
+    linker.setup_linker(opts)
+
+    if opts.do_build:
+        # -march=x86-64-v2 and newer need at least gcc 11 or clang 12
+        for variant in opts.isa_variants:
+            if not linker.is_supported_by_compiler(['-march=' + variant]):
+                fatal_error("The compiler does not support -march=" + variant + " used by --isa-variants, " + 
+                            "at least gcc 11 or clang 12 is needed.")
 
 
 def test_all(opts, install_dirs):
@@ -47,7 +69,7 @@ def test_all(opts, install_dirs):
         install_dirs = bundle.get_extracted_bundle_install_dirs(opts)
 
     # running testing as a new process
-    tests_path = os.path.join(THIS_DIR, '..', REPO_NAME_MCELL_TESTS)
+    tests_path = os.path.join(opts.top_dir, REPO_NAME_MCELL_TESTS)
     test_cmd = [
         PYTHON_SYSTEM_EXECUTABLE,
         os.path.join(tests_path, RUN_TESTS_SCRIPT)
@@ -68,7 +90,7 @@ def test_all(opts, install_dirs):
     # clean the test data immediatelly after pass
     test_cmd += [ '-e' ]
 
-    with open(os.path.join(THIS_DIR, WORK_DIR_NAME, "test_command.sh"), 'w') as f:
+    with open(os.path.join(opts.work_dir, "test_command.sh"), 'w') as f:
     	f.write(' '.join(test_cmd))
 
     # for some reason the script dos not terminate without the shell=True
@@ -77,6 +99,51 @@ def test_all(opts, install_dirs):
         fatal_error("Testing failed")
 
 
+def get_build_config(opts):
+    # options that influence the resulting bundle, the same as those used by the step stamps,
+    # tuned flags are stored outside of the repositories and must be compared by their contents
+    config = { attr: getattr(opts, attr, None) for attr in stamps.FINGERPRINT_OPTIONS }
+    config['tuned_flags'] = flag_tuning.load_tuned_flags(opts)
+    return config
+
+
+def record_successful_build(opts, manifest):
+    if manifest is None or any(info['dirty'] for info in manifest.values()):
+        # changes in dirty repositories are not captured by the manifest
+        return
+
+    last_build_file = os.path.join(opts.work_dir, LAST_SUCCESSFUL_BUILD_FILE)
+    with open(last_build_file, 'w') as f:
+        json.dump({
+            'repositories': manifest,
+            'config': get_build_config(opts),
+            'artifact': opts.result_bundle_archive_path
+        }, f, indent=2, sort_keys=True)
+
+
+def get_reusable_artifact(opts, manifest):
+    # returns path to the bundle of the last successful build if nothing has changed since then, 
+    # None otherwise
+    last_build_file = os.path.join(opts.work_dir, LAST_SUCCESSFUL_BUILD_FILE)
+    if opts.force_rebuild or opts.only_pypi_wheel or not os.path.exists(last_build_file):
+        return None
+
+    with open(last_build_file, 'r') as f:
+        last_build = json.load(f)
+
+    if last_build['repositories'] != manifest:
+        log("Repositories changed since the last successful build.")
+        return None
+    if last_build['config'] != get_build_config(opts):
+        log("Build options changed since the last successful build.")
+        return None
+    if not os.path.exists(last_build['artifact']):
+        log("Bundle '" + last_build['artifact'] + "' of the last successful build does not exist anymore.")
+        return None
+
+    return last_build['artifact']
+
+
 def main():
     opts = Options()
     opts.process_opts()
@@ -110,14 +177,44 @@ def main():
     if opts.do_repos:
         repositories.get_or_update(opts)
 
+    # flag tuning is a separate mode, nothing else is done
+    if opts.tune_flags:
+        build.tune_mcell_flags(opts)
+        log("--- Flag tuning finished ---")
+        return
+
+    # nothing changed since the last successful build?
+    manifest = None
+    reused_artifact = None
+    if opts.do_build and opts.do_bundle:
+        manifest = repositories.create_manifest(opts)
+        reused_artifact = get_reusable_artifact(opts, manifest)
+        if reused_artifact:
+            log("Repositories and options did not change since the last successful build, "
+                "skipping build and bundle and reusing '" + reused_artifact + "'.")
+            # the name of the bundle contains current date, later steps expect it under this name
+            if reused_artifact != opts.result_bundle_archive_path:
+                shutil.copy(reused_artifact, opts.result_bundle_archive_path)
+
+    # make processes of build and bundle share cores with other run.py processes
+    js = None
+    if opts.jobserver and (opts.do_build or opts.do_bundle) and not reused_artifact:
+        js = jobserver.start_jobserver(opts)
+
     # 2) build
     # returns dictionary  repo name -> where it was built
-    if opts.do_build:
+    if opts.do_build and not reused_artifact:
         # generate version file
         repositories.create_version_file(opts)
 
         # keys are REPO_NAME_MCELL and REPO_NAME_CELLBLENDER
         install_dirs = build.build_all(opts)
+
+        if opts.compile_time_report:
+            compile_times.write_report(opts)
+
+        if opts.profiling and not opts.only_pypi_wheel:
+            profiling.profile_models(opts)
     else:
         # testing will use defaults
         install_dirs = {}
@@ -125,7 +222,13 @@ def main():
     # 3) create bundle
     # overwrite install_dirs with new values
     if opts.do_bundle:
-        if opts.only_cellblender_mcell:
+        if reused_artifact:
+            if opts.only_cellblender_mcell:
+                install_dirs = cellblender_mcell_plugin.extract_resulting_package(opts)
+            else:
+                install_dirs = bundle.extract_resulting_bundle(opts)
+
+        elif opts.only_cellblender_mcell:
             cellblender_mcell_plugin.create_package(opts)
 
             install_dirs = cellblender_mcell_plugin.extract_resulting_package(opts)
@@ -138,19 +241,36 @@ def main():
             # also extract it right away if testing is needed
             install_dirs = bundle.extract_resulting_bundle(opts)
 
+        if opts.do_build and not reused_artifact:
+            record_successful_build(opts, manifest)
+
+    if js:
+        js.stop()
+
+    compiler_cache.print_report(opts)
+    if (opts.do_build or opts.do_bundle) and not reused_artifact:
+        linker.print_report(opts)
 
 
     # 4) test
     if opts.do_test:
         test_all(opts, install_dirs)
 
-    # 5) store the release
+    # 5) benchmark, uses the extracted bundle when there was no build
+    if opts.do_benchmark:
+        if not install_dirs:
+            install_dirs = bundle.get_extracted_bundle_install_dirs(opts)
+        benchmark.run_benchmarks(opts, install_dirs)
+
+    # 6) store the release
     if opts.store_build:
         if opts.release_version != INTERNAL_RELEASE_NO_VERSION:
             # release
             if os.path.exists(opts.mcell_build_infrastructure_releases_dir):
                 log("Copying release '" + opts.result_bundle_archive_path + "'  to '" + opts.mcell_build_infrastructure_releases_dir + "'.")
                 shutil.copy(opts.result_bundle_archive_path, opts.mcell_build_infrastructure_releases_dir)
+                profiling.store_profiles(opts, opts.mcell_build_infrastructure_releases_dir)
+                benchmark.store_results(opts, opts.mcell_build_infrastructure_releases_dir)
             else:
                 fatal_error("Could not find directory '" + opts.mcell_build_infrastructure_releases_dir +
                             "', release was not stored but can be found as '" + opts.result_bundle_archive_path + "'.")
@@ -158,6 +278,8 @@ def main():
             if os.path.exists(opts.mcell_build_infrastructure_builds_dir):
                 log("Copying release '" + opts.result_bundle_archive_path + "'  to '" + opts.mcell_build_infrastructure_builds_dir + "'.")
                 shutil.copy(opts.result_bundle_archive_path, opts.mcell_build_infrastructure_builds_dir)
+                profiling.store_profiles(opts, opts.mcell_build_infrastructure_builds_dir)
+                benchmark.store_results(opts, opts.mcell_build_infrastructure_builds_dir)
             else:
                 fatal_error("Could not find directory '" + opts.mcell_build_infrastructure_builds_dir +
                             "', release was not stored but can be found as '" + opts.result_bundle_archive_path + "'.")
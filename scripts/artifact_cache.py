@@ -0,0 +1,441 @@
+"""
+Copyright (C) 2019 by
+The Salk Institute for Biological Studies and
+Pittsburgh Supercomputing Center, Carnegie Mellon University
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+Local content-addressed cache of build outputs (e.g. the VTK build directory).
+
+Each entry is a directory named by a hash of everything that influences
+the output (sources commit, cmake arguments, compiler, platform), entries are
+restored using hardlinks and the least recently used entries are evicted 
+once the cache exceeds its size limit. Keys do not contain absolute paths so 
+that entries are shared between checkouts (e.g. worktrees), text files of a 
+restored entry that contain the paths of the checkout that stored it are 
+rewritten.
+
+An optional remote tier shares entries between build nodes, it is either an HTTP 
+server that supports GET and PUT or a directory (e.g. a network share).
+Entries are stored there as <partition>/<key>.tar.gz with a checksum in 
+<partition>/<key>.sha256, the partition separates platforms and toolchains.
+"""
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import urllib.error
+import urllib.request
+
+from utils import *
+from build_settings import *
+
+ENTRY_DATA_DIR = 'data'
+ENTRY_META_FILE = 'meta.json'
+
+# written into a restored directory, its files are hardlinks to the cache and 
+# must not be modified in place
+RESTORED_MARKER_FILE = '.restored_from_artifact_cache'
+
+
+def get_relocatable_paths(opts):
+    # absolute paths that may differ between the checkout that stored an entry and the one that restores it
+    return { 'top_dir': opts.top_dir }
+
+
+def get_relative_args(args, paths):
+    # args with the given paths replaced by their names, used in keys
+    res = []
+    for arg in args:
+        for name, path in sorted(paths.items(), key=lambda item: len(item[1]), reverse=True):
+            arg = arg.replace(path, '<' + name + '>')
+        res.append(arg)
+    return res
+
+
+def relocate_tree(root_dir, old_paths, new_paths):
+    # rewrites old paths to new ones in text files, files are replaced, not modified 
+    # in place because they are hardlinks to the cache
+    mapping = {}
+    for name, old_path in old_paths.items():
+        if name in new_paths and new_paths[name] != old_path:
+            mapping[old_path.encode('utf-8')] = new_paths[name].encode('utf-8')
+    if not mapping:
+        return
+
+    pattern = re.compile(b'|'.join(re.escape(p) for p in sorted(mapping.keys(), key=len, reverse=True)))
+    rewritten = 0
+    for dir_path, _, files in os.walk(root_dir):
+        for name in files:
+            path = os.path.join(dir_path, name)
+            if os.path.islink(path):
+                continue
+            with open(path, 'rb') as f:
+                head = f.read(8192)
+                if b'\0' in head:
+                    # binary file
+                    continue
+                data = head + f.read()
+            new_data = pattern.sub(lambda m: mapping[m.group(0)], data)
+            if new_data == data:
+                continue
+            tmp_path = path + '.relocate_tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(new_data)
+            shutil.copymode(path, tmp_path)
+            os.replace(tmp_path, path)
+            rewritten += 1
+    log("Artifact cache: rewrote paths in " + str(rewritten) + " files of '" + root_dir + "'.")
+
+
+def is_safe_member(member, dest_dir):
+    # used when tarfile does not support extraction filters (python < 3.12 without backports)
+    if not (member.isfile() or member.isdir() or member.issym()):
+        return False
+    if os.path.isabs(member.name):
+        return False
+    dest_dir = os.path.realpath(dest_dir)
+    target = os.path.realpath(os.path.join(dest_dir, member.name))
+    if os.path.commonpath([dest_dir, target]) != dest_dir:
+        return False
+    if member.issym():
+        # relative links only, pointing inside of the entry
+        link_target = os.path.realpath(os.path.join(os.path.dirname(target), member.linkname))
+        return not os.path.isabs(member.linkname) and os.path.commonpath([dest_dir, link_target]) == dest_dir
+    return True
+
+
+def extract_archive(tar, dest_dir):
+    # returns False when the archive contains members outside of dest_dir or special files
+    if hasattr(tarfile, 'data_filter'):
+        try:
+            tar.extractall(dest_dir, filter='data')
+        except tarfile.FilterError:
+            return False
+        return True
+
+    members = tar.getmembers()
+    if not all(is_safe_member(member, dest_dir) for member in members):
+        return False
+    tar.extractall(dest_dir, members=members)
+    return True
+
+
+def get_compiler_identity():
+    # first line of the compiler version, CC/CXX environment variables are respected
+    identity = []
+    for env_var, default in [('CC', 'cc'), ('CXX', 'c++')]:
+        compiler = os.environ.get(env_var, default)
+        try:
+            out = run_with_ascii_output([compiler, '--version'], cwd=os.getcwd())
+        except OSError:
+            out = ''
+        identity.append(compiler + ': ' + (out.splitlines()[0] if out else 'unknown'))
+    return identity
+
+
+def get_platform_identity():
+    return platform.system() + '-' + platform.machine() + '-' + platform.release()
+
+
+def compute_key(parts):
+    # parts is a json-serializable dictionary
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_partition():
+    # entries of different platforms and toolchains are stored separately on the remote
+    toolchain = hashlib.sha256(json.dumps(get_compiler_identity()).encode('utf-8')).hexdigest()[:16]
+    return get_platform_identity() + '-' + toolchain
+
+
+def get_file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class HttpRemote:
+    # simple protocol, GET returns 404 for missing objects, PUT stores an object
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def get(self, path, local_file):
+        # returns False if the object does not exist
+        try:
+            with urllib.request.urlopen(self.base_url + '/' + path, timeout=REMOTE_CACHE_TIMEOUT_SEC) as resp:
+                with open(local_file, 'wb') as f:
+                    shutil.copyfileobj(resp, f)
+            return True
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+
+    def put(self, local_file, path):
+        with open(local_file, 'rb') as f:
+            req = urllib.request.Request(
+                self.base_url + '/' + path, data=f, method='PUT',
+                headers={ 'Content-Length': str(os.path.getsize(local_file)) })
+            with urllib.request.urlopen(req, timeout=REMOTE_CACHE_TIMEOUT_SEC):
+                pass
+
+    def get_sha256(self, path):
+        # returns None if the object does not exist, the object is hashed while it is read
+        h = hashlib.sha256()
+        try:
+            with urllib.request.urlopen(self.base_url + '/' + path, timeout=REMOTE_CACHE_TIMEOUT_SEC) as resp:
+                for chunk in iter(lambda: resp.read(1024 * 1024), b''):
+                    h.update(chunk)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+        return h.hexdigest()
+
+
+class DirectoryRemote:
+    # used for testing or with a shared network directory
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+
+    def get(self, path, local_file):
+        remote_file = os.path.join(self.base_dir, path)
+        if not os.path.exists(remote_file):
+            return False
+        shutil.copyfile(remote_file, local_file)
+        return True
+
+    def put(self, local_file, path):
+        remote_file = os.path.join(self.base_dir, path)
+        if not os.path.exists(os.path.dirname(remote_file)):
+            os.makedirs(os.path.dirname(remote_file), exist_ok=True)
+        # rename is atomic so that readers never see a partial file
+        tmp_file = remote_file + '.tmp' + str(os.getpid())
+        shutil.copyfile(local_file, tmp_file)
+        os.replace(tmp_file, remote_file)
+
+    def get_sha256(self, path):
+        # returns None if the object does not exist
+        remote_file = os.path.join(self.base_dir, path)
+        if not os.path.exists(remote_file):
+            return None
+        return get_file_sha256(remote_file)
+
+
+def create_remote(url):
+    if url.startswith('http://') or url.startswith('https://'):
+        return HttpRemote(url)
+    elif url.startswith('file://'):
+        return DirectoryRemote(url[len('file://'):])
+    else:
+        return DirectoryRemote(url)
+
+
+def get_dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            fp = os.path.join(root, f)
+            if not os.path.islink(fp):
+                size += os.path.getsize(fp)
+    return size
+
+
+def link_or_copy_tree(src, dest):
+    # hardlinks are used when possible, e.g. different filesystems require a copy
+    def link_or_copy(s, d):
+        try:
+            os.link(s, d)
+        except OSError:
+            shutil.copy2(s, d)
+    shutil.copytree(src, dest, symlinks=True, copy_function=link_or_copy)
+
+
+def is_restored_dir(path):
+    return os.path.exists(os.path.join(path, RESTORED_MARKER_FILE))
+
+
+class ArtifactCache:
+    def __init__(self, cache_dir, max_size_gb, remote=None):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 1024 * 1024 * 1024)
+        self.remote = remote
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def read_meta(self, key):
+        with open(os.path.join(self.get_entry_dir(key), ENTRY_META_FILE), 'r') as f:
+            return json.load(f)
+
+    def write_meta(self, key, meta):
+        with open(os.path.join(self.get_entry_dir(key), ENTRY_META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+
+    def contains(self, key):
+        return os.path.exists(os.path.join(self.get_entry_dir(key), ENTRY_META_FILE))
+
+    def get_remote_path(self, key, ext):
+        return get_partition() + '/' + key + ext
+
+    def download(self, key):
+        # returns True if the entry was downloaded from the remote tier to the local cache
+        with tempfile.TemporaryDirectory(dir=self.cache_dir, prefix='download_') as tmp_dir:
+            checksum_file = os.path.join(tmp_dir, 'checksum')
+            archive = os.path.join(tmp_dir, 'entry.tar.gz')
+            try:
+                # the checksum is uploaded last, entries without it are incomplete
+                if not self.remote.get(self.get_remote_path(key, '.sha256'), checksum_file):
+                    return False
+                log("Artifact cache: downloading entry " + key + " from remote cache.")
+                if not self.remote.get(self.get_remote_path(key, '.tar.gz'), archive):
+                    return False
+            except (OSError, urllib.error.URLError) as e:
+                warning("Artifact cache: download of entry " + key + " failed: " + str(e))
+                return False
+
+            with open(checksum_file, 'r') as f:
+                expected = f.read().strip()
+            if get_file_sha256(archive) != expected:
+                warning("Artifact cache: checksum of downloaded entry " + key + " does not match, ignoring it.")
+                return False
+
+            entry_tmp_dir = os.path.join(tmp_dir, key)
+            with tarfile.open(archive, 'r:gz') as tar:
+                if not extract_archive(tar, entry_tmp_dir):
+                    warning("Artifact cache: downloaded entry " + key + " contains unsafe paths, ignoring it.")
+                    return False
+            
+            # the entry appears in the local cache at once
+            try:
+                os.rename(entry_tmp_dir, self.get_entry_dir(key))
+            except OSError:
+                # downloaded by another process in the meantime
+                pass
+            
+        meta = self.read_meta(key)
+        meta['last_used'] = time.time()
+        self.write_meta(key, meta)
+        self.evict()
+        return True
+
+    def upload(self, key):
+        with tempfile.TemporaryDirectory(dir=self.cache_dir, prefix='upload_') as tmp_dir:
+            archive = os.path.join(tmp_dir, 'entry.tar.gz')
+            with tarfile.open(archive, 'w:gz') as tar:
+                for name in [ENTRY_DATA_DIR, ENTRY_META_FILE]:
+                    tar.add(os.path.join(self.get_entry_dir(key), name), arcname=name)
+            checksum = get_file_sha256(archive)
+            
+            log("Artifact cache: uploading entry " + key + " to remote cache.")
+            try:
+                self.remote.put(archive, self.get_remote_path(key, '.tar.gz'))
+                
+                # the checksum is published only for a complete upload, 
+                # incomplete entries are never downloaded
+                if self.remote.get_sha256(self.get_remote_path(key, '.tar.gz')) != checksum:
+                    warning("Artifact cache: verification of uploaded entry " + key + " failed.")
+                    return
+                
+                checksum_file = os.path.join(tmp_dir, 'checksum')
+                with open(checksum_file, 'w') as f:
+                    f.write(checksum + '\n')
+                self.remote.put(checksum_file, self.get_remote_path(key, '.sha256'))
+            except (OSError, urllib.error.URLError) as e:
+                warning("Artifact cache: upload of entry " + key + " failed: " + str(e))
+
+    def restore(self, key, dest_dir, paths=None):
+        # returns True on cache hit, dest_dir is replaced with the cached content, 
+        # paths recorded by store are changed to the given paths
+        if not self.contains(key) and not (self.remote and self.download(key)):
+            return False
+
+        log("Artifact cache: restoring '" + dest_dir + "' from entry " + key + ".")
+        if os.path.exists(dest_dir):
+            shutil.rmtree(dest_dir)
+        link_or_copy_tree(os.path.join(self.get_entry_dir(key), ENTRY_DATA_DIR), dest_dir)
+        meta = self.read_meta(key)
+        relocate_tree(dest_dir, meta.get('paths', {}), paths or {})
+        with open(os.path.join(dest_dir, RESTORED_MARKER_FILE), 'w') as f:
+            f.write(key + '\n')
+
+        meta['last_used'] = time.time()
+        self.write_meta(key, meta)
+        return True
+
+    def store(self, key, src_dir, info, paths=None):
+        # info is a dictionary with a description of the entry, 
+        # paths are absolute paths used in the content that restore relocates
+        if self.contains(key):
+            return
+
+        log("Artifact cache: storing '" + src_dir + "' as entry " + key + ".")
+        # copy into a temporary directory first so that an interrupted store does not create 
+        # an incomplete entry  
+        tmp_dir = os.path.join(self.cache_dir, 'tmp_' + key + '_' + str(os.getpid()))
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        shutil.copytree(src_dir, os.path.join(tmp_dir, ENTRY_DATA_DIR), symlinks=True)
+
+        meta = {
+            'info': info,
+            'paths': paths or {},
+            'size': get_dir_size(tmp_dir),
+            'created': time.time(),
+            'last_used': time.time()
+        }
+        with open(os.path.join(tmp_dir, ENTRY_META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+
+        try:
+            os.rename(tmp_dir, self.get_entry_dir(key))
+        except OSError:
+            # stored by another process in the meantime
+            shutil.rmtree(tmp_dir)
+            return
+
+        if self.remote:
+            self.upload(key)
+
+        self.evict()
+
+    def evict(self):
+        # removes least recently used entries until the cache fits its size limit
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            if os.path.isdir(self.get_entry_dir(key)) and self.contains(key):
+                meta = self.read_meta(key)
+                entries.append((meta['last_used'], meta['size'], key))
+
+        total = sum(size for _, size, _ in entries)
+        for last_used, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            log("Artifact cache: evicting entry " + key + " (" + str(int(size / (1024 * 1024))) + " MB).")
+            shutil.rmtree(self.get_entry_dir(key))
+            total -= size
+
+
+def get_artifact_cache(opts):
+    # returns None if the cache is not enabled
+    if not opts.artifact_cache_dir:
+        return None
+    
+    remote = None
+    if opts.artifact_cache_remote:
+        remote = create_remote(opts.artifact_cache_remote)
+    return ArtifactCache(opts.artifact_cache_dir, opts.artifact_cache_max_size_gb, remote)
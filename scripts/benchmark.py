@@ -0,0 +1,173 @@
+"""
+Copyright (C) 2019 by
+The Salk Institute for Biological Studies and
+Pittsburgh Supercomputing Center, Carnegie Mellon University
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+Simulation performance regression suite.
+
+Benchmark models are run several times with the built or extracted mcell,
+medians of wall and CPU times and the largest peak RSS of each model are
+compared against a baseline. Baselines are stored in the
+mcell_build_infrastructure_data directory, one file per OS, architecture
+and machine because the times are comparable only on the same machine.
+"""
+
+import os
+import json
+import shutil
+import socket
+
+from utils import *
+from build_settings import *
+import model_runner
+
+# measured values and their units in the report
+METRICS = [
+    ('wall_sec', 's'),
+    ('cpu_sec', 's'),
+    ('max_rss_kb', 'kB')
+]
+
+
+def get_baseline_file(opts):
+    name = platform.system() + '-' + platform.machine() + '-' + socket.gethostname().split('.')[0]
+    return os.path.join(opts.mcell_build_infrastructure_benchmarks_dir, name + '.json')
+
+
+def load_baseline(opts):
+    # returns dictionary model -> measured values, empty when there is no baseline yet
+    baseline_file = get_baseline_file(opts)
+    if not os.path.exists(baseline_file):
+        return {}
+    with open(baseline_file, 'r') as f:
+        return json.load(f)['models']
+
+
+def save_baseline(opts, results):
+    baseline_file = get_baseline_file(opts)
+    if not os.path.exists(os.path.dirname(baseline_file)):
+        os.makedirs(os.path.dirname(baseline_file))
+
+    # models that were not run this time keep their previous values
+    models = load_baseline(opts)
+    models.update(results)
+    with open(baseline_file, 'w') as f:
+        json.dump({ 'archive': os.path.basename(opts.result_bundle_archive_path), 'models': models }, f, indent=2)
+    log("Benchmark baseline was stored to '" + baseline_file + "'.")
+
+
+def get_regressions(opts, model, values, baseline_values):
+    # returns list of messages, one for each metric that got worse over the threshold
+    regressions = []
+    for metric, unit in METRICS:
+        base = baseline_values.get(metric)
+        current = values.get(metric)
+        if base is None or current is None or base <= 0:
+            continue
+        if unit == 's' and base < BENCHMARK_MIN_COMPARED_SEC:
+            continue
+        increase = 100.0 * (current - base) / base
+        if increase > opts.benchmark_threshold_percent:
+            regressions.append(
+                "model '" + model + "' " + metric + " increased by " + "{:.1f}".format(increase) + "% " +
+                "(" + "{:.2f}".format(base) + " -> " + "{:.2f}".format(current) + " " + unit + ")")
+    return regressions
+
+
+def write_report(opts, results, baseline):
+    lines = ["Wall [s]  Base [s]  CPU [s]  Base [s]  Peak RSS [MB]  Base [MB]  Model"]
+
+    def fmt(value, divisor=1):
+        return "{:.2f}".format(value / divisor) if value is not None else 'n/a'
+
+    for model, values in results.items():
+        base = baseline.get(model, {})
+        if not values['ok']:
+            lines.append("{:<58}  {}".format('failed', model))
+            continue
+        lines.append("{:>8}  {:>8}  {:>7}  {:>8}  {:>13}  {:>9}  {}".format(
+            fmt(values['wall_sec']), fmt(base.get('wall_sec')),
+            fmt(values['cpu_sec']), fmt(base.get('cpu_sec')),
+            fmt(values['max_rss_kb'], 1024), fmt(base.get('max_rss_kb'), 1024),
+            model))
+
+    report_file = os.path.join(opts.work_dir, BENCHMARK_REPORT_FILE)
+    with open(report_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    with open(os.path.join(opts.work_dir, BENCHMARK_RESULTS_FILE), 'w') as f:
+        json.dump({ 'archive': os.path.basename(opts.result_bundle_archive_path), 'models': results }, f, indent=2)
+
+    for line in lines:
+        log(line)
+    return report_file
+
+
+def run_benchmarks(opts, install_dirs):
+    # install_dirs are from the build or from the extracted bundle
+    if REPO_NAME_MCELL not in install_dirs or not os.path.exists(install_dirs[REPO_NAME_MCELL]):
+        fatal_error("No mcell build or extracted bundle was found, run the build (-2) or bundle (-3) first.")
+    mcell_dir = install_dirs[REPO_NAME_MCELL]
+
+    models = model_runner.load_model_list(opts.benchmark_models)
+    log("Running " + str(len(models)) + " benchmark models " + str(opts.benchmark_repeats) +
+        " times with mcell from '" + mcell_dir + "'.")
+
+    runs_dir = os.path.join(opts.work_dir, BENCHMARK_RUNS_DIR)
+    if os.path.exists(runs_dir):
+        shutil.rmtree(runs_dir)
+
+    results = {}
+    for i, model in enumerate(models):
+        log("Benchmarking model '" + model + "'.")
+        scratch_dir = os.path.join(runs_dir, str(i) + '_' + os.path.splitext(os.path.basename(model))[0])
+        res = model_runner.run_model_repeated(opts, model, mcell_dir, scratch_dir, opts.benchmark_repeats)
+        results[model] = { 'ok': res.ok, 'wall_sec': res.wall_sec, 'cpu_sec': res.cpu_sec, 'max_rss_kb': res.max_rss_kb }
+
+    baseline = load_baseline(opts)
+    report_file = write_report(opts, results, baseline)
+    log("Benchmark report was written to '" + report_file + "'.")
+
+    failed = [model for model, values in results.items() if not values['ok']]
+    regressions = []
+    for model, values in results.items():
+        if not values['ok']:
+            continue
+        if model not in baseline:
+            log("Model '" + model + "' has no baseline yet.")
+            continue
+        regressions += get_regressions(opts, model, values, baseline[model])
+
+    if opts.update_benchmark_baseline:
+        if failed:
+            fatal_error("Benchmark baseline was not updated because some models failed: " + ', '.join(failed))
+        save_baseline(opts, results)
+        return
+
+    if failed:
+        fatal_error("Benchmark models failed: " + ', '.join(failed))
+
+    if regressions:
+        msg = "Performance regressions over " + str(opts.benchmark_threshold_percent) + "% were found:\n  " + \
+            '\n  '.join(regressions)
+        if opts.benchmark_on_regression == BENCHMARK_ON_REGRESSION_FAIL:
+            fatal_error(msg)
+        else:
+            warning(msg)
+    else:
+        log("No performance regressions were found.")
+
+
+def store_results(opts, target_dir):
+    # copies benchmark results next to a stored bundle
+    results_file = os.path.join(opts.work_dir, BENCHMARK_RESULTS_FILE)
+    if not opts.do_benchmark or not os.path.exists(results_file):
+        return
+    target = os.path.join(target_dir, os.path.basename(opts.result_bundle_archive_path) + BENCHMARK_STORE_SUFFIX)
+    log("Copying benchmark results '" + results_file + "' to '" + target + "'.")
+    shutil.copy(results_file, target)
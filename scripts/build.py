@@ -10,9 +10,22 @@ https://opensource.org/licenses/MIT.
 """
 
 import os
+import re
+import shlex
+import shutil
 import platform
 from utils import *
 from build_settings import *
+from scheduler import BuildStep, run_build_steps, run_build_steps_serially
+import artifact_cache
+import repositories
+import compiler_cache
+import pgo
+import flag_tuning
+import profiling
+import compile_times
+import linker
+import debug_info
 
 def get_cmake_build_cmd(opts = None):
 
@@ -25,6 +38,89 @@ def get_cmake_build_cmd(opts = None):
     return ['cmake', '--build', '.', '--target', target, '--config', 'Release', '-j', str(get_nr_cores())]
 
 
+def get_generator(opts):
+    # returns None on Windows where the default generator is used
+    if os.name == 'nt':
+        return None
+
+    if opts.generator == GENERATOR_AUTO:
+        if shutil.which('ninja'):
+            return GENERATOR_NINJA
+        else:
+            return GENERATOR_MAKE
+    else:
+        if opts.generator == GENERATOR_NINJA and not shutil.which('ninja'):
+            fatal_error("Generator ninja was requested but ninja was not found in PATH.")
+        return opts.generator
+
+
+def get_cmake_generator_args(opts):
+    generator = get_generator(opts)
+    if not generator:
+        return []
+    return ['-G', CMAKE_GENERATOR_NAMES[generator]]
+
+
+def prepare_build_dir_for_generator(opts, build_dir):
+    # cmake cannot switch generator in a configured directory, 
+    # the directory is removed when it was configured with a different generator
+    generator = get_generator(opts)
+    if not generator:
+        return
+
+    stamp_file = os.path.join(build_dir, GENERATOR_STAMP_FILE)
+    if os.path.exists(stamp_file):
+        with open(stamp_file, 'r') as f:
+            prev_generator = f.read().strip()
+    elif os.path.exists(os.path.join(build_dir, 'CMakeCache.txt')):
+        # configured before the stamps were introduced, always with makefiles
+        prev_generator = GENERATOR_MAKE
+    else:
+        prev_generator = generator
+
+    if prev_generator != generator:
+        log("Build directory '" + build_dir + "' was configured for " + prev_generator + 
+            ", removing it to reconfigure for " + generator + ".")
+        shutil.rmtree(build_dir)
+
+    if not os.path.exists(build_dir):
+        os.makedirs(build_dir)
+    with open(stamp_file, 'w') as f:
+        f.write(generator + '\n')
+
+
+def get_ninja_version():
+    # returns tuple (major, minor) or (0, 0) if ninja was not found 
+    try:
+        out = run_with_ascii_output(['ninja', '--version'], cwd=os.getcwd())
+    except OSError:
+        return (0, 0)
+    matches = re.match('([0-9]+)\\.([0-9]+)', out.strip())
+    if matches:
+        return (int(matches.group(1)), int(matches.group(2)))
+    return (0, 0)
+
+
+def is_ninja_jobserver_client():
+    # older ninja and ninja with the pipe jobserver of make < 4.4 ignore MAKEFLAGS
+    return '--jobserver-auth=fifo:' in get_jobserver_makeflags() and \
+        get_ninja_version() >= NINJA_MIN_JOBSERVER_VERSION
+
+
+def get_native_build_cmd(opts, targets=None):
+    # command that builds the given targets (all when None) in a configured build directory
+    targets = targets if targets is not None else []
+    if os.name == 'nt':
+        return get_cmake_build_cmd(opts)
+
+    if get_generator(opts) == GENERATOR_NINJA:
+        if is_ninja_jobserver_client():
+            return ['ninja'] + targets
+        return ['ninja'] + targets + ['-j' + str(get_nr_cores())]
+    else:
+        return ['make'] + targets + get_make_parallel_args()
+
+
 def get_cmake_build_type_arg(opts):
     if opts.debug:
         build_type = 'Debug'
@@ -55,28 +151,163 @@ def is_default_compiler_supported_by_mcell() -> bool:
         return True
 
 
-def build_mcell(opts):
-
+def get_mcell_build_dir(opts):
     if not opts.only_pypi_wheel:
-        mcell_build_dir = os.path.join(opts.work_dir, BUILD_DIR_MCELL)
+        return os.path.join(opts.work_dir, BUILD_DIR_MCELL)
     else:
-        mcell_build_dir = os.path.join(opts.work_dir, BUILD_DIR_MCELL_PYPI)
+        return os.path.join(opts.work_dir, BUILD_DIR_MCELL_PYPI)
+
+
+def clean_build_for_compile_times(opts, build_dir):
+    # all translation units must be compiled to get a complete compile time report
+    if not opts.compile_time_report:
+        return
+    log("Cleaning '" + build_dir + "' to measure compile times of all files.")
+    cmd_clean = get_native_build_cmd(opts, ['clean'])
+    ec = run(cmd_clean, build_dir)
+    check_ec(ec, cmd_clean)
+
+
+def get_cmake_flags_args(compile_flags, link_flags):
+    # flags are always set so that flags of a previous configuration (e.g. PGO) do not 
+    # stay in the cmake cache, flags from the usual environment variables are kept,
+    # an -O flag replaces the default optimization level of the Release build
+    opt_flags = [f for f in compile_flags if f.startswith('-O')]
+    compile_flags = [f for f in compile_flags if not f.startswith('-O')]
+    release_flags = (opt_flags[-1] if opt_flags else '-O3') + ' -DNDEBUG'
+
+    c_flags = ' '.join([os.environ.get('CFLAGS', '')] + compile_flags).strip()
+    cxx_flags = ' '.join([os.environ.get('CXXFLAGS', '')] + compile_flags).strip()
+    return [
+        '-DCMAKE_C_FLAGS=' + c_flags,
+        '-DCMAKE_CXX_FLAGS=' + cxx_flags,
+        '-DCMAKE_C_FLAGS_RELEASE=' + release_flags,
+        '-DCMAKE_CXX_FLAGS_RELEASE=' + release_flags
+    ] + get_cmake_linker_flags_args(link_flags)
+
+
+def get_linker_flags(link_flags):
+    # flags from LDFLAGS are kept
+    return ' '.join([os.environ.get('LDFLAGS', '')] + link_flags).strip()
+
+
+def get_cmake_linker_flags_args(link_flags):
+    ld_flags = get_linker_flags(link_flags)
+    return [
+        '-DCMAKE_EXE_LINKER_FLAGS=' + ld_flags,
+        '-DCMAKE_SHARED_LINKER_FLAGS=' + ld_flags,
+        '-DCMAKE_MODULE_LINKER_FLAGS=' + ld_flags
+    ]
+
+
+def build_mcell(opts):
+
+    mcell_build_dir = get_mcell_build_dir(opts)
 
     log("Running mcell build...")
 
     # create working directory
     if not os.path.exists(mcell_build_dir):
         os.makedirs(mcell_build_dir)
+    prepare_build_dir_for_generator(opts, mcell_build_dir)
+
+    # flags selected with --tune-flags are used for releases
+    flags = []
+    if opts.release_version != INTERNAL_RELEASE_NO_VERSION and not opts.debug:
+        tuned_flags = flag_tuning.load_tuned_flags(opts)
+        if tuned_flags is not None:
+            flags = flag_tuning.remove_isa_flags(tuned_flags)
+            if flags != tuned_flags:
+                warning("Ignoring tuned flags that select an instruction set, use --isa-variants instead.")
+            log("Using tuned flags for release build: " + ' '.join(flags))
+    base_flags = [f for f in flags if f != LTO_FLAG]
+    use_lto = opts.use_lto or LTO_FLAG in flags
+
+    if opts.pgo:
+        pgo.build_with_pgo(
+            opts, mcell_build_dir, 
+            lambda compile_flags, link_flags, pgo_use_lto: 
+                configure_and_build_mcell(opts, mcell_build_dir, base_flags + compile_flags, link_flags, pgo_use_lto),
+            use_lto)
+    else:
+        configure_and_build_mcell(opts, mcell_build_dir, base_flags, [], use_lto)
+
+    return mcell_build_dir
+
+
+def get_isa_variant_step_name(variant):
+    return REPO_NAME_MCELL + '_' + variant
+
+
+def get_isa_variant_build_dir(opts, variant):
+    return os.path.join(opts.work_dir, BUILD_DIR_MCELL_ISA_PREFIX + variant)
+
+
+def build_mcell_isa_variant(opts, variant):
+    # the same build as the main one, only for a newer instruction set, 
+    # compiler cache is shared with the main build
+    if os.name == 'nt' or platform.machine().lower() not in ['x86_64', 'amd64']:
+        fatal_error("ISA variants are supported only with gcc and clang on x86-64.")
+
+    mcell_build_dir = get_isa_variant_build_dir(opts, variant)
+    log("Running mcell build for " + variant + "...")
+
+    if not os.path.exists(mcell_build_dir):
+        os.makedirs(mcell_build_dir)
+    prepare_build_dir_for_generator(opts, mcell_build_dir)
+
+    configure_and_build_mcell(opts, mcell_build_dir, ['-march=' + variant], [], opts.use_lto)
+    return mcell_build_dir
+
+
+def build_mcell_profiling(opts):
+    # release build with frame pointers and symbols, used for profiling
+    if os.name == 'nt':
+        fatal_error("Profiling build is supported only with gcc and clang.")
 
+    mcell_build_dir = profiling.get_profiling_build_dir(opts)
+    log("Running mcell profiling build...")
+
+    if not os.path.exists(mcell_build_dir):
+        os.makedirs(mcell_build_dir)
+    prepare_build_dir_for_generator(opts, mcell_build_dir)
+
+    configure_and_build_mcell(opts, mcell_build_dir, profiling.get_profiling_flags(), [], False)
+    return mcell_build_dir
+
+
+def build_mcell_with_flags(opts, mcell_build_dir, flags):
+    # used by flag tuning, LTO_FLAG enables LTO of the mcell build
+    if not os.path.exists(mcell_build_dir):
+        os.makedirs(mcell_build_dir)
+    prepare_build_dir_for_generator(opts, mcell_build_dir)
+
+    configure_and_build_mcell(opts, mcell_build_dir, [f for f in flags if f != LTO_FLAG], [], LTO_FLAG in flags)
+
+
+def tune_mcell_flags(opts):
+    # mcell needs VTK
+    run_build_steps_serially([s for s in get_build_steps(opts) if s.name == REPO_NAME_VTK], opts)
+    flag_tuning.tune_flags(opts, lambda build_dir, flags: build_mcell_with_flags(opts, build_dir, flags))
+
+
+def configure_and_build_mcell(opts, mcell_build_dir, compile_flags, link_flags, use_lto):
     # setup cmake build arguments
     cmd_cmake = [opts.cmake_executable]
     cmd_cmake += CMAKE_EXTRA_ARGS
+    cmd_cmake += get_cmake_generator_args(opts)
     cmd_cmake.append(os.path.join(opts.top_dir, REPO_NAME_MCELL))
 
     cmd_cmake.append(get_cmake_build_type_arg(opts))
+    cmd_cmake += compile_times.get_cmake_launcher_args(opts, os.path.basename(mcell_build_dir))
+    if os.name != 'nt':
+        debug_compile_flags, debug_link_flags = debug_info.get_debug_flags(opts)
+        cmd_cmake += get_cmake_flags_args(
+            compile_flags + debug_compile_flags, link_flags + debug_link_flags + linker.get_link_flags(opts, use_lto))
+        cmd_cmake += linker.get_cmake_linker_launcher_args(opts, os.path.basename(mcell_build_dir))
 
-    if BUILD_OPTS_USE_LTO:
-        cmd_cmake.append('-DENABLE_LTO=ON')
+    # always set so that the value from a previous configuration is not used 
+    cmd_cmake.append('-DENABLE_LTO=' + ('ON' if use_lto else 'OFF'))
 
     if opts.mcell_python:
         # default is 3.11
@@ -94,21 +325,25 @@ def build_mcell(opts):
         ec = run(cmd_cmake, mcell_build_dir)
     else:
         log("Not using default gcc 8.3.0 due to unresolved issue, fallback to gcc 7")
+        # run through shell, flags may contain spaces
+        cmd_cmake = [shlex.quote(arg) for arg in cmd_cmake]
         cmd_cmake.insert(0, "CC=gcc-7")
         cmd_cmake.insert(0, "CXX=g++-7")
         ec = run(cmd_cmake, mcell_build_dir, shell=True)
     check_ec(ec, cmd_cmake)
 
     if os.name != 'nt':
-        # setup make build arguments
-        cmd_make = ['make']
+        compile_times.begin_build(opts, os.path.basename(mcell_build_dir))
+        linker.begin_build(opts, os.path.basename(mcell_build_dir))
+        clean_build_for_compile_times(opts, mcell_build_dir)
 
+        # setup make or ninja build arguments
         if opts.only_pypi_wheel:
-            cmd_make.append('mcell4_so')
-
-        cmd_make.append('-j' + str(get_nr_cores()))
+            cmd_make = get_native_build_cmd(opts, ['mcell4_so'])
+        else:
+            cmd_make = get_native_build_cmd(opts)
 
-        # run make
+        # run make or ninja
         ec = run(cmd_make, mcell_build_dir, timeout_sec = BUILD_TIMEOUT)
         check_ec(ec, cmd_make)
     else:
@@ -117,8 +352,6 @@ def build_mcell(opts):
         ec = run(cmd_build, mcell_build_dir, timeout_sec = BUILD_TIMEOUT)
         check_ec(ec, cmd_build)
 
-    return mcell_build_dir
-
 
 def build_cellblender(opts):
 
@@ -166,6 +399,25 @@ def build_mesh_tools(opts):
     check_ec(ec, cmd_make)
 
 
+def get_vtk_cache_key(opts, cmd_cmake, vtk_build_dir):
+    # returns None when the build cannot be cached
+    state = repositories.get_repo_state(REPO_NAME_VTK, opts)
+    if state.is_dirty():
+        log("Repository '" + REPO_NAME_VTK + "' is dirty, not using artifact cache.")
+        return None
+
+    # the build directory is relocated on restore, 
+    # it is identified relative to the checkout
+    paths = artifact_cache.get_relocatable_paths(opts)
+    return artifact_cache.compute_key({
+        'sha': state.head_sha,
+        'cmake': artifact_cache.get_relative_args(cmd_cmake, paths),
+        'build_dir': artifact_cache.get_relative_args([vtk_build_dir], paths),
+        'compiler': artifact_cache.get_compiler_identity(),
+        'platform': artifact_cache.get_platform_identity()
+    })
+
+
 def build_vtk(opts):
 
     vtk_build_dir = os.path.join(opts.work_dir, BUILD_DIR_VTK)
@@ -179,6 +431,7 @@ def build_vtk(opts):
     # setup cmake build arguments
     cmd_cmake = [opts.cmake_executable]
     cmd_cmake += CMAKE_EXTRA_ARGS
+    cmd_cmake += get_cmake_generator_args(opts)
     cmd_cmake.append(os.path.join(opts.top_dir, REPO_NAME_VTK))
 
     # always built as release
@@ -210,36 +463,99 @@ def build_vtk(opts):
             '-DVTK_MODULE_ENABLE_VTK_FiltersPoints=NO'
         ]
 
+    # VTK almost never changes, try to reuse a previous build
+    cache = artifact_cache.get_artifact_cache(opts)
+    cache_key = None
+    if cache and opts.compile_time_report:
+        log("Not restoring VTK from artifact cache, its compile times are measured.")
+    elif cache:
+        cache_key = get_vtk_cache_key(opts, cmd_cmake, vtk_build_dir)
+        if cache_key and cache.restore(cache_key, vtk_build_dir, artifact_cache.get_relocatable_paths(opts)):
+            return
+        
+    if artifact_cache.is_restored_dir(vtk_build_dir):
+        # files are hardlinks to the cache, they must not be overwritten by the build 
+        log("Removing '" + vtk_build_dir + "' restored from artifact cache before rebuilding it.")
+        shutil.rmtree(vtk_build_dir)
+        os.makedirs(vtk_build_dir)
+    prepare_build_dir_for_generator(opts, vtk_build_dir)
+
+    # the launcher does not change the build outputs, it is not a part of the cache key
+    cmd_cmake += compile_times.get_cmake_launcher_args(opts, BUILD_DIR_VTK)
+    if os.name != 'nt':
+        # nor is the linker, VTK is built as static libraries
+        cmd_cmake += get_cmake_linker_flags_args(linker.get_link_flags(opts))
+        cmd_cmake += linker.get_cmake_linker_launcher_args(opts, BUILD_DIR_VTK)
+
     # run cmake
     ec = run(cmd_cmake, vtk_build_dir)
     check_ec(ec, cmd_cmake)
 
     # run make, will fail
     if os.name != 'nt':
-        # setup make build arguments
-        cmd_make = ['make']
-        cmd_make.append('-j' + str(get_nr_cores()))
-
+        compile_times.begin_build(opts, BUILD_DIR_VTK)
+        linker.begin_build(opts, BUILD_DIR_VTK)
+        clean_build_for_compile_times(opts, vtk_build_dir)
+        cmd_make = get_native_build_cmd(opts)
         ec = run(cmd_make, vtk_build_dir, timeout_sec = BUILD_TIMEOUT)
     else:
         cmd_build = get_cmake_build_cmd()
         ec = run(cmd_build, vtk_build_dir, timeout_sec = BUILD_TIMEOUT)
+        
+    if cache_key and ec == 0:
+        cache.store(cache_key, vtk_build_dir, { 'name': REPO_NAME_VTK, 'cmake': cmd_cmake },
+                    artifact_cache.get_relocatable_paths(opts))
+
+
+def get_build_steps(opts):
+    # weights set how the cores are divided between steps that run concurrently,
+    # cellblender and mesh_tools do not use parallel make 
+    # repos and outputs are used to skip steps whose inputs did not change
+    steps = [
+        BuildStep(REPO_NAME_VTK, build_vtk, weight=4,
+                  repos=[REPO_NAME_VTK], outputs=[os.path.join(opts.work_dir, BUILD_DIR_VTK)]),
+        BuildStep(REPO_NAME_MCELL, build_mcell, deps=[REPO_NAME_VTK], weight=4,
+                  repos=MCELL_BUILD_REPOSITORIES,
+                  outputs=[get_mcell_build_dir(opts)],
+                  # only the directory is an option, the stored flags may change
+                  extra={ 'tuned_flags': flag_tuning.load_tuned_flags(opts) })
+    ]
 
+    if not opts.only_pypi_wheel:
+        for variant in opts.isa_variants:
+            steps.append(BuildStep(
+                get_isa_variant_step_name(variant), lambda opts, variant=variant: build_mcell_isa_variant(opts, variant),
+                deps=[REPO_NAME_VTK], weight=4,
+                repos=MCELL_BUILD_REPOSITORIES, outputs=[get_isa_variant_build_dir(opts, variant)]))
 
-def build_all(opts):
-    build_dirs = {}
-
-    build_vtk(opts)
-
-    build_dirs[REPO_NAME_MCELL] = build_mcell(opts)
+        if opts.profiling:
+            steps.append(BuildStep(
+                REPO_NAME_MCELL + '_profiling', build_mcell_profiling, deps=[REPO_NAME_VTK], weight=4,
+                repos=MCELL_BUILD_REPOSITORIES, outputs=[profiling.get_profiling_build_dir(opts)]))
 
-    if not opts.only_pypi_wheel:
         # in-source build for now, should be fixed but it can work like this
         # needed for testing even for 'only_cellblender_mcell'
-        build_dirs[REPO_NAME_CELLBLENDER] = build_cellblender(opts)
+        steps.append(BuildStep(REPO_NAME_CELLBLENDER, build_cellblender, weight=1,
+                               repos=[REPO_NAME_CELLBLENDER], outputs=[os.path.join(opts.work_dir, BUILD_DIR_CELLBLENDER)]))
 
     if not opts.only_cellblender_mcell and not opts.only_pypi_wheel:
         if 'Windows' not in platform.system():
-            build_mesh_tools(opts)
+            steps.append(BuildStep(REPO_NAME_MESH_TOOLS, build_mesh_tools, weight=1, repos=[REPO_NAME_MESH_TOOLS]))
+
+    return steps
+
+
+def build_all(opts):
+    steps = get_build_steps(opts)
+
+    if opts.serial_build:
+        results = run_build_steps_serially(steps, opts)
+    else:
+        results = run_build_steps(steps, opts, get_nr_cores())
+
+    build_dirs = {}
+    build_dirs[REPO_NAME_MCELL] = results[REPO_NAME_MCELL]
+    if REPO_NAME_CELLBLENDER in results:
+        build_dirs[REPO_NAME_CELLBLENDER] = results[REPO_NAME_CELLBLENDER]
 
     return build_dirs
@@ -16,6 +16,7 @@ import os
 import platform
 import socket
 import datetime
+import tempfile
 from utils import *
 
 
@@ -27,6 +28,146 @@ BRANCH_PREFIX_MCELL4='mcell4'
 
 WORK_DIR_NAME = 'work'
 
+# directory under the top directory that contains worktree sets for each branch (--worktree)
+WORKTREES_DIR_NAME = 'mcell_worktrees'
+
+# number of repositories that are cloned/fetched/checked out in parallel,
+# 1 means that they are processed serially
+DEFAULT_REPO_JOBS = 1
+# default for mcell_git.py, bulk operations are mostly waiting for network
+DEFAULT_BULK_REPO_JOBS = 8
+
+# directory with lock files that represent slots of the core budget shared by all run.py processes 
+JOBSERVER_LOCK_DIR = os.path.join(tempfile.gettempdir(), 'mcell_build_jobserver')
+JOBSERVER_POLL_SEC = 5
+# the pipe is checked this often, a slot is acquired when make took all tokens
+# and released when more than JOBSERVER_SPARE_TOKENS stay unused for JOBSERVER_IDLE_POLLS checks
+JOBSERVER_FEED_SEC = 0.2
+JOBSERVER_SPARE_TOKENS = 1
+JOBSERVER_IDLE_POLLS = 10
+
+# default size limit of the artifact cache (--artifact-cache-dir)
+ARTIFACT_CACHE_MAX_SIZE_GB = 20
+REMOTE_CACHE_TIMEOUT_SEC = 60*10
+
+# cmake generators (--generator), auto selects ninja when it is installed
+GENERATOR_AUTO = 'auto'
+GENERATOR_NINJA = 'ninja'
+GENERATOR_MAKE = 'make'
+CMAKE_GENERATOR_NAMES = { GENERATOR_NINJA: 'Ninja', GENERATOR_MAKE: 'Unix Makefiles' }
+# ninja is a jobserver client since 1.13 and only with the fifo jobserver of make 4.4+
+NINJA_MIN_JOBSERVER_VERSION = (1, 13)
+# records the generator a build directory was configured with
+GENERATOR_STAMP_FILE = 'generator_stamp.txt'
+
+# mcell variants for x86-64 microarchitecture levels (--isa-variants),
+# x86-64 is the baseline used by the main mcell build
+ISA_VARIANTS = ['x86-64', 'x86-64-v2', 'x86-64-v3', 'x86-64-v4']
+ISA_VARIANT_BASELINE = 'x86-64'
+BUILD_DIR_MCELL_ISA_PREFIX = 'build_mcell_'
+# subdirectory of the mcell install directory with the variants
+INSTALL_SUBDIR_MCELL_ISA = 'isa'
+# selects the best variant at runtime, copied from system_files
+MCELL_ISA_DISPATCH_SCRIPT = 'mcell_isa.py'
+
+# flag tuning of mcell (--tune-flags), each axis is a list of alternative flag sets 
+# and all combinations are measured, the first combination is the reference, 
+# -O flags replace the optimization level of the Release build and -flto enables LTO,
+# flags selecting the instruction set are not used by release builds, newer CPUs 
+# are handled by ISA variants (--isa-variants)
+LTO_FLAG = '-flto'
+DEFAULT_TUNING_MATRIX = [
+    [['-O2'], ['-O3']],
+    [[], [LTO_FLAG]],
+    [[], ['-fno-semantic-interposition']]
+]
+ISA_FLAG_PREFIXES = ['-march=', '-mcpu=', '-mtune=']
+TUNING_BUILD_DIR_PREFIX = 'build_mcell_tune_'
+TUNING_RUNS_DIR = 'tuning_runs'
+TUNING_REPORT_FILE = 'flag_tuning_report.txt'
+
+# profiling build of mcell with frame pointers and symbols (--profiling)
+BUILD_DIR_MCELL_PROFILING = 'build_mcell_profiling'
+PROFILER_PERF = 'perf'
+PROFILER_PY_SPY = 'py-spy'
+PROFILING_FREQUENCY_HZ = 999
+# folded stacks and flamegraphs, in work_dir
+PROFILING_DIR = 'profiles'
+PROFILING_RUNS_DIR = 'profiling_runs'
+# profiles are stored next to the bundle archive with this suffix
+PROFILES_STORE_SUFFIX = '.profiles'
+
+# default number of runs of each benchmark model, the median is used
+BENCHMARK_REPEATS = 3
+
+# performance regression suite (-5), directories and files are in work_dir
+BENCHMARK_RUNS_DIR = 'benchmark_runs'
+BENCHMARK_REPORT_FILE = 'benchmark_report.txt'
+BENCHMARK_RESULTS_FILE = 'benchmark_results.json'
+# default increase of wall time, CPU time or peak RSS in percent reported as a regression 
+BENCHMARK_THRESHOLD_PERCENT = 10.0
+# models faster than this are too noisy to compare their times
+BENCHMARK_MIN_COMPARED_SEC = 1.0
+BENCHMARK_ON_REGRESSION_FAIL = 'fail'
+BENCHMARK_ON_REGRESSION_WARN = 'warn'
+# results are stored next to the bundle archive with this suffix
+BENCHMARK_STORE_SUFFIX = '.benchmark.json'
+
+# PGO build of mcell (--pgo), directories are in work_dir
+PGO_DIR = 'pgo_profiles'
+PGO_TRAINING_DIR = 'pgo_training'
+PGO_RAW_PROFILES_SUBDIR = 'raw'
+PGO_CLANG_PROFDATA_FILE = 'mcell.profdata'
+PGO_COMPLETE_FILE = 'complete'
+
+# models run by model_runner
+MODEL_RUN_TIMEOUT_SEC = 60*60
+MODEL_RUN_LOG_FILE = 'model_run.log'
+
+# stamps of build and bundle steps, in work_dir
+STAMPS_DIR = 'stamps'
+# output of each concurrently run build step, in work_dir
+BUILD_STEP_LOGS_DIR = 'logs'
+# names of bundle steps, build steps are named by their repository
+BUNDLE_STEP_BLENDER = 'bundle_blender'
+BUNDLE_STEP_CELLBLENDER = 'bundle_cellblender'
+BUNDLE_STEP_MCELL = 'bundle_mcell'
+BUNDLE_STEP_NEUROPIL_TOOLS = 'bundle_neuropil_tools'
+BUNDLE_STEP_GAMER = 'bundle_gamer'
+
+# supported compiler caches (--compiler-cache)
+COMPILER_CACHE_CCACHE = 'ccache'
+COMPILER_CACHE_SCCACHE = 'sccache'
+# per build step ccache stats logs, in work_dir
+COMPILER_CACHE_STATS_DIR = 'compiler_cache_stats'
+
+# compile time report (--compile-time-report), compiler launcher in this directory 
+# logs each compilation, logs and the report are in work_dir
+COMPILE_TIMER_SCRIPT = 'compile_timer.py'
+COMPILE_TIMES_DIR = 'compile_times'
+COMPILE_TIME_REPORT_FILE = 'compile_time_report.txt'
+# number of translation units and headers listed in the report
+COMPILE_TIME_REPORT_TOP = 30
+
+# linker passed as -fuse-ld (--linker), auto selects mold or lld when available
+LINKER_AUTO = 'auto'
+LINKER_MOLD = 'mold'
+LINKER_LLD = 'lld'
+LINKER_DEFAULT = 'default'
+LINKER_EXECUTABLES = {
+    LINKER_MOLD: 'mold',
+    LINKER_LLD: 'ld.lld' if platform.system() != 'Darwin' else 'ld64.lld'
+}
+# split DWARF of debug builds, binaries of the mcell build directory that get 
+# a .dwp package of their .dwo files when they are bundled
+DWP_TOOLS = ['dwp', 'llvm-dwp']
+DWP_SUFFIX = '.dwp'
+DEBUG_INFO_BINARIES = ['mcell', os.path.join('lib', 'mcell.so')]
+
+# link times logged by compile_timer.py, in work_dir
+LINK_TIMES_DIR = 'link_times'
+LINK_TIME_REPORT_FILE = 'link_time_report.txt'
+
 BUILD_OPTS_USE_LTO = False  # higher performnce but slower build
 
 BUILD_TIMEOUT = 60*60*4  # *30*4 # in seconds, Windows build can be slow
@@ -50,6 +191,11 @@ REPO_NAME_GAMER1 = 'gamer1'
 REPO_NAME_MCELL_TEST_PRIVATE = 'mcell_tests_private'
 REPO_NAME_VTK = 'VTK'
 
+# repositories used by the mcell build
+MCELL_BUILD_REPOSITORIES = [
+    REPO_NAME_MCELL, REPO_NAME_LIBBNG, REPO_NAME_NFSIM, REPO_NAME_NFSIMCINTERFACE, REPO_NAME_BIONETGEN
+]
+
 BUILD_DIR_MCELL = 'build_mcell'
 BUILD_DIR_MCELL_PYPI = 'build_mcell_pypi'
 BUILD_DIR_CELLBLENDER = 'build_cellblender' # this in fact an install dir for now
@@ -60,6 +206,21 @@ INSTALL_DIR_GAMER = 'install_gamer'
 
 INSTALL_DIR_MCELL = 'mcell'
 
+# memory-aware builds (--memory-aware), observed values are stored in COMPILE_JOB_MEMORY_FILE
+# in the work directory and override these defaults (in MB per compile job, key None is for other steps)
+DEFAULT_COMPILE_JOB_MEMORY_MB = {
+    None: 1000,
+    REPO_NAME_VTK: 1000,
+    REPO_NAME_MCELL: 2000,
+    REPO_NAME_GAMER: 1500
+}
+COMPILE_JOB_MEMORY_FILE = 'compile_job_memory.json'
+MEMORY_RESERVE_MB = 1024
+# new jobs are held back while less memory is available
+MEMORY_PRESSURE_AVAILABLE_MB = 1536
+MEMORY_PRESSURE_POLL_SEC = 5
+MEMORY_PRESSURE_MAX_WAIT_SEC = 60*10
+
 BLENDER_VERSION = '4.4'
 BLENDER_FULL_VERSION = '4.4.3'
 BUILD_DIR_BLENDER = 'blender'
@@ -68,6 +229,11 @@ BUILD_SUBDIR_BLENDER = 'Blender-' + BLENDER_FULL_VERSION + '-CellBlender' # name
 
 RELEASE_INFO_FILE = 'cellblender_bundle_release_info.txt'
 
+# machine-readable record of repository commits, written to the work directory
+MANIFEST_FILE = 'repositories_manifest.json'
+# manifest and configuration of the last build whose bundle was successfully created
+LAST_SUCCESSFUL_BUILD_FILE = 'last_successful_build.json'
+
 # BUILD_SUBDIR_BLENDER_OS_BASED is no longer in use in options.py
 if platform.system() == 'Linux':
     BUILD_SUBDIR_BLENDER_OS_BASED = BUILD_DIR_BLENDER + '-' + BLENDER_FULL_VERSION + '-' + platform.platform()
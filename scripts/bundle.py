@@ -10,6 +10,7 @@ https://opensource.org/licenses/MIT.
 
 import os
 import shutil
+import hashlib
 import sys
 import platform
 import multiprocessing
@@ -17,7 +18,15 @@ from typing import List, Dict
 
 from utils import *
 from build_settings import *
-from build import get_cmake_build_cmd
+from build import get_cmake_build_cmd, get_generator, prepare_build_dir_for_generator, get_native_build_cmd, \
+    get_isa_variant_step_name, get_isa_variant_build_dir, get_linker_flags
+import memory
+import artifact_cache
+import repositories
+import compiler_cache
+import stamps
+import linker
+import debug_info
 
 def copy_prebuilt_blender_w_python(opts) -> None:
     log("Copying pre-built blender with python from '" + opts.prebuilt_blender_w_python_base + "'.")
@@ -63,6 +72,9 @@ def sign_package_on_macos(blender_dir) -> None:
 
 def archive_resulting_bundle(opts, blender_dir, dir_to_archive=BUILD_SUBDIR_BLENDER) -> None:
     log("Creating resulting archive '" + opts.result_bundle_archive_path + "'.")
+    # the blender directory is reused by later runs, zip would update an existing archive
+    if os.path.exists(opts.result_bundle_archive_path):
+        os.remove(opts.result_bundle_archive_path)
 
     if platform.system() == 'Linux':
         cmd = TAR_BASE_CMD + ['-zcf', os.path.basename(opts.result_bundle_archive_path), dir_to_archive]
@@ -74,33 +86,95 @@ def archive_resulting_bundle(opts, blender_dir, dir_to_archive=BUILD_SUBDIR_BLEN
     check_ec(ec, cmd)
 
 
+def get_gamer_cache_key(opts, cmake_blendgamer_script, blender_dir, gamer_build_dir):
+    # returns None when the build cannot be cached
+    state = repositories.get_repo_state(REPO_NAME_GAMER, opts)
+    if state.is_dirty():
+        log("Repository '" + REPO_NAME_GAMER + "' is dirty, not using artifact cache.")
+        return None
+
+    with open(cmake_blendgamer_script, 'rb') as f:
+        script_hash = hashlib.sha256(f.read()).hexdigest()
+
+    # the build directory is relocated on restore, 
+    # it is identified relative to the checkout
+    paths = artifact_cache.get_relocatable_paths(opts)
+    return artifact_cache.compute_key({
+        'sha': state.head_sha,
+        'script': script_hash,
+        'blender': BLENDER_FULL_VERSION,
+        'blender_dir': artifact_cache.get_relative_args([blender_dir], paths),
+        'generator': get_generator(opts),
+        'linker': opts.resolved_linker,
+        'build_dir': artifact_cache.get_relative_args([gamer_build_dir], paths),
+        'compiler': artifact_cache.get_compiler_identity(),
+        'platform': artifact_cache.get_platform_identity()
+    })
+
+
 def build_gamer(opts, blender_dir):
     log("Running gamer build...")
 
     cmake_blendgamer_script = os.path.join(opts.top_dir, 'mcell_tools', 'scripts', 'cmake_blendgamer.sh')
     gamer_build_dir = os.path.join(opts.work_dir, BUILD_DIR_GAMER)
 
+    cache = artifact_cache.get_artifact_cache(opts)
+    cache_key = None
+    if cache:
+        cache_key = get_gamer_cache_key(opts, cmake_blendgamer_script, blender_dir, gamer_build_dir)
+        if cache_key and cache.restore(cache_key, gamer_build_dir, artifact_cache.get_relocatable_paths(opts)):
+            return
+
+    if artifact_cache.is_restored_dir(gamer_build_dir):
+        # files are hardlinks to the cache, they must not be overwritten by the build 
+        log("Removing '" + gamer_build_dir + "' restored from artifact cache before rebuilding it.")
+        shutil.rmtree(gamer_build_dir)
+
     if not os.path.exists(gamer_build_dir):
         os.makedirs(gamer_build_dir)
+    prepare_build_dir_for_generator(opts, gamer_build_dir)
 
     cmd_bash_cmake = ['bash', cmake_blendgamer_script, blender_dir, gamer_build_dir]
+    # passed by the script to cmake
+    cmake_env = { 'EXTRA_CMAKE_ARGS': ' '.join(compiler_cache.get_cmake_launcher_args(opts)) }
+    if os.name != 'nt':
+        cmake_env['EXTRA_CMAKE_ARGS'] += ' ' + ' '.join(linker.get_cmake_linker_launcher_args(opts, BUILD_DIR_GAMER))
+        # may contain spaces, passed by the script as a single argument
+        cmake_env['LINKER_FLAGS'] = get_linker_flags(linker.get_link_flags(opts))
+    if get_generator(opts):
+        # used by cmake when -G is not given 
+        cmake_env['CMAKE_GENERATOR'] = CMAKE_GENERATOR_NAMES[get_generator(opts)]
 
     # run cmake
-    ec = run(cmd_bash_cmake, gamer_build_dir, timeout_sec = BUILD_TIMEOUT)
+    ec = run(cmd_bash_cmake, gamer_build_dir, timeout_sec = BUILD_TIMEOUT, extra_env=cmake_env)
     check_ec(ec, cmd_bash_cmake)
 
-    if os.name != 'nt':
-        # setup make build arguments
-        cmd_make = ['make']
-        cmd_make.append('-j' + str(get_nr_cores()))
+    cache_state = compiler_cache.begin_step(opts, REPO_NAME_GAMER)
+
+    if opts.memory_aware:
+        set_thread_nr_cores(memory.limit_cores_by_memory(opts, REPO_NAME_GAMER, get_nr_cores()))
+    reset_max_child_rss()
 
-        # run make
+    if os.name != 'nt':
+        linker.begin_build(opts, BUILD_DIR_GAMER)
+        # run make or ninja
+        cmd_make = get_native_build_cmd(opts)
         ec = run(cmd_make, gamer_build_dir, timeout_sec = BUILD_TIMEOUT)
         check_ec(ec, cmd_make)
     else:
         cmd_build = get_cmake_build_cmd()
         ec = run(cmd_build, gamer_build_dir, timeout_sec = BUILD_TIMEOUT)
 
+    compiler_cache.end_step(opts, REPO_NAME_GAMER, cache_state)
+
+    if opts.memory_aware:
+        set_thread_nr_cores(None)
+        memory.release_memory(REPO_NAME_GAMER)
+        memory.record_compile_job_memory(opts, REPO_NAME_GAMER, get_max_child_rss_kb())
+
+    if cache_key:
+        cache.store(cache_key, gamer_build_dir, { 'name': REPO_NAME_GAMER }, artifact_cache.get_relocatable_paths(opts))
+
 
 def unpack_blendgamer(opts, blender_dir):
     # not sure which version will be make, expecting that there will be just one .zip file
@@ -119,8 +193,8 @@ def unpack_blendgamer(opts, blender_dir):
 
     addons_dir = os.path.join(blender_dir, INSTALL_SUBDIR_ADDONS)
 
-    # unpack it
-    cmd = UNZIP_CMD + [blendgamer_zip, '-d', addons_dir]
+    # unpack it, overwrites files from a previous bundle run
+    cmd = UNZIP_CMD + ['-o', blendgamer_zip, '-d', addons_dir]
     # must be run from work_dir to avoid having full paths in the archive
     ec = run(cmd, cwd=build_gamer_dir, timeout_sec=BUILD_TIMEOUT)
     check_ec(ec, cmd)
@@ -185,21 +259,18 @@ def extract_resulting_bundle(opts) -> List[str]:
     return get_extracted_bundle_install_dirs(opts)
 
 
-# main entry point
-def create_bundle(opts) -> None:
-
+def install_blender(opts, blender_dir) -> None:
     # clear target directory
-    blender_dir = os.path.join(opts.work_dir, BUILD_DIR_BLENDER)
-
     if os.path.exists(blender_dir):
         log("Cleaning '" + blender_dir)
         shutil.rmtree(blender_dir)
 
-    # A) prepare blender directory with new python
     copy_prebuilt_blender_w_python(opts)
 
-    # B) copy cellblender
-    cellblender_dir = os.path.join(blender_dir, INSTALL_SUBDIR_CELLBLENDER)
+
+def install_cellblender(opts, cellblender_dir) -> None:
+    if os.path.exists(cellblender_dir):
+        shutil.rmtree(cellblender_dir)
     log("Installing cellblender to '" + cellblender_dir + "'.")
     shutil.copytree(
         os.path.join(os.path.join(opts.work_dir), BUILD_DIR_CELLBLENDER, REPO_NAME_CELLBLENDER),
@@ -207,36 +278,84 @@ def create_bundle(opts) -> None:
         symlinks=True
     )
 
-    # C) copy mcell
-    mcell_dir = os.path.join(blender_dir, INSTALL_SUBDIR_MCELL)
+
+def install_mcell(opts, mcell_dir) -> None:
+    if os.path.exists(mcell_dir):
+        shutil.rmtree(mcell_dir)
     log("Installing mcell to '" + mcell_dir + "'.")
+    mcell_ignore = shutil.ignore_patterns('CMakeFiles', 'deps', '*.a', '*.tlog', '*.log', '*.dir', '*.dwo')
     shutil.copytree(
         os.path.join(opts.work_dir, BUILD_DIR_MCELL),
         mcell_dir,
-        ignore=shutil.ignore_patterns('CMakeFiles', 'deps', '*.a', '*.tlog', '*.log', '*.dir')
+        ignore=mcell_ignore
     )
+    debug_info.install_debug_info(opts, os.path.join(opts.work_dir, BUILD_DIR_MCELL), mcell_dir)
+
+    # variants for newer CPUs and a script that selects one of them at runtime 
+    if opts.isa_variants:
+        for variant in opts.isa_variants:
+            variant_dir = os.path.join(mcell_dir, INSTALL_SUBDIR_MCELL_ISA, variant)
+            log("Installing mcell " + variant + " to '" + variant_dir + "'.")
+            shutil.copytree(get_isa_variant_build_dir(opts, variant), variant_dir, ignore=mcell_ignore)
+            debug_info.install_debug_info(opts, get_isa_variant_build_dir(opts, variant), variant_dir)
+        shutil.copy(
+            os.path.join(opts.top_dir, REPO_NAME_MCELL_TOOLS, 'system_files', MCELL_ISA_DISPATCH_SCRIPT),
+            mcell_dir
+        )
+
+    # other dependencies that might be needed and must be installed after plugins
+    if platform.system() == 'Darwin':
+        shutil.copyfile(
+            os.path.join(opts.top_dir, REPO_NAME_MCELL_TOOLS, 'system_files', 'darwin', 'libintl.8.dylib'),
+            os.path.join(mcell_dir, 'lib', 'libintl.8.dylib')
+        )
+
+
+# main entry point
+def create_bundle(opts) -> None:
+    # each part of the bundle is a step that is skipped when its inputs did not change,
+    # all parts depend on the blender directory, when it is created again, all of them are run again
+    blender_dir = os.path.join(opts.work_dir, BUILD_DIR_BLENDER)
+
+    # A) prepare blender directory with new python
+    stamps.run_with_stamp(
+        opts, BUNDLE_STEP_BLENDER, lambda: install_blender(opts, blender_dir),
+        outputs=[blender_dir])
+
+    # B) copy cellblender
+    cellblender_dir = os.path.join(blender_dir, INSTALL_SUBDIR_CELLBLENDER)
+    stamps.run_with_stamp(
+        opts, BUNDLE_STEP_CELLBLENDER, lambda: install_cellblender(opts, cellblender_dir),
+        deps=[BUNDLE_STEP_BLENDER, REPO_NAME_CELLBLENDER], outputs=[cellblender_dir])
+
+    # C) copy mcell
+    mcell_dir = os.path.join(blender_dir, INSTALL_SUBDIR_MCELL)
+    stamps.run_with_stamp(
+        opts, BUNDLE_STEP_MCELL, lambda: install_mcell(opts, mcell_dir),
+        deps=[BUNDLE_STEP_BLENDER, REPO_NAME_MCELL] + [get_isa_variant_step_name(v) for v in opts.isa_variants], 
+        outputs=[mcell_dir])
 
     # neuropil_tools and mesh_tools
     if 'Windows' not in platform.system():
         neuropil_tools_dir = os.path.join(blender_dir, INSTALL_SUBDIR_NEUROPIL_TOOLS)
-        install_neuropil_tools(opts, neuropil_tools_dir)
+        stamps.run_with_stamp(
+            opts, BUNDLE_STEP_NEUROPIL_TOOLS, lambda: install_neuropil_tools(opts, neuropil_tools_dir),
+            repos=[REPO_NAME_NEUROPIL_TOOLS], deps=[BUNDLE_STEP_BLENDER, REPO_NAME_MESH_TOOLS], 
+            outputs=[neuropil_tools_dir])
 
     # gamer
     if not opts.do_not_build_gamer:
         # gamer must be built at this phase because we need the blender executable
-        build_gamer(opts, blender_dir)
-        unpack_blendgamer(opts, blender_dir)
+        stamps.run_with_stamp(
+            opts, REPO_NAME_GAMER, lambda: build_gamer(opts, blender_dir),
+            repos=[REPO_NAME_GAMER], outputs=[os.path.join(opts.work_dir, BUILD_DIR_GAMER)])
+        stamps.run_with_stamp(
+            opts, BUNDLE_STEP_GAMER, lambda: unpack_blendgamer(opts, blender_dir),
+            deps=[BUNDLE_STEP_BLENDER, REPO_NAME_GAMER])
 
     # E) bionetgen
     # NOTE: mcell build already copies all the needed tools, probably that's all we need for now
 
-    # other dependencies that might be needed and must be installed after plugins
-    if platform.system() == 'Darwin':
-        shutil.copyfile(
-            os.path.join(opts.top_dir, REPO_NAME_MCELL_TOOLS, 'system_files', 'darwin', 'libintl.8.dylib'),
-            os.path.join(mcell_dir, 'lib', 'libintl.8.dylib')
-        )
-
     # add a version file
     blender_subdir = os.path.join(blender_dir, BUILD_SUBDIR_BLENDER)
     log("Copying version file to '" + blender_subdir + "'.")
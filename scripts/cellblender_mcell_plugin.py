@@ -19,6 +19,7 @@ from typing import List, Dict
 from utils import *
 from build_settings import *
 from bundle import archive_resulting_bundle, extract_resulting_bundle, get_install_dir
+import debug_info
 
 
 def extract_resulting_package(opts) -> List[str]:
@@ -59,8 +60,9 @@ def create_package(opts) -> None:
     shutil.copytree(
         os.path.join(opts.work_dir, BUILD_DIR_MCELL),
         mcell_dir,
-        ignore=shutil.ignore_patterns('CMakeFiles', 'deps', '*.a')
+        ignore=shutil.ignore_patterns('CMakeFiles', 'deps', '*.a', '*.dwo')
     )
+    debug_info.install_debug_info(opts, os.path.join(opts.work_dir, BUILD_DIR_MCELL), mcell_dir)
     
     # add a version file
     log("Copying version file to '" + plugin_dir + "'.")
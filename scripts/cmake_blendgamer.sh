@@ -29,8 +29,14 @@ if [[ $UN == *"deb8u1"* ]]; then
   COMPILER_OVERRIDE="-DCMAKE_C_COMPILER=/home/tester/tools/gcc-7.5.0/bin/gcc -DCMAKE_CXX_COMPILER=/home/tester/tools/gcc-7.5.0/bin/g++ "
 fi
 
+# linker flags are set only when LINKER_FLAGS is defined, LDFLAGS are used otherwise
+LINKER_ARGS=()
+if [ -n "${LINKER_FLAGS+x}" ]; then
+  LINKER_ARGS=("-DCMAKE_EXE_LINKER_FLAGS=$LINKER_FLAGS" "-DCMAKE_SHARED_LINKER_FLAGS=$LINKER_FLAGS" "-DCMAKE_MODULE_LINKER_FLAGS=$LINKER_FLAGS")
+fi
+
 # override -DPYBIND11_PYTHON_VERSION=3.5 is needed for MacOS because even with
 # the default python being the one from conda, pybind11 uses the system libs
-cmake ../../../gamer -DBUILD_BLENDGAMER=ON -DCMAKE_BUILD_TYPE=Release -DBLENDER_VERSION=4.4.3 -DPYBIND11_PYTHON_VERSION=3.11 $COMPILER_OVERRIDE || exit 1
+cmake ../../../gamer -DBUILD_BLENDGAMER=ON -DCMAKE_BUILD_TYPE=Release -DBLENDER_VERSION=4.4.3 -DPYBIND11_PYTHON_VERSION=3.11 $COMPILER_OVERRIDE $EXTRA_CMAKE_ARGS "${LINKER_ARGS[@]}" || exit 1
 
 
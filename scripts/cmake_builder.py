@@ -18,6 +18,7 @@ import re
 import multiprocessing
 
 from build_settings import *
+import artifact_cache
 
 CMAKE_LOCAL_INSTALL_DIR = 'cmake_install'
 CMAKE_LOCAL_INSTALL_BIN_DIR = os.path.join(CMAKE_LOCAL_INSTALL_DIR, 'bin')
@@ -66,7 +67,7 @@ def get_cmake_info(base_dir: str = '') -> (bool, bool):
     return (False, False)
 
 
-def download_and_build_cmake(work_dir):
+def download_and_build_cmake(work_dir, cache=None):
     sources_dir = os.path.join(work_dir, CMAKE_SRC_DIR)
     build_dir = os.path.join(work_dir, CMAKE_LOCAL_BUILD_DIR)
     install_dir = os.path.join(work_dir, CMAKE_LOCAL_INSTALL_DIR)
@@ -74,6 +75,17 @@ def download_and_build_cmake(work_dir):
     if not os.path.exists(work_dir):
         os.mkdir(work_dir)
     
+    cache_key = None
+    if cache:
+        cache_key = artifact_cache.compute_key({
+            'url': CMAKE_SRC_URL,
+            # cmake finds its data directory relative to the executable, the install directory can be moved 
+            'compiler': artifact_cache.get_compiler_identity(),
+            'platform': artifact_cache.get_platform_identity()
+        })
+        if cache.restore(cache_key, install_dir):
+            return
+    
     # 1) download
     ec = run(['wget', CMAKE_SRC_URL], cwd=work_dir)
     if ec != 0:
@@ -94,13 +106,16 @@ def download_and_build_cmake(work_dir):
     # 3) make install
     if not os.path.exists(build_dir):
         os.mkdir(build_dir)
-    ec = run(['make', 'install', '-j' + str(int(multiprocessing.cpu_count()/2))], cwd=build_dir)
+    ec = run(['make', 'install'] + get_make_parallel_args(), cwd=build_dir)
     if ec != 0:
         fatal_error("Could not build cmake, cmake of sufficient version must be buillt manually")
+        
+    if cache_key:
+        cache.store(cache_key, install_dir, { 'name': 'cmake', 'url': CMAKE_SRC_URL })
     
     
 # returns path to the cmake binary or just 'cmake' if the system version is ok
-def build_cmake_if_version_is_insufficient(work_dir) -> str:
+def build_cmake_if_version_is_insufficient(work_dir, cache=None) -> str:
     # check the system version first
     exists, version_ok = get_cmake_info()
     
@@ -121,7 +136,7 @@ def build_cmake_if_version_is_insufficient(work_dir) -> str:
         else:
             # we need to download the sources and build them
             log("Downloading and building cmake")
-            download_and_build_cmake(work_dir)
+            download_and_build_cmake(work_dir, cache)
             log("Built cmake in '" + cmake_executable + "'")
             return cmake_executable 
             
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (C) 2019 by
+The Salk Institute for Biological Studies and
+Pittsburgh Supercomputing Center, Carnegie Mellon University
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+Compiler launcher that measures each compilation.
+
+Used by cmake as CMAKE_<LANG>_COMPILER_LAUNCHER:
+  compile_timer.py --log FILE [--time-trace] compiler args...
+
+Wall time, CPU time and peak RSS of the compiler are appended as one json
+line to FILE, --time-trace adds -ftime-trace so that clang writes a trace
+of the compilation next to the object file. This script is run for every
+translation unit, it must not import the other build scripts.
+
+It is also used as CMAKE_<LANG>_LINKER_LAUNCHER to time links.
+"""
+
+import os
+import sys
+import json
+import time
+import subprocess
+
+SOURCE_EXTENSIONS = ('.c', '.cc', '.cpp', '.cxx', '.c++', '.C')
+
+
+def get_source_and_output(args):
+    source = None
+    output = None
+    for i, arg in enumerate(args):
+        if arg == '-o' and i + 1 < len(args):
+            output = args[i + 1]
+        elif arg == '-c' and i + 1 < len(args) and not args[i + 1].startswith('-'):
+            source = args[i + 1]
+        elif source is None and arg.endswith(SOURCE_EXTENSIONS):
+            source = arg
+    return source, output
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) < 3 or args[0] != '--log':
+        sys.exit("Usage: compile_timer.py --log FILE [--time-trace] compiler args...")
+    log_file = args[1]
+    args = args[2:]
+    if args[0] == '--time-trace':
+        args = args[1:] + ['-ftime-trace']
+
+    start = time.time()
+    try:
+        proc = subprocess.Popen(args)
+    except OSError as e:
+        sys.exit("compile_timer.py: could not run '" + args[0] + "': " + str(e))
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall_sec = time.time() - start
+    ec = os.waitstatus_to_exitcode(status)
+    proc.returncode = ec
+
+    source, output = get_source_and_output(args)
+    max_rss_kb = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes on MacOS
+        max_rss_kb //= 1024
+
+    record = {
+        'source': os.path.abspath(source) if source else None,
+        'output': os.path.abspath(output) if output else None,
+        'wall_sec': wall_sec,
+        'cpu_sec': rusage.ru_utime + rusage.ru_stime,
+        'max_rss_kb': max_rss_kb,
+        'ok': ec == 0
+    }
+    # a short write with O_APPEND is not interleaved with writes of concurrent compilations
+    with open(log_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+    sys.exit(ec)
+
+
+if __name__ == '__main__':
+    main()
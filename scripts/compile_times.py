@@ -0,0 +1,165 @@
+"""
+Copyright (C) 2019 by
+The Salk Institute for Biological Studies and
+Pittsburgh Supercomputing Center, Carnegie Mellon University
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+Compile time report of the mcell and VTK builds.
+
+Every compilation is run through compile_timer.py set as the cmake
+compiler launcher, it logs wall time, CPU time and peak RSS of each
+translation unit. With clang, -ftime-trace is also used and the time spent
+in parsing of each header is summed over all translation units.
+
+Builds are cleaned before they are timed so that all translation units are
+compiled, the compiler cache is not used.
+"""
+
+import os
+import sys
+import json
+from collections import defaultdict
+
+from utils import *
+from build_settings import *
+import compiler_cache
+import pgo
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# names of the builds timed in this run, logs of other builds are from previous runs
+begun_builds = set()
+
+
+def get_log_file(opts, name):
+    return os.path.join(opts.work_dir, COMPILE_TIMES_DIR, name + '.jsonl')
+
+
+def get_cmake_launcher_args(opts, name):
+    # launcher arguments for the build logged as name, the compiler cache when not enabled
+    if not opts.compile_time_report:
+        launcher_args = compiler_cache.get_cmake_launcher_args(opts)
+        if launcher_args:
+            return launcher_args
+        # the launcher from a previous configuration must not stay in the cmake cache
+        return ['-DCMAKE_C_COMPILER_LAUNCHER=', '-DCMAKE_CXX_COMPILER_LAUNCHER=']
+
+    launcher = [sys.executable, os.path.join(THIS_DIR, COMPILE_TIMER_SCRIPT), '--log', get_log_file(opts, name)]
+    if pgo.is_clang():
+        launcher.append('--time-trace')
+    return [
+        '-DCMAKE_C_COMPILER_LAUNCHER=' + ';'.join(launcher),
+        '-DCMAKE_CXX_COMPILER_LAUNCHER=' + ';'.join(launcher)
+    ]
+
+
+def begin_build(opts, name):
+    # called before a timed build, removes results of the previous one
+    if not opts.compile_time_report:
+        return
+    begun_builds.add(name)
+    log_file = get_log_file(opts, name)
+    if not os.path.exists(os.path.dirname(log_file)):
+        os.makedirs(os.path.dirname(log_file))
+    if os.path.exists(log_file):
+        os.remove(log_file)
+
+
+def load_header_times(trace_file, header_times):
+    # header_times: path -> [microseconds, number of translation units]
+    try:
+        with open(trace_file, 'r') as f:
+            events = json.load(f).get('traceEvents', [])
+    except (OSError, ValueError):
+        return
+    seen = set()
+    for event in events:
+        if event.get('name') != 'Source' or 'dur' not in event:
+            continue
+        header = event.get('args', {}).get('detail')
+        if not header:
+            continue
+        header_times[header][0] += event['dur']
+        if header not in seen:
+            header_times[header][1] += 1
+            seen.add(header)
+
+
+def write_report(opts):
+    times_dir = os.path.join(opts.work_dir, COMPILE_TIMES_DIR)
+    if not os.path.exists(times_dir):
+        return
+
+    records = []
+    for name in sorted(os.listdir(times_dir)):
+        if not name.endswith('.jsonl'):
+            continue
+        if os.path.splitext(name)[0] not in begun_builds:
+            warning("Compile times of '" + os.path.splitext(name)[0] + "' are from a previous run, not using them.")
+            continue
+        with open(os.path.join(times_dir, name), 'r') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    record['build'] = os.path.splitext(name)[0]
+                    records.append(record)
+    if not records:
+        warning("No compilations were logged, compile time report was not created.")
+        return
+
+    header_times = defaultdict(lambda: [0, 0])
+    for record in records:
+        if record['output']:
+            trace_file = os.path.splitext(record['output'])[0] + '.json'
+            if os.path.exists(trace_file):
+                load_header_times(trace_file, header_times)
+
+    lines = ["Builds"]
+    totals = defaultdict(lambda: [0, 0.0, 0.0])
+    for record in records:
+        totals[record['build']][0] += 1
+        totals[record['build']][1] += record['wall_sec']
+        totals[record['build']][2] += record['cpu_sec']
+    for build, (count, wall_sec, cpu_sec) in sorted(totals.items()):
+        lines.append("  {}: {} translation units, {:.1f} s wall, {:.1f} s CPU".format(build, count, wall_sec, cpu_sec))
+
+    lines.append('')
+    lines.append("Slowest translation units")
+    lines.append("  Wall [s]  CPU [s]  Peak RSS [MB]  Build  Source")
+    ranked = sorted(records, key=lambda r: r['wall_sec'], reverse=True)
+    for record in ranked[:COMPILE_TIME_REPORT_TOP]:
+        lines.append("  {:>8.2f}  {:>7.2f}  {:>13.0f}  {}  {}".format(
+            record['wall_sec'], record['cpu_sec'], record['max_rss_kb'] / 1024, record['build'], record['source'] or record['output']))
+
+    lines.append('')
+    lines.append("Largest peak memory")
+    lines.append("  Peak RSS [MB]  Build  Source")
+    for record in sorted(records, key=lambda r: r['max_rss_kb'], reverse=True)[:COMPILE_TIME_REPORT_TOP]:
+        lines.append("  {:>13.0f}  {}  {}".format(record['max_rss_kb'] / 1024, record['build'], record['source'] or record['output']))
+
+    lines.append('')
+    if header_times:
+        lines.append("Most expensive headers (parse time summed over all translation units, includes nested headers)")
+        lines.append("  Total [s]  TUs  Header")
+        ranked_headers = sorted(header_times.items(), key=lambda item: item[1][0], reverse=True)
+        for header, (usec, count) in ranked_headers[:COMPILE_TIME_REPORT_TOP]:
+            lines.append("  {:>9.2f}  {:>3}  {}".format(usec / 1e6, count, header))
+    else:
+        lines.append("Header times are available only with clang (-ftime-trace).")
+
+    report_file = os.path.join(opts.work_dir, COMPILE_TIME_REPORT_FILE)
+    with open(report_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    with open(os.path.splitext(report_file)[0] + '.json', 'w') as f:
+        json.dump({
+            'translation_units': ranked,
+            'headers': { header: { 'sec': usec / 1e6, 'translation_units': count }
+                         for header, (usec, count) in header_times.items() }
+        }, f, indent=2)
+
+    log("Compile time report was written to '" + report_file + "'.")
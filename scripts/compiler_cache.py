@@ -0,0 +1,162 @@
+"""
+Copyright (C) 2019 by
+The Salk Institute for Biological Studies and
+Pittsburgh Supercomputing Center, Carnegie Mellon University
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+Support for ccache and sccache used as compiler launchers by cmake.
+
+Hits and misses are counted per build step, ccache writes a stats log
+for each step, for sccache the difference of its server statistics
+before and after the step is used (not exact when steps run concurrently).
+"""
+
+import os
+import json
+import shutil
+import threading
+
+from utils import *
+from build_settings import *
+
+# step name -> (hits, misses), None values when not known
+step_stats = {}
+step_stats_lock = threading.Lock()
+
+
+def get_launcher(opts):
+    # returns None when no compiler cache is used
+    if not opts.compiler_cache:
+        return None
+    return shutil.which(opts.compiler_cache)
+
+
+def get_cmake_launcher_args(opts):
+    launcher = get_launcher(opts)
+    if not launcher:
+        return []
+    return [
+        '-DCMAKE_C_COMPILER_LAUNCHER=' + launcher,
+        '-DCMAKE_CXX_COMPILER_LAUNCHER=' + launcher
+    ]
+
+
+def setup_compiler_cache(opts):
+    # called once before the build, the environment is inherited by all commands run later
+    if not opts.compiler_cache:
+        return
+
+    if not get_launcher(opts):
+        fatal_error("Compiler cache '" + opts.compiler_cache + "' was not found in PATH.")
+
+    if opts.compiler_cache == COMPILER_CACHE_CCACHE:
+        if opts.compiler_cache_dir:
+            os.environ['CCACHE_DIR'] = opts.compiler_cache_dir
+        if opts.compiler_cache_max_size_gb:
+            os.environ['CCACHE_MAXSIZE'] = str(opts.compiler_cache_max_size_gb) + 'G'
+        # paths under top_dir are made relative so that worktrees share cache entries
+        os.environ['CCACHE_BASEDIR'] = opts.main_top_dir
+    else:
+        if opts.compiler_cache_dir:
+            os.environ['SCCACHE_DIR'] = opts.compiler_cache_dir
+        if opts.compiler_cache_max_size_gb:
+            os.environ['SCCACHE_CACHE_SIZE'] = str(int(opts.compiler_cache_max_size_gb)) + 'G'
+        # the server reads its configuration when started
+        run([opts.compiler_cache, '--start-server'], cwd=os.getcwd(), timeout_is_fatal=False)
+
+    log("Using compiler cache '" + get_launcher(opts) + "'.")
+
+
+def get_stats_log_path(opts, name):
+    return os.path.join(opts.work_dir, COMPILER_CACHE_STATS_DIR, name + '.log')
+
+
+def get_sccache_counts(opts):
+    # returns pair hits, misses
+    out = run_with_ascii_output([opts.compiler_cache, '--show-stats', '--stats-format=json'], cwd=os.getcwd())
+    try:
+        stats = json.loads(out)['stats']
+    except (ValueError, KeyError):
+        return None, None
+    hits = sum(stats.get('cache_hits', {}).get('counts', {}).values())
+    misses = sum(stats.get('cache_misses', {}).get('counts', {}).values())
+    return hits, misses
+
+
+def parse_stats_log(log_file):
+    # each compilation has a line with the source file starting with '#'
+    # and lines with its results such as direct_cache_hit or cache_miss
+    hits = 0
+    misses = 0
+    with open(log_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.endswith('cache_hit'):
+                hits += 1
+            elif line == 'cache_miss':
+                misses += 1
+    return hits, misses
+
+
+def begin_step(opts, name):
+    # returns state passed to end_step
+    if not get_launcher(opts):
+        return None
+
+    if opts.compiler_cache == COMPILER_CACHE_CCACHE:
+        log_file = get_stats_log_path(opts, name)
+        if not os.path.exists(os.path.dirname(log_file)):
+            os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        if os.path.exists(log_file):
+            os.remove(log_file)
+        set_thread_env({ 'CCACHE_STATSLOG': log_file })
+        return log_file
+    else:
+        return get_sccache_counts(opts)
+
+
+def end_step(opts, name, state):
+    if not get_launcher(opts):
+        return
+
+    if opts.compiler_cache == COMPILER_CACHE_CCACHE:
+        set_thread_env(None)
+        if os.path.exists(state):
+            hits, misses = parse_stats_log(state)
+        else:
+            # nothing was compiled or ccache is too old to support stats log
+            hits, misses = 0, 0
+    else:
+        hits, misses = get_sccache_counts(opts)
+        if hits is None or state[0] is None:
+            hits, misses = None, None
+        else:
+            hits -= state[0]
+            misses -= state[1]
+
+    with step_stats_lock:
+        step_stats[name] = (hits, misses)
+
+
+def print_report(opts):
+    if not step_stats:
+        return
+
+    log("Compiler cache statistics (" + opts.compiler_cache + "):")
+    for name, (hits, misses) in sorted(step_stats.items()):
+        if hits is None:
+            log("  " + name + ": not available")
+            continue
+        total = hits + misses
+        if total == 0:
+            # steps that do not compile anything 
+            continue
+        log("  " + name + ": " + str(hits) + " hits, " + str(misses) + " misses (" + 
+            str(int(100 * hits / total)) + "% hits)")
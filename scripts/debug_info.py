@@ -0,0 +1,91 @@
+"""
+Copyright (C) 2019 by
+The Salk Institute for Biological Studies and
+Pittsburgh Supercomputing Center, Carnegie Mellon University
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+Split DWARF for debug builds of mcell (Linux only).
+
+Debug info stays in .dwo files next to the object files and only
+references to them are linked, debug sections are compressed with -gz
+when supported. gdb finds the .dwo files through absolute paths when
+mcell is run from the build directory. Bundles and packages get a .dwp
+package of all .dwo files of each binary, gdb loads <binary>.dwp
+automatically.
+"""
+
+import os
+import shutil
+
+from utils import *
+from build_settings import *
+import linker
+
+
+def use_split_dwarf(opts):
+    return opts.debug and not opts.do_not_split_dwarf and platform.system() == 'Linux'
+
+
+def get_debug_flags(opts):
+    # returns pair compile flags, link flags
+    if not use_split_dwarf(opts):
+        return [], []
+
+    # dwp tools and gdb index of the linkers do not support split DWARF 5 well yet
+    compile_flags = ['-gsplit-dwarf', '-gdwarf-4']
+    link_flags = []
+    if linker.is_supported_by_compiler(['-gz']):
+        compile_flags.append('-gz')
+        link_flags.append('-gz')
+
+    if opts.gdb_index:
+        # GNU ld does not support the index, gold, lld and mold do
+        index_flags = ['-Wl,--gdb-index']
+        if linker.is_supported_by_compiler(linker.get_link_flags(opts) + index_flags):
+            # the index is created from the public names sections
+            compile_flags.append('-ggnu-pubnames')
+            link_flags += index_flags
+        else:
+            warning("Linker '" + opts.resolved_linker + "' does not support --gdb-index, use --linker mold or lld.")
+
+    return compile_flags, link_flags
+
+
+def get_dwp_tool():
+    for tool in DWP_TOOLS:
+        if shutil.which(tool):
+            return tool
+    return None
+
+
+def write_dwp(opts, binary, dwp_file):
+    # packages .dwo files referenced by binary, returns False when not possible
+    tool = get_dwp_tool()
+    if not tool:
+        warning("Neither of " + ', '.join(DWP_TOOLS) + " was found, '" + binary +
+                "' was packaged without its debug info.")
+        return False
+
+    cmd = [tool, '-e', binary, '-o', dwp_file]
+    ec = run(cmd, cwd=os.path.dirname(binary), timeout_sec=BUILD_TIMEOUT)
+    check_ec(ec, cmd)
+    return True
+
+
+def install_debug_info(opts, build_dir, install_dir):
+    # called after the mcell build directory was copied to install_dir
+    if not use_split_dwarf(opts):
+        return
+
+    for binary in DEBUG_INFO_BINARIES:
+        binary_path = os.path.join(build_dir, binary)
+        if not os.path.exists(binary_path):
+            continue
+        log("Packaging debug info of '" + binary_path + "'.")
+        if not write_dwp(opts, binary_path, os.path.join(install_dir, binary + DWP_SUFFIX)):
+            return
@@ -0,0 +1,170 @@
+"""
+Copyright (C) 2019 by
+The Salk Institute for Biological Studies and
+Pittsburgh Supercomputing Center, Carnegie Mellon University
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+Selection of mcell compiler flags by measurement.
+
+Every combination of the flag sets from the tuning matrix is built in its
+own build directory, benchmark models are run with each build and the
+configurations are ranked by the total of median wall times. The winner
+can be stored to the mcell_build_infrastructure_data directory and is then
+used by release builds on the same platform.
+"""
+
+import os
+import json
+import itertools
+
+from utils import *
+from build_settings import *
+import model_runner
+
+
+class TuningResult:
+    def __init__(self, flags):
+        self.flags = flags
+        self.ok = False
+        self.error = ''
+        # sums over all models of medians over repeats
+        self.wall_sec = 0.0
+        self.cpu_sec = 0.0
+        # largest over all runs, None when not available
+        self.max_rss_kb = None
+
+    def get_name(self):
+        return ' '.join(self.flags) if self.flags else '(default)'
+
+
+def get_tuned_flags_file(opts):
+    # one file per OS and architecture
+    return os.path.join(
+        opts.mcell_build_infrastructure_tuned_flags_dir,
+        platform.system() + '-' + platform.machine() + '.json')
+
+
+def load_tuned_flags(opts):
+    # returns list of flags or None when no tuned flags were stored for this platform
+    tuned_flags_file = get_tuned_flags_file(opts)
+    if not os.path.exists(tuned_flags_file):
+        return None
+    with open(tuned_flags_file, 'r') as f:
+        return json.load(f)['flags']
+
+
+def remove_isa_flags(flags):
+    # the generic build must run on every CPU of its architecture
+    return [f for f in flags if not any(f.startswith(prefix) for prefix in ISA_FLAG_PREFIXES)]
+
+
+def load_tuning_matrix(opts):
+    # returns list of flag sets, the first one is the reference configuration,
+    # flags that select an instruction set are removed because release builds do not use them
+    if opts.tuning_matrix_file:
+        with open(opts.tuning_matrix_file, 'r') as f:
+            axes = json.load(f)
+    else:
+        axes = DEFAULT_TUNING_MATRIX
+
+    isa_flags = [flag for flags in itertools.chain(*axes) for flag in flags if flag not in remove_isa_flags([flag])]
+    if isa_flags:
+        warning("Ignoring flags of the tuning matrix that select an instruction set: " + ' '.join(isa_flags) + 
+                ", use --isa-variants instead.")
+
+    configurations = []
+    for combination in itertools.product(*axes):
+        flags = remove_isa_flags([flag for flags in combination for flag in flags])
+        if flags not in configurations:
+            configurations.append(flags)
+    return configurations
+
+
+def measure_configuration(opts, index, flags, build_function, models):
+    res = TuningResult(flags)
+    build_dir = os.path.join(opts.work_dir, TUNING_BUILD_DIR_PREFIX + str(index))
+    log("Tuning configuration " + str(index) + ": " + res.get_name())
+
+    try:
+        build_function(build_dir, flags)
+    except SystemExit:
+        # fatal_error in the build, other configurations are still measured
+        res.error = 'build failed'
+        return res
+
+    max_rss_kb = None
+    for model_index, model in enumerate(models):
+        scratch_dir = os.path.join(opts.work_dir, TUNING_RUNS_DIR, str(index) + '_' + str(model_index))
+        run_res = model_runner.run_model_repeated(opts, model, build_dir, scratch_dir, opts.benchmark_repeats)
+        if not run_res.ok:
+            res.error = "model '" + model + "' failed"
+            return res
+        if run_res.max_rss_kb is not None:
+            max_rss_kb = max(max_rss_kb or 0, run_res.max_rss_kb)
+
+        res.wall_sec += run_res.wall_sec
+        res.cpu_sec += run_res.cpu_sec
+
+    res.max_rss_kb = max_rss_kb
+    res.ok = True
+    return res
+
+
+def write_report(opts, results):
+    # returns path to the report, results are ranked by wall time, failed configurations are last
+    ranked = sorted(results, key=lambda r: (not r.ok, r.wall_sec))
+    reference = results[0] if results[0].ok else None
+
+    lines = ["Rank  Wall [s]  CPU [s]  Peak RSS [MB]  Speedup  Flags"]
+    for rank, res in enumerate(ranked, 1):
+        if not res.ok:
+            lines.append("{:<4}  {:<42}  {}".format('-', 'failed: ' + res.error, res.get_name()))
+            continue
+        rss = "{:.0f}".format(res.max_rss_kb / 1024) if res.max_rss_kb is not None else 'n/a'
+        speedup = "{:.3f}".format(reference.wall_sec / res.wall_sec) if reference and res.wall_sec else 'n/a'
+        lines.append("{:<4}  {:>8.2f}  {:>7.2f}  {:>13}  {:>7}  {}".format(
+            rank, res.wall_sec, res.cpu_sec, rss, speedup, res.get_name()))
+
+    report_file = os.path.join(opts.work_dir, TUNING_REPORT_FILE)
+    with open(report_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    with open(os.path.splitext(report_file)[0] + '.json', 'w') as f:
+        json.dump([vars(r) for r in ranked], f, indent=2)
+
+    for line in lines:
+        log(line)
+    return report_file
+
+
+def tune_flags(opts, build_function):
+    # build_function(build_dir, flags) configures and builds mcell in build_dir
+    models = model_runner.load_model_list(opts.benchmark_models)
+    configurations = load_tuning_matrix(opts)
+    log("Tuning mcell flags, " + str(len(configurations)) + " configurations, " +
+        str(len(models)) + " models, " + str(opts.benchmark_repeats) + " repeats.")
+
+    results = []
+    for index, flags in enumerate(configurations):
+        results.append(measure_configuration(opts, index, flags, build_function, models))
+
+    report_file = write_report(opts, results)
+    log("Tuning report was written to '" + report_file + "'.")
+
+    successful = [r for r in results if r.ok]
+    if not successful:
+        fatal_error("No tuning configuration was built and run successfully.")
+    best = min(successful, key=lambda r: r.wall_sec)
+    log("Best configuration: " + best.get_name())
+
+    if opts.save_tuned_flags:
+        tuned_flags_file = get_tuned_flags_file(opts)
+        if not os.path.exists(os.path.dirname(tuned_flags_file)):
+            os.makedirs(os.path.dirname(tuned_flags_file))
+        with open(tuned_flags_file, 'w') as f:
+            json.dump({ 'flags': best.flags, 'wall_sec': best.wall_sec, 'models': models }, f, indent=2)
+        log("Flags for release builds were stored to '" + tuned_flags_file + "'.")
@@ -0,0 +1,164 @@
+"""
+Copyright (C) 2019 by
+The Salk Institute for Biological Studies and
+Pittsburgh Supercomputing Center, Carnegie Mellon University
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+Folded stacks and SVG flamegraphs without external tools.
+
+Folded stacks are lines 'root;caller;callee count', the same format as
+used by stackcollapse-perf.pl and flamegraph.pl so that the files can be
+processed also with the usual tools.
+"""
+
+import os
+import re
+import html
+import hashlib
+from collections import Counter
+
+SVG_WIDTH = 1200
+FRAME_HEIGHT = 16
+FONT_SIZE = 12
+# frames narrower than this are not drawn
+MIN_FRAME_WIDTH = 0.1
+
+
+def get_frame_name(frame_line):
+    # '    7f12a3b4c5d6 function_name+0x1a (/path/to/lib.so)'
+    parts = frame_line.strip().split(' ', 1)
+    if len(parts) < 2:
+        return parts[0]
+    rest = parts[1]
+    dso = ''
+    if rest.endswith(')') and ' (' in rest:
+        rest, dso = rest.rsplit(' (', 1)
+        dso = dso[:-1]
+    symbol = re.sub(r'\+0x[0-9a-f]+$', '', rest)
+    if symbol == '[unknown]' and dso:
+        return '[' + os.path.basename(dso) + ']'
+    return symbol
+
+
+def fold_perf_script(perf_script_file):
+    # returns Counter folded stack -> number of samples
+    stacks = Counter()
+    comm = None
+    frames = []
+
+    def flush():
+        if comm is not None and frames:
+            # perf prints the leaf first
+            stacks[';'.join([comm] + list(reversed(frames)))] += 1
+
+    with open(perf_script_file, 'r', errors='replace') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip():
+                flush()
+                comm = None
+                frames = []
+            elif line[0].isspace():
+                if comm is not None:
+                    frames.append(get_frame_name(line).replace(';', ':'))
+            else:
+                # sample header 'comm pid/tid time: period event:'
+                flush()
+                comm = line.split()[0]
+                frames = []
+    flush()
+    return stacks
+
+
+def load_folded(folded_file):
+    stacks = Counter()
+    with open(folded_file, 'r', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            stack, _, count = line.rpartition(' ')
+            if stack and count.isdigit():
+                stacks[stack] += int(count)
+    return stacks
+
+
+def write_folded(stacks, folded_file):
+    with open(folded_file, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write(stack + ' ' + str(count) + '\n')
+
+
+def build_tree(stacks):
+    # node is [count, children dict]
+    root = [0, {}]
+    for stack, count in stacks.items():
+        root[0] += count
+        node = root
+        for frame in stack.split(';'):
+            node = node[1].setdefault(frame, [0, {}])
+            node[0] += count
+    return root
+
+
+def get_color(name):
+    # stable warm colors as in the usual flamegraphs
+    h = int(hashlib.md5(name.encode('utf-8')).hexdigest()[:6], 16)
+    r = 205 + h % 50
+    g = (h >> 8) % 180
+    b = (h >> 16) % 55
+    return 'rgb(' + str(r) + ',' + str(g) + ',' + str(b) + ')'
+
+
+def write_svg(stacks, svg_file, title):
+    root = build_tree(stacks)
+    total = root[0]
+    rects = []
+    max_depth = [0]
+
+    def visit(name, node, depth, x):
+        width = SVG_WIDTH * node[0] / total
+        if width < MIN_FRAME_WIDTH:
+            return
+        max_depth[0] = max(max_depth[0], depth)
+        rects.append((name, node[0], depth, x, width))
+        child_x = x
+        for child_name, child in sorted(node[1].items()):
+            visit(child_name, child, depth + 1, child_x)
+            child_x += SVG_WIDTH * child[0] / total
+
+    if total:
+        visit('all', root, 0, 0.0)
+
+    title_height = FRAME_HEIGHT * 2
+    height = title_height + (max_depth[0] + 1) * FRAME_HEIGHT
+    out = [
+        '<?xml version="1.0" standalone="no"?>',
+        '<svg version="1.1" width="' + str(SVG_WIDTH) + '" height="' + str(height) + '" '
+        'xmlns="http://www.w3.org/2000/svg" font-family="Verdana" font-size="' + str(FONT_SIZE) + '">',
+        '<text x="' + str(SVG_WIDTH / 2) + '" y="' + str(FONT_SIZE + 4) + '" text-anchor="middle">' +
+        html.escape(title) + '</text>'
+    ]
+    for name, count, depth, x, width in rects:
+        # root is at the bottom
+        y = height - (depth + 1) * FRAME_HEIGHT
+        label = html.escape(name)
+        tooltip = label + ' (' + str(count) + ' samples, ' + '{:.2f}'.format(100.0 * count / total) + '%)'
+        out.append('<g><title>' + tooltip + '</title>')
+        out.append('<rect x="{:.2f}" y="{}" width="{:.2f}" height="{}" fill="{}" rx="2" ry="2"/>'.format(
+            x, y, width, FRAME_HEIGHT - 1, get_color(name)))
+        # approximate text width to show only labels that fit
+        max_chars = int(width / (FONT_SIZE * 0.6))
+        if max_chars >= 3:
+            text = name if len(name) <= max_chars else name[:max_chars - 2] + '..'
+            out.append('<text x="{:.2f}" y="{}">{}</text>'.format(x + 3, y + FRAME_HEIGHT - 4, html.escape(text)))
+        out.append('</g>')
+    out.append('</svg>')
+
+    with open(svg_file, 'w') as f:
+        f.write('\n'.join(out) + '\n')
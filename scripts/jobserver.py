@@ -0,0 +1,256 @@
+"""
+Copyright (C) 2019 by
+The Salk Institute for Biological Studies and
+Pittsburgh Supercomputing Center, Carnegie Mellon University
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+GNU make compatible jobserver owned by run.py. 
+
+Each token corresponds to one slot of a host-wide pool, slots are lock files 
+so that all run.py processes on the same machine share a single core budget. 
+Slots are acquired only when make used all tokens in the pipe and given back 
+when tokens stay unused, so that concurrent builds share the budget. 
+Slots are released automatically by the OS when a process terminates.
+With --memory-aware, no more slots are acquired than the build steps may run 
+compile jobs according to the available memory.
+"""
+
+import os
+import re
+import fcntl
+import atexit
+import select
+import termios
+import struct
+import tempfile
+import threading
+
+from utils import *
+from build_settings import *
+import memory
+
+
+def get_make_version():
+    # returns tuple (major, minor) or (0, 0) if make was not found 
+    try:
+        out = run_with_ascii_output(['make', '--version'], cwd=os.getcwd())
+    except OSError:
+        return (0, 0)
+    matches = re.match('GNU Make ([0-9]+)\.([0-9]+)', out)
+    if matches:
+        return (int(matches.group(1)), int(matches.group(2)))
+    return (0, 0)
+
+
+class HostSlotPool:
+    def __init__(self, lock_dir, budget):
+        self.lock_dir = lock_dir
+        self.budget = budget
+        self.held = {} # slot index -> open file with lock
+        # index of the first acquired slot, the implicit token
+        self.implicit = None
+        if not os.path.exists(lock_dir):
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def try_acquire(self):
+        # returns True if a new slot was locked 
+        for i in range(self.budget):
+            if i in self.held:
+                continue
+            f = open(os.path.join(self.lock_dir, 'slot_' + str(i) + '.lock'), 'w')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            self.held[i] = f
+            if self.implicit is None:
+                self.implicit = i
+            return True
+        return False
+
+    def release_one(self):
+        # the first slot is the implicit token of the build and is kept
+        if len(self.held) <= 1:
+            return False
+        i = max(i for i in self.held.keys() if i != self.implicit)
+        self.held.pop(i).close()
+        return True
+
+    def release_all(self):
+        for f in self.held.values():
+            f.close()
+        self.held.clear()
+        self.implicit = None
+
+
+class Jobserver:
+    # each make run concurrently by the build scheduler has its own implicit token 
+    # in addition to the tokens in the pipe, a run.py with N concurrent build steps 
+    # can therefore run up to N-1 jobs more than its share of the host core budget
+    def __init__(self, opts):
+        self.budget = opts.host_core_budget
+        self.memory_aware = opts.memory_aware
+        # tokens taken out of the pipe because of memory pressure
+        self.withheld = 0
+        self.slots = HostSlotPool(JOBSERVER_LOCK_DIR, self.budget)
+        self.read_fd = None
+        self.write_fd = None
+        self.fifo_path = None
+        self.stop_event = threading.Event()
+        self.feeder = None
+        # number of consecutive checks with more than JOBSERVER_SPARE_TOKENS unused tokens
+        self.idle_polls = 0
+
+    def start(self):
+        # block until at least one slot is available, this slot is the implicit token 
+        # that each make process has
+        log("Jobserver: waiting for a free slot of the host core budget " + str(self.budget) + 
+            " in '" + JOBSERVER_LOCK_DIR + "'.")
+        while not self.slots.try_acquire():
+            time.sleep(JOBSERVER_POLL_SEC)
+        
+        make_version = get_make_version()
+        if make_version >= (4, 4):
+            # named pipe is also understood by ninja 1.13+ 
+            self.fifo_path = os.path.join(tempfile.mkdtemp(prefix='mcell_jobserver_'), 'fifo')
+            os.mkfifo(self.fifo_path)
+            self.read_fd = os.open(self.fifo_path, os.O_RDWR)
+            self.write_fd = self.read_fd
+            auth = '--jobserver-auth=fifo:' + self.fifo_path
+            fds = ()
+        else:
+            self.read_fd, self.write_fd = os.pipe()
+            fd_pair = str(self.read_fd) + ',' + str(self.write_fd)
+            if make_version >= (4, 2):
+                auth = '--jobserver-auth=' + fd_pair
+            else:
+                auth = '--jobserver-fds=' + fd_pair
+            fds = (self.read_fd, self.write_fd)
+        
+        self.add_token()
+        makeflags = '-j' + str(self.budget) + ' ' + auth
+        set_jobserver({ 'MAKEFLAGS': makeflags }, fds)
+        
+        self.feeder = threading.Thread(target=self.feed, daemon=True)
+        self.feeder.start()
+        log("Jobserver started with " + str(len(self.slots.held)) + " slots, MAKEFLAGS: " + makeflags)
+        
+    def get_tokens_in_pipe(self):
+        # tokens that no make process is using
+        buf = fcntl.ioctl(self.read_fd, termios.FIONREAD, struct.pack('i', 0))
+        return struct.unpack('i', buf)[0]
+
+    def take_token(self):
+        # returns True if a token was read from the pipe, does not block
+        readable, _, _ = select.select([self.read_fd], [], [], 0)
+        if readable:
+            os.read(self.read_fd, 1)
+            return True
+        return False
+
+    def add_token(self):
+        # a newly acquired slot is one token in the pipe
+        if not self.slots.try_acquire():
+            return False
+        os.write(self.write_fd, b'+')
+        return True
+
+    def release_idle_token(self):
+        # the token goes back to the host pool as a free slot
+        if len(self.slots.held) <= 1 or not self.take_token():
+            return False
+        self.slots.release_one()
+        return True
+
+    def is_limited_by_memory(self):
+        # make gets no -j with a jobserver, the job limits of the running build steps 
+        # derived from memory are applied to the number of held slots
+        if not self.memory_aware:
+            return False
+        limit = memory.get_reserved_jobs()
+        return limit is not None and len(self.slots.held) >= limit
+
+    def balance_tokens(self):
+        tokens = self.get_tokens_in_pipe()
+        if tokens == 0:
+            self.idle_polls = 0
+            if not self.is_limited_by_memory() and self.add_token():
+                log("Jobserver: all tokens are used, acquired a slot, now holding " + str(len(self.slots.held)) + ".")
+        elif tokens > JOBSERVER_SPARE_TOKENS:
+            self.idle_polls += 1
+            if self.idle_polls >= JOBSERVER_IDLE_POLLS and self.release_idle_token():
+                self.idle_polls = 0
+                log("Jobserver: released an unused slot, now holding " + str(len(self.slots.held)) + ".")
+        else:
+            self.idle_polls = 0
+    
+    def withhold_token(self):
+        # take one free token from the pipe so that make cannot start a new job,
+        # tokens currently used by running jobs are not affected
+        if self.take_token():
+            self.withheld += 1
+            log("Memory: pressure is high (available " + str(memory.get_available_memory_mb()) + 
+                " MB), jobserver holds back " + str(self.withheld) + " tokens.")
+            
+    def return_withheld_tokens(self):
+        log("Memory: pressure is low, jobserver returns " + str(self.withheld) + " tokens.")
+        os.write(self.write_fd, b'+' * self.withheld)
+        self.withheld = 0
+    
+    def feed(self):
+        # slots are acquired on demand and given back when unused, 
+        # memory is checked once per JOBSERVER_POLL_SEC
+        polls_per_memory_check = max(1, int(JOBSERVER_POLL_SEC / JOBSERVER_FEED_SEC))
+        poll = 0
+        while not self.stop_event.wait(JOBSERVER_FEED_SEC):
+            poll += 1
+            if self.memory_aware and poll % polls_per_memory_check == 0:
+                if memory.is_memory_pressure_high():
+                    self.withhold_token()
+                elif self.withheld:
+                    self.return_withheld_tokens()
+            
+            if self.withheld:
+                # new slots would only replace the withheld tokens
+                continue
+            self.balance_tokens()
+
+    def stop(self):
+        # called also at exit after fatal_error, does nothing when already stopped
+        if self.read_fd is None:
+            return
+        self.stop_event.set()
+        if self.feeder:
+            self.feeder.join()
+        set_jobserver({}, ())
+        
+        os.close(self.read_fd)
+        if self.write_fd != self.read_fd:
+            os.close(self.write_fd)
+        self.read_fd = None
+        self.write_fd = None
+        if self.fifo_path:
+            os.remove(self.fifo_path)
+            os.rmdir(os.path.dirname(self.fifo_path))
+        
+        self.slots.release_all()
+        log("Jobserver stopped.")
+
+
+def start_jobserver(opts):
+    # returns None when jobserver cannot be used on this platform
+    if os.name == 'nt':
+        warning("Jobserver is not supported on Windows, using -j with " + str(get_nr_cores()) + " cores.")
+        return None
+    
+    js = Jobserver(opts)
+    js.start()
+    # the fifo and its directory are removed also when the build fails
+    atexit.register(js.stop)
+    return js
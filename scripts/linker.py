@@ -0,0 +1,152 @@
+"""
+Copyright (C) 2019 by
+The Salk Institute for Biological Studies and
+Pittsburgh Supercomputing Center, Carnegie Mellon University
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+Selection of a fast linker (mold or lld) for the mcell, VTK and gamer builds.
+
+The linker is passed to the compiler driver as -fuse-ld, it is used only
+when the compiler accepts it for a trivial program. Each link is run
+through compile_timer.py set as the cmake linker launcher (cmake 3.21+)
+so that link times can be reported separately from compile times.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+from collections import defaultdict
+
+from utils import *
+from build_settings import *
+import pgo
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def get_linker_executable(linker):
+    return shutil.which(LINKER_EXECUTABLES[linker])
+
+
+def is_supported_by_compiler(flags):
+    # compiles and links a trivial program with flags
+    compiler = os.environ.get('CC', 'cc')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open(os.path.join(tmp_dir, 'main.c'), 'w') as f:
+            f.write('int main(void) { return 0; }\n')
+        cmd = [compiler] + flags + ['main.c', '-o', 'main']
+        try:
+            ec = run(cmd, cwd=tmp_dir, fout_name=os.path.join(tmp_dir, 'log.txt'), timeout_is_fatal=False)
+        except OSError:
+            return False
+    return ec == 0
+
+
+def is_linker_usable(linker):
+    # the compiler must know -fuse-ld=linker and find the linker
+    if not get_linker_executable(linker):
+        return False
+    return is_supported_by_compiler(['-fuse-ld=' + linker])
+
+
+def setup_linker(opts):
+    # called once before the build, sets opts.resolved_linker
+    opts.resolved_linker = LINKER_DEFAULT
+    if os.name == 'nt' or opts.linker == LINKER_DEFAULT:
+        return
+
+    if opts.linker == LINKER_AUTO:
+        # mold for MacOS is a different product, only lld is tried there
+        candidates = [LINKER_MOLD, LINKER_LLD] if platform.system() == 'Linux' else [LINKER_LLD]
+        for linker in candidates:
+            if is_linker_usable(linker):
+                opts.resolved_linker = linker
+                break
+    else:
+        if not is_linker_usable(opts.linker):
+            fatal_error("Linker '" + opts.linker + "' was not found or is not supported by the compiler.")
+        opts.resolved_linker = opts.linker
+
+    log("Using linker '" + opts.resolved_linker + "'.")
+
+
+def get_link_flags(opts, use_lto=False):
+    if opts.resolved_linker == LINKER_DEFAULT:
+        return []
+    if use_lto and opts.resolved_linker == LINKER_LLD and not pgo.is_clang():
+        # lld cannot load the LTO plugin of gcc
+        log("Using the default linker for LTO build with gcc.")
+        return []
+    return ['-fuse-ld=' + opts.resolved_linker]
+
+
+def get_linker_description(opts):
+    # used in the release info file
+    if opts.resolved_linker == LINKER_DEFAULT:
+        cmd = ['ld', '--version']
+    else:
+        cmd = [get_linker_executable(opts.resolved_linker), '--version']
+    try:
+        out = run_with_ascii_output(cmd, cwd='.')
+    except (OSError, UnicodeDecodeError):
+        out = ''
+    return opts.resolved_linker + (' (' + out.splitlines()[0] + ')' if out else '')
+
+
+def get_log_file(opts, name):
+    return os.path.join(opts.work_dir, LINK_TIMES_DIR, name + '.jsonl')
+
+
+def get_cmake_linker_launcher_args(opts, name):
+    # every link of the build logged as name is timed
+    launcher = [sys.executable, os.path.join(THIS_DIR, COMPILE_TIMER_SCRIPT), '--log', get_log_file(opts, name)]
+    return [
+        '-DCMAKE_C_LINKER_LAUNCHER=' + ';'.join(launcher),
+        '-DCMAKE_CXX_LINKER_LAUNCHER=' + ';'.join(launcher)
+    ]
+
+
+def begin_build(opts, name):
+    # called before a build, removes link times of the previous one
+    log_file = get_log_file(opts, name)
+    if not os.path.exists(os.path.dirname(log_file)):
+        os.makedirs(os.path.dirname(log_file))
+    if os.path.exists(log_file):
+        os.remove(log_file)
+
+
+def print_report(opts):
+    # link times of the builds that were run, written also to work_dir
+    times_dir = os.path.join(opts.work_dir, LINK_TIMES_DIR)
+    if not os.path.exists(times_dir):
+        return
+
+    records = defaultdict(list)
+    for name in sorted(os.listdir(times_dir)):
+        if not name.endswith('.jsonl'):
+            continue
+        with open(os.path.join(times_dir, name), 'r') as f:
+            for line in f:
+                if line.strip():
+                    records[os.path.splitext(name)[0]].append(json.loads(line))
+    if not records:
+        return
+
+    lines = ["Link times with linker '" + opts.resolved_linker + "':"]
+    for build, build_records in sorted(records.items()):
+        total_sec = sum(r['wall_sec'] for r in build_records)
+        slowest = max(build_records, key=lambda r: r['wall_sec'])
+        lines.append("  {}: {} links, {:.2f} s total, slowest {:.2f} s {}".format(
+            build, len(build_records), total_sec, slowest['wall_sec'], os.path.basename(slowest['output'] or '')))
+
+    with open(os.path.join(opts.work_dir, LINK_TIME_REPORT_FILE), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    for line in lines:
+        log(line)
@@ -0,0 +1,166 @@
+"""
+Copyright (C) 2019 by
+The Salk Institute for Biological Studies and
+Pittsburgh Supercomputing Center, Carnegie Mellon University
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+Functions that limit build parallelism according to available memory.
+
+Memory needed by a single compile job is taken from the previous builds 
+(largest process run by a build step) or from defaults in build_settings.
+Each running build step reserves memory for its jobs so that steps started 
+concurrently do not all count with the same available memory.
+"""
+
+import os
+import json
+import threading
+
+from utils import *
+from build_settings import *
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# build step name -> MB reserved for its compile jobs while it runs
+reserved_mb = {}
+# build step name -> number of compile jobs the step may run, 
+# caps the jobserver tokens because make gets no -j with a jobserver
+reserved_jobs = {}
+reserved_mb_lock = threading.Lock()
+
+
+def get_available_memory_mb():
+    # returns None when the information is not available
+    if psutil:
+        return int(psutil.virtual_memory().available / (1024 * 1024))
+
+    if os.path.exists('/proc/meminfo'):
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(int(line.split()[1]) / 1024)
+
+    if platform.system() == 'Darwin':
+        # free + inactive pages can be reused without swapping
+        out = run_with_ascii_output(['vm_stat'], cwd=os.getcwd())
+        page_size = 4096
+        pages = 0
+        for line in out.splitlines():
+            if 'page size of' in line:
+                page_size = int(line.split('page size of')[1].split()[0])
+            elif line.startswith('Pages free:') or line.startswith('Pages inactive:'):
+                pages += int(line.split(':')[1].strip().rstrip('.'))
+        return int(pages * page_size / (1024 * 1024))
+
+    return None
+
+
+def is_memory_pressure_high():
+    available = get_available_memory_mb()
+    return available is not None and available < MEMORY_PRESSURE_AVAILABLE_MB
+
+
+def get_observed_memory_file(opts):
+    return os.path.join(opts.work_dir, COMPILE_JOB_MEMORY_FILE)
+
+
+def load_observed_memory(opts):
+    # dictionary build step name -> memory in MB needed by a single compile job 
+    observed_file = get_observed_memory_file(opts)
+    if os.path.exists(observed_file):
+        with open(observed_file, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def get_compile_job_memory_mb(opts, step_name):
+    observed = load_observed_memory(opts)
+    if step_name in observed:
+        return observed[step_name]
+    return DEFAULT_COMPILE_JOB_MEMORY_MB.get(step_name, DEFAULT_COMPILE_JOB_MEMORY_MB[None])
+
+
+def record_compile_job_memory(opts, step_name, max_rss_kb):
+    if max_rss_kb == 0:
+        # not supported on this system
+        return
+
+    max_rss_mb = int(max_rss_kb / 1024)
+    log("Memory: largest process of build step '" + step_name + "' used " + str(max_rss_mb) + " MB.")
+    if max_rss_mb < DEFAULT_COMPILE_JOB_MEMORY_MB.get(step_name, DEFAULT_COMPILE_JOB_MEMORY_MB[None]) / 4:
+        # probably nothing was compiled, e.g. the build was up-to-date
+        return
+
+    observed = load_observed_memory(opts)
+    observed[step_name] = max_rss_mb
+
+    if not os.path.exists(opts.work_dir):
+        os.makedirs(opts.work_dir)
+    with open(get_observed_memory_file(opts), 'w') as f:
+        json.dump(observed, f, indent=2, sort_keys=True)
+
+
+def limit_cores_by_memory(opts, step_name, nr_cores):
+    # the memory for the returned number of jobs stays reserved until release_memory is called
+    available = get_available_memory_mb()
+    if available is None:
+        warning("Memory: could not determine available memory, using " + str(nr_cores) + " cores for '" + step_name + "'.")
+        return nr_cores
+
+    per_job = get_compile_job_memory_mb(opts, step_name)
+    with reserved_mb_lock:
+        # memory reserved by the other running steps may not be in use yet 
+        reserved = sum(mb for name, mb in reserved_mb.items() if name != step_name)
+        usable = available - MEMORY_RESERVE_MB - reserved
+        limit = max(1, int(usable / per_job))
+        cores = min(limit, nr_cores)
+        reserved_mb[step_name] = cores * per_job
+        reserved_jobs[step_name] = cores
+
+    if limit < nr_cores:
+        log("Memory: limiting build step '" + step_name + "' from " + str(nr_cores) + " to " + str(limit) +
+            " jobs, available " + str(available) + " MB, reserved by other steps " + str(reserved) + " MB, " + 
+            str(per_job) + " MB per compile job.")
+    else:
+        log("Memory: build step '" + step_name + "' can use " + str(nr_cores) + " jobs, available " + 
+            str(available) + " MB, reserved by other steps " + str(reserved) + " MB, " + 
+            str(per_job) + " MB per compile job.")
+    return cores
+
+
+def release_memory(step_name):
+    # called when a build step finished
+    with reserved_mb_lock:
+        reserved_mb.pop(step_name, None)
+        reserved_jobs.pop(step_name, None)
+
+
+def get_reserved_jobs():
+    # returns the number of compile jobs the running steps may use together, 
+    # None when no step was limited
+    with reserved_mb_lock:
+        if not reserved_jobs:
+            return None
+        return sum(reserved_jobs.values())
+
+
+def wait_while_memory_pressure_is_high(step_name, can_wait):
+    # can_wait is a function that returns False once waiting would not help 
+    # (e.g. nothing else is running), waits at most MEMORY_PRESSURE_MAX_WAIT_SEC 
+    waited = 0
+    while is_memory_pressure_high() and can_wait() and waited < MEMORY_PRESSURE_MAX_WAIT_SEC:
+        if waited == 0:
+            log("Memory: pressure is high (available " + str(get_available_memory_mb()) + " MB), " +
+                "holding back build step '" + step_name + "'.")
+        time.sleep(MEMORY_PRESSURE_POLL_SEC)
+        waited += MEMORY_PRESSURE_POLL_SEC
+    if waited:
+        log("Memory: starting build step '" + step_name + "' after waiting " + str(waited) + " s.")
@@ -0,0 +1,132 @@
+"""
+Copyright (C) 2019 by
+The Salk Institute for Biological Studies and
+Pittsburgh Supercomputing Center, Carnegie Mellon University
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+Runs MCell models from mcell_tests with a given mcell build or installation
+and measures their wall time, CPU time and peak memory.
+
+Models are listed in a text file, one path relative to the mcell_tests
+repository per line, empty lines and lines starting with '#' are ignored.
+MCell4 models are .py files run with MCELL_PATH pointing to the mcell
+directory, MCell3 models are .mdl files run with the mcell executable.
+"""
+
+import os
+import time
+import shutil
+import statistics
+
+from utils import *
+from build_settings import *
+
+
+class ModelRunResult:
+    def __init__(self, model):
+        self.model = model
+        self.ok = False
+        self.wall_sec = 0.0
+        self.cpu_sec = 0.0
+        # None when the system does not provide resource usage of child processes
+        self.max_rss_kb = None
+        self.log_file = ''
+
+
+def load_model_list(file_name):
+    if not os.path.exists(file_name):
+        fatal_error("Model list '" + file_name + "' does not exist.")
+
+    models = []
+    with open(file_name, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                models.append(line)
+    return models
+
+
+def get_model_path(opts, model):
+    if os.path.isabs(model):
+        return model
+    return os.path.join(opts.top_dir, REPO_NAME_MCELL_TESTS, model)
+
+
+def get_model_cmd(model_path, mcell_dir, wrapper):
+    if model_path.endswith('.py'):
+        cmd = [PYTHON_SYSTEM_EXECUTABLE, os.path.basename(model_path)]
+    elif model_path.endswith('.mdl'):
+        cmd = [os.path.join(mcell_dir, 'mcell' + EXE_EXT), os.path.basename(model_path)]
+    else:
+        fatal_error("Unknown model type of '" + model_path + "', expected .py or .mdl file.")
+    return wrapper + cmd
+
+
+def run_model(opts, model, mcell_dir, scratch_dir, wrapper=None, extra_env=None, timeout_sec=MODEL_RUN_TIMEOUT_SEC):
+    # the model directory is copied to scratch_dir because models write their outputs
+    # next to them, wrapper is a command prefix such as a profiler
+    res = ModelRunResult(model)
+    model_path = get_model_path(opts, model)
+    if not os.path.exists(model_path):
+        fatal_error("Model '" + model_path + "' does not exist.")
+
+    if os.path.exists(scratch_dir):
+        shutil.rmtree(scratch_dir)
+    shutil.copytree(os.path.dirname(model_path), scratch_dir, symlinks=True)
+
+    env = { 'MCELL_PATH': mcell_dir }
+    if extra_env:
+        env.update(extra_env)
+
+    res.log_file = os.path.join(scratch_dir, MODEL_RUN_LOG_FILE)
+    cmd = get_model_cmd(model_path, mcell_dir, wrapper if wrapper is not None else [])
+
+    start = time.time()
+    ec = run(cmd, cwd=scratch_dir, fout_name=res.log_file, timeout_sec=timeout_sec,
+             timeout_is_fatal=False, extra_env=env)
+    res.wall_sec = time.time() - start
+    res.ok = ec == 0
+
+    rusage = get_last_rusage()
+    if rusage:
+        res.cpu_sec = rusage.ru_utime + rusage.ru_stime
+        res.max_rss_kb = rusage_max_rss_kb(rusage)
+
+    if not res.ok:
+        warning("Model '" + model + "' failed with exit code " + str(ec) + ", see '" + res.log_file + "'.")
+    return res
+
+
+def run_model_repeated(opts, model, mcell_dir, scratch_dir, repeats):
+    # returns ModelRunResult with medians of wall and CPU times and the largest peak RSS,
+    # stops at the first failed run and returns its result
+    runs = []
+    for i in range(repeats):
+        run_res = run_model(opts, model, mcell_dir, scratch_dir)
+        if not run_res.ok:
+            return run_res
+        runs.append(run_res)
+
+    res = ModelRunResult(model)
+    res.ok = True
+    res.wall_sec = statistics.median([r.wall_sec for r in runs])
+    res.cpu_sec = statistics.median([r.cpu_sec for r in runs])
+    max_rss = [r.max_rss_kb for r in runs if r.max_rss_kb is not None]
+    res.max_rss_kb = max(max_rss) if max_rss else None
+    res.log_file = runs[-1].log_file
+    return res
+
+
+def run_models(opts, models, mcell_dir, scratch_base_dir, wrapper=None, extra_env=None):
+    # returns list of ModelRunResult, models are run one by one to get stable measurements
+    results = []
+    for i, model in enumerate(models):
+        scratch_dir = os.path.join(scratch_base_dir, str(i) + '_' + os.path.splitext(os.path.basename(model))[0])
+        log("Running model '" + model + "'.")
+        results.append(run_model(opts, model, mcell_dir, scratch_dir, wrapper, extra_env))
+    return results
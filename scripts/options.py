@@ -13,6 +13,7 @@ import platform
 import socket
 import datetime
 import argparse
+import multiprocessing
 
 from build_settings import *
 
@@ -23,6 +24,9 @@ class Options:
         self.clean = False
         self.ignore_dirty = False
         self.debug = False
+        # debug builds use split DWARF on Linux unless disabled
+        self.do_not_split_dwarf = False
+        self.gdb_index = False
         self.ssh = False
         self.use_private_repos = False
         self.mcell_python = None
@@ -37,9 +41,82 @@ class Options:
         self.do_build = False
         self.do_bundle = False
         self.do_test = False
+        self.do_benchmark = False
 
         self.branch = DEFAULT_BRANCH
 
+        self.repo_jobs = DEFAULT_REPO_JOBS
+
+        # directory with bare mirrors of all repositories, 
+        # clones and fetches are served from it when set
+        self.mirror_dir = None
+        # use only the mirror, never access network
+        self.offline = False
+        # use shallow/partial clones defined in repositories.CLONE_PROFILES
+        self.use_clone_profiles = False
+        # limit working trees to directories from repositories.SPARSE_CHECKOUT_PROFILES
+        self.sparse_checkout = False
+        self.sparse_checkout_profiles_file = None
+        # run repositories.maintain_repository for repositories that were not maintained recently
+        self.git_maintenance = False
+        # manifest with commits that are checked out instead of branches
+        self.pinned_manifest_file = None
+        # do not reuse bundle of a previous build even if nothing changed
+        self.force_rebuild = False
+        # names of build and bundle steps that are run even when their stamp matches, 'all' for all steps
+        self.force_steps = []
+        # run build steps one after another instead of using the dependency-based scheduler
+        self.serial_build = False
+        # share cores with other run.py processes on the same host through a jobserver
+        self.jobserver = False
+        self.host_core_budget = multiprocessing.cpu_count()
+        # limit build parallelism by available memory and hold back jobs under memory pressure
+        self.memory_aware = False
+        # cache of build outputs such as the VTK build directory, disabled when None
+        self.artifact_cache_dir = None
+        self.artifact_cache_max_size_gb = ARTIFACT_CACHE_MAX_SIZE_GB
+        # http(s) url or directory shared with other build nodes
+        self.artifact_cache_remote = None
+
+        self.use_lto = BUILD_OPTS_USE_LTO
+        # profile-guided optimization of mcell, training models are listed in a file
+        self.pgo = False
+        self.pgo_training_models = None
+
+        # models used to measure mcell performance, one path relative to mcell_tests per line
+        self.benchmark_models = None
+        self.benchmark_repeats = BENCHMARK_REPEATS
+        # flag tuning mode, builds and measures mcell with all flag combinations from the matrix
+        self.tune_flags = False
+        self.tuning_matrix_file = None
+        self.save_tuned_flags = False
+        # performance regression suite (-5)
+        self.benchmark_threshold_percent = BENCHMARK_THRESHOLD_PERCENT
+        self.benchmark_on_regression = BENCHMARK_ON_REGRESSION_FAIL
+        self.update_benchmark_baseline = False
+
+        # profiling build of mcell, benchmark models are run with it under a profiler
+        self.profiling = False
+
+        # additional mcell builds for newer x86-64 levels, e.g. x86-64-v3
+        self.isa_variants = []
+
+        # cmake generator used on Linux and MacOS
+        self.generator = GENERATOR_AUTO
+
+        # ccache or sccache used as compiler launcher, disabled when None, 
+        # dir and size default to the settings of the tool
+        self.compiler_cache = None
+        self.compiler_cache_dir = None
+        self.compiler_cache_max_size_gb = None
+
+        # requested linker, resolved_linker is set by linker.setup_linker
+        self.linker = LINKER_AUTO
+        self.resolved_linker = LINKER_DEFAULT
+
+        # logs compile time and memory of each translation unit of mcell and VTK
+        self.compile_time_report = False
+
         self.release_version = INTERNAL_RELEASE_NO_VERSION
         self.store_build = False
 
@@ -61,6 +138,12 @@ class Options:
         self.top_dir = os.path.dirname(get_cwd_no_link())
         self.work_dir = os.path.join(self.top_dir, REPO_NAME_MCELL_TOOLS, WORK_DIR_NAME)
 
+        # in worktree mode, top_dir and work_dir point to the worktree set of the selected branch
+        # and these directories keep the main checkouts and data shared by all branches
+        self.worktree = False
+        self.main_top_dir = self.top_dir
+        self.main_work_dir = self.work_dir
+
         # might be overridden in case when the buid system builds its own cmake
         self.cmake_executable = CMAKE_SYSTEM_EXECUTABLE
 
@@ -68,6 +151,8 @@ class Options:
         self.prebuilt_blender_w_python_base = ''
         self.mcell_build_infrastructure_releases_dir = ''
         self.mcell_build_infrastructure_builds_dir = ''
+        self.mcell_build_infrastructure_tuned_flags_dir = ''
+        self.mcell_build_infrastructure_benchmarks_dir = ''
         self.set_mcell_infrastructure_dirs()
 
 
@@ -96,6 +181,17 @@ class Options:
             os.path.join(self.mcell_build_infrastructure_dir, 'releases')
         self.mcell_build_infrastructure_builds_dir = \
             os.path.join(self.mcell_build_infrastructure_dir, 'builds')
+        self.mcell_build_infrastructure_tuned_flags_dir = \
+            os.path.join(self.mcell_build_infrastructure_dir, 'tuned_flags')
+        self.mcell_build_infrastructure_benchmarks_dir = \
+            os.path.join(self.mcell_build_infrastructure_dir, 'benchmark_baselines')
+
+
+    def set_worktree_dirs(self):
+        # each branch has its own set of worktrees with its own work directory, 
+        # the work directory must stay in mcell_tools because some build scripts use relative paths 
+        self.top_dir = os.path.join(self.main_top_dir, WORKTREES_DIR_NAME, self.branch.replace('/', '_'))
+        self.work_dir = os.path.join(self.top_dir, REPO_NAME_MCELL_TOOLS, WORK_DIR_NAME)
 
 
     def __repr__(self):
@@ -133,6 +229,8 @@ class Options:
         parser.add_argument('-c', '--clean', action='store_true', help='clean data from previous build')
         parser.add_argument('-i', '--ignore-dirty', action='store_true', help='ignore dirty repositories (not supported yet)')
         parser.add_argument('-d', '--debug', action='store_true', help='build debug variant of mcell')
+        parser.add_argument('--do-not-split-dwarf', action='store_true', help='keep debug info in object files and binaries of the debug build instead of separate .dwo files (Linux)')
+        parser.add_argument('--gdb-index', action='store_true', help='add an index for faster loading in gdb to the debug build, requires --linker mold or lld')
         parser.add_argument('-s', '--ssh', action='store_true', help='use ssh to clone repositories')
         parser.add_argument('-z', '--use-private-repos', action='store_true', help='use mcell private repositories')
         parser.add_argument('-g', '--do-not-build-gamer', action='store_true', help='do not build gamer')
@@ -148,10 +246,61 @@ class Options:
 
         parser.add_argument('-b', '--branch', type=str, help='branch to checkout, tries to change the current branch if the branch is different from what is selected and there are no changes')
 
+        parser.add_argument('--repo-jobs', type=int, help='number of repositories processed in parallel in the "1" step, default is ' + str(DEFAULT_REPO_JOBS))
+
+        parser.add_argument('--mirror-dir', type=str, help='directory with bare mirrors of all repositories, it is updated once per run and then used for clones and fetches')
+        parser.add_argument('--offline', action='store_true', help='do not access network, clone and fetch only from the mirror set with --mirror-dir')
+
+        parser.add_argument('--use-clone-profiles', action='store_true', help='use shallow, partial or single branch clones for large repositories such as VTK, meant for CI builds')
+
+        parser.add_argument('--sparse-checkout', action='store_true', help='check out only directories needed for the build in repositories that have a sparse-checkout profile')
+        parser.add_argument('--sparse-checkout-profiles', type=str, help='json file with additional sparse-checkout profiles in the form {"repo_name": ["dir1", "dir2"]}, implies --sparse-checkout')
+
+        parser.add_argument('--git-maintenance', action='store_true', help='repack and write commit-graph and multi-pack-index for repositories that were not maintained in the last days, enables untracked cache and fsmonitor where available')
+
+        parser.add_argument('--worktree', action='store_true', help='use a separate set of git worktrees and a separate work directory for each branch so that switching branches does not invalidate builds')
+
+        parser.add_argument('--manifest', type=str, help='check out exact commits listed in a manifest file written by a previous run (work/' + MANIFEST_FILE + ')')
+        parser.add_argument('--force-rebuild', action='store_true', help='run build and bundle even when the repositories and options did not change since the last successful build')
+
+        parser.add_argument('--force-step', type=str, action='append', help='run the given build or bundle step (e.g. mcell, cellblender, bundle_mcell) even when its inputs did not change, \'all\' forces all steps, can be used multiple times')
+        parser.add_argument('--serial-build', action='store_true', help='run build steps one after another, by default independent steps run concurrently and share the available cores')
+
+        parser.add_argument('--jobserver', action='store_true', help='run make through a jobserver whose tokens are shared by all run.py processes on this host')
+        parser.add_argument('--host-core-budget', type=int, help='number of cores shared by all run.py processes using --jobserver on this host, default is the number of cpus')
+
+        parser.add_argument('--memory-aware', action='store_true', help='limit build parallelism by available memory using observed memory per compile job, hold back new jobs when memory pressure is high (live throttling of make jobs requires --jobserver)')
+
+        parser.add_argument('--artifact-cache-dir', type=str, help='directory with cached build outputs (VTK build), the cache is keyed by sources commit, cmake arguments, compiler and platform')
+        parser.add_argument('--artifact-cache-max-size', type=float, help='size limit of the artifact cache in GB, least recently used entries are evicted, default is ' + str(ARTIFACT_CACHE_MAX_SIZE_GB))
+
+        parser.add_argument('--artifact-cache-remote', type=str, help='remote tier of the artifact cache shared by build nodes, http(s) url of a server supporting GET and PUT or a directory, requires --artifact-cache-dir')
+
+        parser.add_argument('--linker', type=str, choices=[LINKER_AUTO, LINKER_MOLD, LINKER_LLD, LINKER_DEFAULT], help='linker for mcell, VTK and gamer, auto uses mold or lld when the compiler supports it, default is ' + LINKER_AUTO)
+        parser.add_argument('--compile-time-report', action='store_true', help='clean and rebuild mcell and VTK without compiler cache while measuring time and memory of each compilation (and header parse times with clang), a ranked report is written to the work directory')
+        parser.add_argument('--lto', action='store_true', help='build mcell with link-time optimization')
+        parser.add_argument('--pgo', action='store_true', help='build mcell with profile-guided optimization: instrumented build, training runs, optimized build, profiles are reused until mcell sources change')
+        parser.add_argument('--pgo-training-models', type=str, help='file with PGO training models, one path relative to mcell_tests per line (.py or .mdl), required with --pgo')
+        parser.add_argument('--benchmark-models', type=str, help='file with benchmark models, one path relative to mcell_tests per line (.py or .mdl)')
+        parser.add_argument('--benchmark-repeats', type=int, help='number of runs of each benchmark model, median is used, default is ' + str(BENCHMARK_REPEATS))
+        parser.add_argument('--tune-flags', action='store_true', help='build mcell with each combination of flags from the tuning matrix, run the benchmark models and write a ranked report to the work directory, requires --benchmark-models')
+        parser.add_argument('--tuning-matrix', type=str, help='json file with a list of axes, each axis is a list of alternative flag lists, e.g. [[["-O2"], ["-O3"]], [[], ["-flto"]]]')
+        parser.add_argument('--save-tuned-flags', action='store_true', help='store the best flags from --tune-flags to the mcell_build_infrastructure_data directory, release builds on this platform then use them')
+        parser.add_argument('--benchmark-threshold', type=float, help='increase of wall time, CPU time or peak RSS in percent that -5 reports as a regression, default is ' + str(BENCHMARK_THRESHOLD_PERCENT))
+        parser.add_argument('--benchmark-on-regression', type=str, choices=[BENCHMARK_ON_REGRESSION_FAIL, BENCHMARK_ON_REGRESSION_WARN], help='whether -5 fails or only warns when a regression is found, default is ' + BENCHMARK_ON_REGRESSION_FAIL)
+        parser.add_argument('--update-benchmark-baseline', action='store_true', help='store results of -5 as the new baseline for this machine instead of failing on regressions')
+        parser.add_argument('--profiling', action='store_true', help='build also mcell with frame pointers and symbols, run the benchmark models with it under perf (or py-spy) and store folded stacks and flamegraphs to the work directory and with the stored build, requires --benchmark-models')
+        parser.add_argument('--isa-variants', type=str, help='comma-separated list of additional mcell builds for x86-64 levels (' + ', '.join(ISA_VARIANTS) + '), all are installed to the bundle and the best one for the CPU is selected at runtime by ' + MCELL_ISA_DISPATCH_SCRIPT)
+        parser.add_argument('--generator', type=str, choices=[GENERATOR_AUTO, GENERATOR_NINJA, GENERATOR_MAKE], help='cmake generator for mcell, VTK and gamer builds on Linux and MacOS, auto (default) uses ninja when it is installed, build directories configured with another generator are rebuilt from scratch')
+        parser.add_argument('--compiler-cache', type=str, choices=[COMPILER_CACHE_CCACHE, COMPILER_CACHE_SCCACHE], help='use ccache or sccache as compiler launcher for all cmake builds, hit/miss statistics per build step are printed at the end')
+        parser.add_argument('--compiler-cache-dir', type=str, help='directory of the compiler cache, should be outside of the work directory to survive --clean')
+        parser.add_argument('--compiler-cache-max-size', type=float, help='size limit of the compiler cache in GB')
+
         parser.add_argument('-1', '--do-repos', action='store_true', help='get repositories (done by default when none of the "1234" args are set)')
         parser.add_argument('-2', '--do-build', action='store_true', help='run build (done by default when none of the "1234" args are set)')
         parser.add_argument('-3', '--do-bundle', action='store_true', help='build bundle (done by default when none of the "1234" args are set)')
         parser.add_argument('-4', '--do-test', action='store_true', help='run tests (done by default when none of the "1234" args are set)')
+        parser.add_argument('-5', '--do-benchmark', action='store_true', help='run benchmark models with the built or extracted mcell and compare wall time, CPU time and peak RSS against the stored baseline, requires --benchmark-models')
 
         parser.add_argument('-p', '--print-platform-info', action='store_true', help='print platform-dependent names of packages')
 
@@ -175,6 +324,10 @@ class Options:
             self.ignore_dirty = True
         if args.debug:
             self.debug = True
+        if args.do_not_split_dwarf:
+            self.do_not_split_dwarf = True
+        if args.gdb_index:
+            self.gdb_index = True
 
         if args.only_cellblender_mcell:
             self.only_cellblender_mcell = True
@@ -200,10 +353,134 @@ class Options:
         if args.branch:
             self.branch = args.branch
 
+        if args.repo_jobs is not None:
+            if args.repo_jobs < 1:
+                sys.exit("Argument --repo-jobs must be at least 1")
+            self.repo_jobs = args.repo_jobs
+
+        if args.mirror_dir:
+            self.mirror_dir = os.path.abspath(args.mirror_dir)
+        if args.offline:
+            if not args.mirror_dir:
+                sys.exit("Argument --offline requires --mirror-dir")
+            self.offline = True
+
+        if args.use_clone_profiles:
+            self.use_clone_profiles = True
+
+        if args.sparse_checkout:
+            self.sparse_checkout = True
+        if args.sparse_checkout_profiles:
+            self.sparse_checkout = True
+            self.sparse_checkout_profiles_file = os.path.abspath(args.sparse_checkout_profiles)
+
+        if args.git_maintenance:
+            self.git_maintenance = True
+
+        if args.manifest:
+            self.pinned_manifest_file = os.path.abspath(args.manifest)
+        if args.force_rebuild:
+            self.force_rebuild = True
+        if args.force_step:
+            self.force_steps = args.force_step
+
+        if args.serial_build:
+            self.serial_build = True
+
+        if args.jobserver:
+            self.jobserver = True
+        if args.host_core_budget is not None:
+            if args.host_core_budget < 1:
+                sys.exit("Argument --host-core-budget must be at least 1")
+            self.host_core_budget = args.host_core_budget
+
+        if args.memory_aware:
+            self.memory_aware = True
+
+        if args.artifact_cache_dir:
+            self.artifact_cache_dir = os.path.abspath(args.artifact_cache_dir)
+        if args.artifact_cache_max_size:
+            self.artifact_cache_max_size_gb = args.artifact_cache_max_size
+
+        if args.artifact_cache_remote:
+            if not args.artifact_cache_dir:
+                sys.exit("Argument --artifact-cache-remote requires --artifact-cache-dir")
+            self.artifact_cache_remote = args.artifact_cache_remote
+
+        if args.linker:
+            self.linker = args.linker
+
+        if args.compile_time_report:
+            if os.name == 'nt':
+                sys.exit("Argument --compile-time-report is supported only on Linux and MacOS")
+            self.compile_time_report = True
+            # the timed builds must not be reused from a previous run
+            self.force_steps = self.force_steps + [REPO_NAME_VTK, REPO_NAME_MCELL]
+
+        if args.lto:
+            self.use_lto = True
+        if args.pgo:
+            if not args.pgo_training_models:
+                sys.exit("Argument --pgo requires --pgo-training-models")
+            self.pgo = True
+        if args.pgo_training_models:
+            self.pgo_training_models = os.path.abspath(args.pgo_training_models)
+
+        if args.benchmark_models:
+            self.benchmark_models = os.path.abspath(args.benchmark_models)
+        if args.benchmark_repeats:
+            if args.benchmark_repeats < 1:
+                sys.exit("Argument --benchmark-repeats must be at least 1")
+            self.benchmark_repeats = args.benchmark_repeats
+        if args.tune_flags:
+            if not args.benchmark_models:
+                sys.exit("Argument --tune-flags requires --benchmark-models")
+            self.tune_flags = True
+        if args.tuning_matrix:
+            self.tuning_matrix_file = os.path.abspath(args.tuning_matrix)
+        if args.save_tuned_flags:
+            self.save_tuned_flags = True
+
+        if args.benchmark_threshold is not None:
+            if args.benchmark_threshold < 0:
+                sys.exit("Argument --benchmark-threshold must not be negative")
+            self.benchmark_threshold_percent = args.benchmark_threshold
+        if args.benchmark_on_regression:
+            self.benchmark_on_regression = args.benchmark_on_regression
+        if args.update_benchmark_baseline:
+            self.update_benchmark_baseline = True
+
+        if args.profiling:
+            if not args.benchmark_models:
+                sys.exit("Argument --profiling requires --benchmark-models")
+            self.profiling = True
+
+        if args.isa_variants:
+            for variant in args.isa_variants.split(','):
+                if variant not in ISA_VARIANTS:
+                    sys.exit("Unknown ISA variant '" + variant + "', supported are: " + ', '.join(ISA_VARIANTS))
+                # the baseline is the main mcell build
+                if variant != ISA_VARIANT_BASELINE and variant not in self.isa_variants:
+                    self.isa_variants.append(variant)
+
+        if args.generator:
+            self.generator = args.generator
+
+        if args.compiler_cache:
+            self.compiler_cache = args.compiler_cache
+        if args.compiler_cache_dir:
+            self.compiler_cache_dir = os.path.abspath(args.compiler_cache_dir)
+        if args.compiler_cache_max_size:
+            self.compiler_cache_max_size_gb = args.compiler_cache_max_size
+
         if args.mcell_infrastructure_dir:
             self.mcell_build_infrastructure_dir = args.mcell_infrastructure_dir
             self.set_mcell_infrastructure_dirs()
 
+        if args.worktree:
+            self.worktree = True
+            self.set_worktree_dirs()
+
         if args.release:
             self.release_version = args.release
         if args.store_build:
@@ -213,6 +490,9 @@ class Options:
         self.do_build = args.do_build
         self.do_bundle = args.do_bundle
         self.do_test = args.do_test
+        self.do_benchmark = args.do_benchmark
+        if self.do_benchmark and not self.benchmark_models:
+            sys.exit("Argument --do-benchmark requires --benchmark-models")
 
         self.set_result_bundle_archive_path()
 
@@ -223,7 +503,7 @@ class Options:
         # final processing
 
         # no specific task was set, do all
-        if not (self.do_repos or self.do_build or self.do_bundle or self.do_test or self.only_cellblender_mcell):
+        if not (self.do_repos or self.do_build or self.do_bundle or self.do_test or self.do_benchmark or self.only_cellblender_mcell):
             self.do_repos = True
             self.do_build = True
             #self.do_bundle = True
@@ -0,0 +1,118 @@
+"""
+Copyright (C) 2019 by
+The Salk Institute for Biological Studies and
+Pittsburgh Supercomputing Center, Carnegie Mellon University
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+Profile-guided optimization of the mcell build.
+
+1) mcell is built with instrumentation,
+2) training models from mcell_tests are run with it,
+3) profiles are merged (clang only, gcc merges its .gcda files itself),
+4) mcell is built again using the profiles, optionally with LTO.
+
+All builds use the same build directory because gcc names the profile
+files by the paths of object files. Profiles are stored in work_dir and
+reused as long as the mcell sources, training models and compiler
+do not change.
+"""
+
+import os
+import glob
+import shutil
+import hashlib
+
+from utils import *
+from build_settings import *
+import artifact_cache
+import model_runner
+import stamps
+
+
+def is_clang():
+    # CXX compiler identity is the second item
+    return 'clang' in artifact_cache.get_compiler_identity()[1].lower()
+
+
+def get_profile_key(opts):
+    with open(opts.pgo_training_models, 'rb') as f:
+        models_hash = hashlib.sha256(f.read()).hexdigest()
+
+    return artifact_cache.compute_key({
+        'repos': { name: stamps.get_repo_fingerprint(opts, name) for name in MCELL_BUILD_REPOSITORIES },
+        'models': models_hash,
+        'debug': opts.debug,
+        'compiler': artifact_cache.get_compiler_identity(),
+        'platform': artifact_cache.get_platform_identity()
+    })
+
+
+def get_llvm_profdata():
+    if shutil.which('llvm-profdata'):
+        return ['llvm-profdata']
+    elif platform.system() == 'Darwin':
+        return ['xcrun', 'llvm-profdata']
+    else:
+        fatal_error("PGO with clang requires llvm-profdata in PATH.")
+
+
+def generate_profiles(opts, mcell_build_dir, build_function, profile_dir):
+    raw_dir = os.path.join(profile_dir, PGO_RAW_PROFILES_SUBDIR)
+    os.makedirs(raw_dir)
+
+    log("PGO stage 1/4: building instrumented mcell.")
+    instrument_flags = ['-fprofile-generate=' + raw_dir]
+    if not is_clang():
+        # counters must not get corrupted when models use threads
+        instrument_flags.append('-fprofile-update=atomic')
+    build_function(instrument_flags, ['-fprofile-generate=' + raw_dir], False)
+
+    log("PGO stage 2/4: running training models.")
+    models = model_runner.load_model_list(opts.pgo_training_models)
+    results = model_runner.run_models(
+        opts, models, mcell_build_dir, os.path.join(opts.work_dir, PGO_TRAINING_DIR))
+    if not any(res.ok for res in results):
+        fatal_error("All PGO training models failed, no profiles were collected.")
+
+    log("PGO stage 3/4: merging profiles.")
+    if is_clang():
+        cmd = get_llvm_profdata() + ['merge', '-output=' + os.path.join(profile_dir, PGO_CLANG_PROFDATA_FILE)]
+        cmd += glob.glob(os.path.join(raw_dir, '*.profraw'))
+        ec = run(cmd, cwd=profile_dir)
+        check_ec(ec, cmd)
+
+    # profiles are complete only when all stages passed
+    with open(os.path.join(profile_dir, PGO_COMPLETE_FILE), 'w') as f:
+        f.write(opts.pgo_training_models + '\n')
+
+
+def build_with_pgo(opts, mcell_build_dir, build_function, use_lto):
+    # build_function(compile_flags, link_flags, use_lto) configures and builds mcell in mcell_build_dir
+    if os.name == 'nt':
+        fatal_error("PGO build is supported only with gcc and clang.")
+
+    pgo_dir = os.path.join(opts.work_dir, PGO_DIR)
+    profile_dir = os.path.join(pgo_dir, get_profile_key(opts))
+
+    if os.path.exists(os.path.join(profile_dir, PGO_COMPLETE_FILE)):
+        log("PGO: reusing profiles from '" + profile_dir + "', mcell sources and training models did not change.")
+    else:
+        # profiles of older sources are not useful anymore
+        if os.path.exists(pgo_dir):
+            shutil.rmtree(pgo_dir)
+        generate_profiles(opts, mcell_build_dir, build_function, profile_dir)
+
+    log("PGO stage 4/4: building mcell with profiles" + (" and LTO." if use_lto else "."))
+    if is_clang():
+        profile = os.path.join(profile_dir, PGO_CLANG_PROFDATA_FILE)
+        # the sources may have changed a bit compared to the profiles
+        use_flags = ['-fprofile-use=' + profile, '-Wno-profile-instr-out-of-date', '-Wno-profile-instr-unprofiled']
+    else:
+        profile = os.path.join(profile_dir, PGO_RAW_PROFILES_SUBDIR)
+        use_flags = ['-fprofile-use=' + profile, '-Wno-missing-profile']
+    build_function(use_flags, ['-fprofile-use=' + profile], use_lto)
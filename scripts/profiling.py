@@ -0,0 +1,138 @@
+"""
+Copyright (C) 2019 by
+The Salk Institute for Biological Studies and
+Pittsburgh Supercomputing Center, Carnegie Mellon University
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+Profiling of the mcell build with frame pointers and symbols.
+
+Benchmark models are run under 'perf record', py-spy is used when perf is
+not available or fails for a model, e.g. when perf_event_paranoid does not 
+allow recording (only for MCell4 Python models). Folded stacks and SVG
+flamegraphs of each model are stored in work_dir and also next to the
+stored build.
+"""
+
+import os
+import shutil
+from collections import Counter
+
+from utils import *
+from build_settings import *
+import model_runner
+import flamegraph
+
+
+def get_profiling_build_dir(opts):
+    return os.path.join(opts.work_dir, BUILD_DIR_MCELL_PROFILING)
+
+
+def get_profiling_flags():
+    flags = ['-g', '-fno-omit-frame-pointer']
+    if platform.machine().lower() in ['x86_64', 'amd64']:
+        flags.append('-mno-omit-leaf-frame-pointer')
+    return flags
+
+
+def get_profilers():
+    # returns the available profilers in the order in which they are tried
+    return [profiler for profiler in [PROFILER_PERF, PROFILER_PY_SPY] if shutil.which(profiler)]
+
+
+def profile_model_with_perf(opts, model, mcell_dir, scratch_dir, folded_file):
+    perf_data = os.path.join(opts.work_dir, PROFILING_DIR, 'perf.data')
+    perf_script_file = os.path.join(opts.work_dir, PROFILING_DIR, 'perf_script.txt')
+    try:
+        wrapper = ['perf', 'record', '-F', str(PROFILING_FREQUENCY_HZ), '--call-graph', 'fp', '-o', perf_data, '--']
+        res = model_runner.run_model(opts, model, mcell_dir, scratch_dir, wrapper)
+        if not res.ok:
+            return False
+
+        cmd = ['perf', 'script', '-i', perf_data]
+        ec = run(cmd, cwd=scratch_dir, fout_name=perf_script_file, timeout_sec=MODEL_RUN_TIMEOUT_SEC)
+        if ec != 0:
+            warning("Command '" + ' '.join(cmd) + "' failed for model '" + model + "'.")
+            return False
+
+        flamegraph.write_folded(flamegraph.fold_perf_script(perf_script_file), folded_file)
+        return True
+    finally:
+        # perf.data of long runs is large
+        if os.path.exists(perf_data):
+            os.remove(perf_data)
+        if os.path.exists(perf_script_file):
+            os.remove(perf_script_file)
+
+
+def profile_model_with_py_spy(opts, model, mcell_dir, scratch_dir, folded_file):
+    if not model.endswith('.py'):
+        warning("Model '" + model + "' is not a Python model, it cannot be profiled with py-spy.")
+        return False
+
+    # raw format are folded stacks, native frames are those of the mcell module
+    wrapper = ['py-spy', 'record', '--native', '--rate', str(PROFILING_FREQUENCY_HZ),
+               '--format', 'raw', '-o', folded_file, '--']
+    res = model_runner.run_model(opts, model, mcell_dir, scratch_dir, wrapper)
+    return res.ok
+
+
+def profile_models(opts):
+    mcell_dir = get_profiling_build_dir(opts)
+    profiles_dir = os.path.join(opts.work_dir, PROFILING_DIR)
+    if os.path.exists(profiles_dir):
+        shutil.rmtree(profiles_dir)
+    os.makedirs(profiles_dir)
+
+    profilers = get_profilers()
+    if not profilers:
+        fatal_error("Profiling requires perf or py-spy in PATH.")
+    log("Profiling benchmark models with " + ' or '.join(profilers) + ".")
+
+    models = model_runner.load_model_list(opts.benchmark_models)
+    all_stacks = Counter()
+    for i, model in enumerate(models):
+        name = str(i) + '_' + os.path.splitext(os.path.basename(model))[0]
+        scratch_dir = os.path.join(opts.work_dir, PROFILING_RUNS_DIR, name)
+        folded_file = os.path.join(profiles_dir, name + '.folded')
+
+        log("Profiling model '" + model + "'.")
+        ok = False
+        if PROFILER_PERF in profilers:
+            ok = profile_model_with_perf(opts, model, mcell_dir, scratch_dir, folded_file)
+            if not ok and PROFILER_PY_SPY in profilers:
+                # e.g. perf_event_paranoid does not allow recording
+                warning("Profiling of model '" + model + "' with perf failed, trying py-spy.")
+        if not ok and PROFILER_PY_SPY in profilers:
+            ok = profile_model_with_py_spy(opts, model, mcell_dir, scratch_dir, folded_file)
+        if not ok:
+            warning("Model '" + model + "' was not profiled.")
+            continue
+
+        stacks = flamegraph.load_folded(folded_file)
+        flamegraph.write_svg(stacks, os.path.join(profiles_dir, name + '.svg'), model)
+        all_stacks.update(stacks)
+
+    if not all_stacks:
+        fatal_error("No benchmark model was profiled successfully.")
+
+    # one flamegraph for all models
+    flamegraph.write_folded(all_stacks, os.path.join(profiles_dir, 'all.folded'))
+    flamegraph.write_svg(all_stacks, os.path.join(profiles_dir, 'all.svg'), 'All benchmark models')
+    log("Profiles and flamegraphs were written to '" + profiles_dir + "'.")
+
+
+def store_profiles(opts, target_dir):
+    # copies the profiles next to a stored bundle
+    profiles_dir = os.path.join(opts.work_dir, PROFILING_DIR)
+    if not opts.profiling or not os.path.exists(profiles_dir):
+        return
+    target = os.path.join(target_dir, os.path.basename(opts.result_bundle_archive_path) + PROFILES_STORE_SUFFIX)
+    log("Copying profiles '" + profiles_dir + "' to '" + target + "'.")
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    shutil.copytree(profiles_dir, target)
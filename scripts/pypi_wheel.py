@@ -14,6 +14,7 @@ from build_settings import *
 import sys
 import platform
 import shutil
+import debug_info
 
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
 
@@ -50,6 +51,13 @@ def create_pypi_wheel(opts):
         os.path.join(opts.work_dir, BUILD_DIR_MCELL_PYPI, 'lib', 'mcell' + lib_ext),
         os.path.join(lib_dir, lib_name)
     )
+    # gdb looks for the debug info package under the name of the library
+    if debug_info.use_split_dwarf(opts):
+        debug_info.write_dwp(
+            opts, 
+            os.path.join(opts.work_dir, BUILD_DIR_MCELL_PYPI, 'lib', 'mcell' + lib_ext),
+            os.path.abspath(os.path.join(lib_dir, lib_name + DWP_SUFFIX))
+        )
     
     
     cmd = [
@@ -12,11 +12,16 @@ https://opensource.org/licenses/MIT.
 # really work on Windows and MacOS, therefore a simple wrapper functions were created instead 
 
 import os
+import re
+import json
 import time
 import datetime
+import pathlib
+import subprocess
 
 from utils import *
 from build_settings import *
+import linker
 
 BASE_URL = 'https://github.com/mcellteam/'
 
@@ -37,6 +42,33 @@ FORKED_REPOSITORIES = [REPO_NAME_NFSIM, REPO_NAME_NFSIMCINTERFACE, REPO_NAME_BIO
 
 ALL_REPOSITORIES = BASE_REPOSITORIES + FORKED_REPOSITORIES
  
+# clone profiles applied with --use-clone-profiles, CI builds need only the tip of a branch, 
+# supported keys are:
+#   'depth' - number of commits fetched from the tip of each branch
+#   'filter' - partial clone filter, blobs are then downloaded only when needed 
+#   'single_branch' - only the branch that is checked out is fetched  
+CLONE_PROFILES = {
+    REPO_NAME_VTK: { 'depth': 1, 'single_branch': True },
+    REPO_NAME_BIONETGEN: { 'filter': 'blob:none' },
+}
+
+# sparse-checkout profiles applied with --sparse-checkout, only these directories 
+# (and files in the repository root) are present in the working tree, 
+# the list for VTK must contain all modules enabled in build.build_vtk and their dependencies,
+# top-level directories referenced by the root CMakeLists.txt of the checked out commit 
+# are added automatically (see get_referenced_dirs) so that a VTK update does not break configure,
+# there are no default profiles for other repositories (e.g. mesh_tools or mcell_tests), 
+# they can be added or overridden with --sparse-checkout-profiles
+SPARSE_CHECKOUT_PROFILES = {
+    REPO_NAME_VTK: [
+        # build system and third party libraries
+        'CMake', 'ThirdParty', 'Utilities', 'Wrapping',
+        # modules enabled in build.build_vtk and their dependencies
+        'Common', 'Filters', 'IO', 'Imaging', 'Interaction', 'Parallel', 'Rendering',
+        # scanned for vtk.module files by vtk_module_find_modules in the root CMakeLists.txt 
+        'Remote', 'Testing', 'Examples', 'GUISupport'
+    ],
+}
 
 REPOSITORIES_ALLOWED_TO_BE_DIRTY = [REPO_NAME_MCELL_TESTS, REPO_NAME_MCELL_TOOLS, REPO_NAME_GAMER, REPO_NAME_BIONETGEN]
 
@@ -44,12 +76,121 @@ REPOSITORIES_ALLOWED_TO_BE_DIRTY = [REPO_NAME_MCELL_TESTS, REPO_NAME_MCELL_TOOLS
 # FORKED_REPOSITORY_BRANCH_PREFIX = 'mcell_'
 FORKED_REPOSITORY_BRANCH_PREFIX = ''
 
-MIN_GIT_VERSION= 'git version 1.9' 
+# 'git status --porcelain=v2' used by query_repo_state
+MIN_GIT_VERSION = (2, 11)
 ORIGIN = 'origin'
 
 GAMER_BASE_URL = 'https://github.com/ctlee/'
 GAMER_BRANCH = 'master'
 
+# names of repositories whose mirrors were already updated in this run
+updated_mirrors = set()
+
+# outcomes printed by print_bulk_operation_report, 
+# functions called by run_on_all_repositories may return OUTCOME_SKIPPED 
+OUTCOME_OK = 'ok'
+OUTCOME_SKIPPED = 'skipped'
+OUTCOME_FAILED = 'FAILED'
+
+# automatic maintenance in get_or_update is run only after this interval 
+GIT_MAINTENANCE_INTERVAL_DAYS = 7
+GIT_CONFIG_LAST_MAINTENANCE = 'mcell.lastMaintenance'
+# git versions that introduced the maintenance commands
+GIT_VERSION_UNTRACKED_CACHE = (2, 8)
+GIT_VERSION_COMMIT_GRAPH = (2, 18)
+GIT_VERSION_MULTI_PACK_INDEX = (2, 21)
+GIT_VERSION_CHANGED_PATHS = (2, 27)
+# 'git sparse-checkout' and 'git clone --sparse'
+GIT_VERSION_SPARSE_CHECKOUT = (2, 25)
+
+# set by get_git_version
+git_version = None
+
+# set by is_fsmonitor_daemon_supported
+fsmonitor_daemon_supported = None
+
+# tuples (name, status_before, status_after, fetch_before, fetch_after)
+maintenance_reports = []
+
+# loaded from opts.pinned_manifest_file by get_pinned_commit
+pinned_manifest = None
+
+# cache of RepoState objects for the whole run, keys are absolute repository paths
+repo_states = {}
+
+
+class RepoState:
+    # snapshot of a repository, all information is collected with 
+    # 'git status --porcelain=v2 --branch', remote branches are listed 
+    # with 'git for-each-ref' only when they are needed
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        self.head_sha = ''
+        self.branch = '' # empty for detached HEAD
+        self.upstream = ''
+        self.ahead = 0
+        self.behind = 0
+        self.changes = [] # lines of 'git status --porcelain=v2' describing changed and untracked files
+        self._remote_branches = None
+
+    @property
+    def remote_branches(self):
+        # e.g. 'origin/master'
+        if self._remote_branches is None:
+            refs = run_git_w_ascii_output(['for-each-ref', '--format=%(refname:short)', 'refs/remotes/' + ORIGIN], self.repo_dir)
+            self._remote_branches = set(refs.split())
+        return self._remote_branches
+
+    def is_dirty(self):
+        return len(self.changes) != 0
+    
+    def get_branch_description(self):
+        # similar to the output of 'git describe --all'  
+        if self.branch:
+            return 'heads/' + self.branch
+        else:
+            return 'detached'
+
+    def __repr__(self):
+        res = "On branch " + self.branch if self.branch else "HEAD detached at " + self.head_sha
+        if self.upstream:
+            res += ", upstream " + self.upstream + " (ahead " + str(self.ahead) + ", behind " + str(self.behind) + ")"
+        if self.changes:
+            res += ", changes:\n  " + '\n  '.join(self.changes)
+        else:
+            res += ", working tree clean"
+        return res
+        
+
+def query_repo_state(repo_dir):
+    state = RepoState(repo_dir)
+    
+    status = run_git_w_ascii_output(['status', '--porcelain=v2', '--branch'], repo_dir)
+    for line in status.splitlines():
+        if line.startswith('# branch.oid '):
+            state.head_sha = line.split()[2]
+        elif line.startswith('# branch.head '):
+            head = line.split()[2]
+            if head != '(detached)':
+                state.branch = head
+        elif line.startswith('# branch.upstream '):
+            state.upstream = line.split()[2]
+        elif line.startswith('# branch.ab '):
+            ab = line.split()
+            state.ahead = int(ab[2][1:])
+            state.behind = int(ab[3][1:])
+        elif line and not line.startswith('#'):
+            state.changes.append(line)
+    return state
+
+
+def get_repo_state(name, opts):
+    # the state is cached until a git command that may modify the repository is run 
+    repo_dir = os.path.abspath(os.path.join(opts.top_dir, name))
+    if repo_dir not in repo_states:
+        repo_states[repo_dir] = query_repo_state(repo_dir)
+    return repo_states[repo_dir]
+
 
 def run_git_w_ascii_output(args, cwd):
     cmd = ['git']
@@ -62,25 +203,233 @@ def run_git_w_ec_check(args, cwd):
     cmd += args
     #print(str(cmd)) 
     ec = run(cmd, cwd)
+    # all commands that change a repository are run through this function 
+    repo_states.pop(os.path.abspath(cwd), None)
     check_ec(ec, cmd) 
 
 
+def get_git_version():
+    # returns tuple (major, minor) or (0, 0) if the version was not recognized 
+    global git_version
+    if git_version is None:
+        out = run_git_w_ascii_output(['--version'], os.getcwd())
+        matches = re.match('git version ([0-9]+)\\.([0-9]+)', out)
+        if matches:
+            git_version = (int(matches.group(1)), int(matches.group(2)))
+        else:
+            git_version = (0, 0)
+    return git_version
+
+
+def format_version(version):
+    return '.'.join(str(v) for v in version)
+
+
 def check_git_version():
-    out = run_git_w_ascii_output(['--version'], os.getcwd())
-    # TODO: just a string compre for now..
-    if out >= MIN_GIT_VERSION:
-        log("Checked " + out + " - ok")
+    version = get_git_version()
+    if version >= MIN_GIT_VERSION:
+        log("Checked git version " + format_version(version) + " - ok")
     else:
-        fatal_error("Required at least " + MIN_GIT_VERSION)
+        fatal_error("Required at least git version " + format_version(MIN_GIT_VERSION) + 
+                    ", found " + format_version(version) + ".")
+    
+
+def get_mirror_path(name, opts):
+    return os.path.join(opts.mirror_dir, name + GIT_SUFFIX)
+
+
+def get_mirror_url(name, opts):
+    # file:// is needed so that git uses the regular transport instead of local hardlinking,
+    # on Windows the URL must be file:///C:/... 
+    return pathlib.Path(os.path.abspath(get_mirror_path(name, opts))).as_uri()
+
+
+def update_mirror(name, opts, base_url):
+    # the mirror is a bare repository that is shared by all workspaces, 
+    # it is updated at most once per run
+    if name in updated_mirrors:
+        return
     
+    mirror_path = get_mirror_path(name, opts)
+    if opts.offline:
+        if not os.path.exists(mirror_path):
+            fatal_error("Offline mode was requested but mirror '" + mirror_path + "' does not exist.")
+        log("Offline mode, not updating mirror '" + mirror_path + "'.")
+    elif not os.path.exists(mirror_path):
+        log("Mirror '" + mirror_path + "' does not exist, creating it...")
+        if not os.path.exists(opts.mirror_dir):
+            os.makedirs(opts.mirror_dir)
+        run_git_w_ec_check(['clone', '--mirror', base_url + name + GIT_SUFFIX, mirror_path], opts.mirror_dir)
+    else:
+        log("Updating mirror '" + mirror_path + "'.")
+        run_git_w_ec_check(['remote', 'update', '--prune'], mirror_path)
+        
+    updated_mirrors.add(name)
+
+
+def get_clone_profile(name, opts):
+    if opts.use_clone_profiles and name in CLONE_PROFILES:
+        return CLONE_PROFILES[name]
+    else:
+        return {}
+
+
+def get_clone_profile_args(profile):
+    args = []
+    if 'depth' in profile:
+        args.append('--depth=' + str(profile['depth']))
+        if not profile.get('single_branch', False):
+            # --depth implies --single-branch
+            args.append('--no-single-branch')
+    elif profile.get('single_branch', False):
+        args.append('--single-branch')
+    if 'filter' in profile:
+        args.append('--filter=' + profile['filter'])
+    return args
+
+
+def load_sparse_checkout_profiles(opts):
+    # json file with a dictionary repository name -> list of directories
+    profiles = dict(SPARSE_CHECKOUT_PROFILES)
+    if opts.sparse_checkout_profiles_file:
+        with open(opts.sparse_checkout_profiles_file, 'r') as f:
+            profiles.update(json.load(f))
+    return profiles
+
+
+def get_sparse_checkout_profile(name, opts):
+    # returns None when the whole working tree should be checked out
+    if opts.sparse_checkout:
+        if get_git_version() < GIT_VERSION_SPARSE_CHECKOUT:
+            fatal_error("Argument --sparse-checkout requires at least git version " + 
+                        format_version(GIT_VERSION_SPARSE_CHECKOUT) + ".")
+        return load_sparse_checkout_profiles(opts).get(name)
+    else:
+        return None
+
+
+def get_referenced_dirs(repo_dir, commit):
+    # top-level directories of commit whose names appear in its root CMakeLists.txt
+    top_dirs = run_git_w_ascii_output(['ls-tree', '-d', '--name-only', commit], repo_dir).split()
+    try:
+        cmake_lists = subprocess.check_output(
+            ['git', 'show', commit + ':CMakeLists.txt'], cwd=repo_dir, stderr=subprocess.DEVNULL).decode('utf-8', 'replace')
+    except subprocess.CalledProcessError:
+        return []
+    return [d for d in top_dirs if re.search('(^|[\\s/"(])' + re.escape(d) + '([\\s/")]|$)', cmake_lists, re.MULTILINE)]
+
+
+def get_sparse_checkout_dirs(name, opts, commit):
+    # returns None when the full working tree is used
+    repo_dir = os.path.join(opts.top_dir, name)
+    dirs = get_sparse_checkout_profile(name, opts)
+    if dirs is None:
+        return None
+    missing = [d for d in get_referenced_dirs(repo_dir, commit) if d not in dirs]
+    if missing:
+        warning("Sparse checkout profile of '" + name + "' does not contain directories referenced by " + 
+                "its CMakeLists.txt, adding them: " + ' '.join(missing))
+    return dirs + missing
+
+
+def apply_sparse_checkout(name, opts):
+    repo_dir = os.path.join(opts.top_dir, name)
+    dirs = get_sparse_checkout_dirs(name, opts, 'HEAD')
+    
+    if dirs is not None:
+        log("Using sparse checkout of '" + name + "' with directories: " + ' '.join(dirs))
+        run_git_w_ec_check(['sparse-checkout', 'init', '--cone'], repo_dir)
+        run_git_w_ec_check(['sparse-checkout', 'set'] + dirs, repo_dir)
+    elif name in load_sparse_checkout_profiles(opts):
+        # the repo might have been made sparse by a previous run
+        if run_git_w_ascii_output(['config', '--get', 'core.sparseCheckout'], repo_dir) == 'true':
+            log("Restoring full working tree of '" + name + "'.")
+            run_git_w_ec_check(['sparse-checkout', 'disable'], repo_dir)
+
+
+def add_referenced_sparse_checkout_dirs(name, opts):
+    repo_dir = os.path.join(opts.top_dir, name)
+    dirs = get_sparse_checkout_dirs(name, opts, 'HEAD')
+    if dirs is None:
+        return
+    current = run_git_w_ascii_output(['sparse-checkout', 'list'], repo_dir).split()
+    added = [d for d in dirs if d not in current]
+    if added:
+        run_git_w_ec_check(['sparse-checkout', 'add'] + added, repo_dir)
+
+
+def is_shallow(repo_dir):
+    return run_git_w_ascii_output(['rev-parse', '--is-shallow-repository'], repo_dir) == 'true'
+
 
 def clone(name, opts, base_url):
     log("Repository '" + name + "' does not exist, cloning it...")
-    run_git_w_ec_check(['clone', base_url + name + GIT_SUFFIX], opts.top_dir)
+    profile_args = get_clone_profile_args(get_clone_profile(name, opts))
+    if get_sparse_checkout_profile(name, opts) is not None:
+        # only files in the root directory are checked out, the rest is set in apply_sparse_checkout
+        profile_args.append('--sparse')
+    
+    if not opts.mirror_dir:
+        run_git_w_ec_check(['clone'] + profile_args + [base_url + name + GIT_SUFFIX], opts.main_top_dir)
+    elif opts.offline:
+        # origin will point to the mirror, there is no network access
+        run_git_w_ec_check(['clone'] + profile_args + [get_mirror_url(name, opts), name], opts.main_top_dir)
+    else:
+        # objects are copied from the mirror and the clone does not depend on it afterwards
+        run_git_w_ec_check(
+            ['clone'] + profile_args + 
+            ['--reference', get_mirror_path(name, opts), '--dissociate', base_url + name + GIT_SUFFIX], 
+            opts.main_top_dir)
+
 
+def fetch(name, opts, dry_run=False):
+    # with dry_run, the remote is contacted but no refs are updated
+    repo_dir = os.path.join(opts.top_dir, name)
+    
+    args = ['fetch']
+    if dry_run:
+        args.append('--dry-run')
+    profile = get_clone_profile(name, opts)
+    if 'depth' in profile and is_shallow(repo_dir):
+        # keep the history shallow, a full clone made without profiles stays full 
+        args.append('--depth=' + str(profile['depth']))
+    
+    if not opts.mirror_dir:
+        run_git_w_ec_check(args, repo_dir)
+    else:
+        # the mirror was updated already, take remote branches from there,
+        # configured refspecs are used so that single branch clones fetch only their branches
+        refspecs = run_git_w_ascii_output(['config', '--get-all', 'remote.' + ORIGIN + '.fetch'], repo_dir).split()
+        run_git_w_ec_check(args + ['--prune', get_mirror_url(name, opts)] + refspecs, repo_dir)
 
-def fetch(name, opts):
-    run_git_w_ec_check(['fetch'], os.path.join(opts.top_dir, name))
+
+def get_remote_branches(name, opts):
+    # returns a set of remote branch names such as 'origin/master'
+    repo_dir = os.path.join(opts.top_dir, name)
+    if not get_clone_profile(name, opts).get('single_branch', False):
+        return get_repo_state(name, opts).remote_branches
+    
+    # single branch clones know only about the branches they fetched, ask the remote 
+    if opts.mirror_dir:
+        remote = get_mirror_url(name, opts)
+    else:
+        remote = ORIGIN
+    heads = run_git_w_ascii_output(['ls-remote', '--heads', remote], repo_dir)
+    
+    branches = set()
+    for line in heads.splitlines():
+        ref = line.split()[-1]
+        branches.add(ORIGIN + '/' + ref[len('refs/heads/'):])
+    return branches
+
+
+def add_single_branch(name, opts, branch):
+    # single branch clones must be told to fetch the other branch 
+    repo_dir = os.path.join(opts.top_dir, name)
+    if ORIGIN + '/' + branch not in get_repo_state(name, opts).remote_branches:
+        log("Adding branch '" + branch + "' to the fetched branches of single branch clone '" + name + "'.")
+        run_git_w_ec_check(['remote', 'set-branches', '--add', ORIGIN, branch], repo_dir)
+        fetch(name, opts)
 
 
 def get_default_branch(name, branch):
@@ -93,28 +442,32 @@ def get_default_branch(name, branch):
 
 
 def checkout(name, opts, branch):
+    # returns the branch that was checked out, it may be a default branch
     log("Checking out branch '" + branch + "'")
 
     repo_dir = os.path.join(opts.top_dir, name)
     
     # first check that the branch exists on remote
-    branches = run_git_w_ascii_output(['branch', '-r'], repo_dir)
+    branches = get_remote_branches(name, opts)
     full_name = ORIGIN + '/' + branch 
-    if not full_name in branches: # FIXME: improve check, we are just checking a substring
+    if not full_name in branches:
         orig_branch = branch
         branch = get_default_branch(name, branch)
         warning("Remote branch '" + orig_branch + "' does not exit in repo '" + name + "', defaulting to '" + branch + "'.")
 
     full_name2 = ORIGIN + '/' + branch 
-    if not full_name2 in branches: # FIXME: improve check, we are just checking a substring
+    if not full_name2 in branches:
         orig_branch = branch
         branch = DEFAULT_BRANCH
         warning("Remote default branch '" + orig_branch + "' does not exit in repo '" + name + "', defaulting to '" + branch + "'.")
     
+    if get_clone_profile(name, opts).get('single_branch', False):
+        add_single_branch(name, opts, branch)
+
     # then we need to check that the branch is clean before we switch
-    status = run_git_w_ascii_output(['status'], repo_dir)
-    print(status)
-    if 'working directory clean' not in status and 'working tree clean' not in status:
+    state = get_repo_state(name, opts)
+    print(state)
+    if state.is_dirty():
         if not opts.ignore_dirty and name not in REPOSITORIES_ALLOWED_TO_BE_DIRTY:
             fatal_error("Repository '" + name + "' is not clean. "
                         "Either clean it manually or if you are sure that there are "
@@ -123,34 +476,188 @@ def checkout(name, opts, branch):
             warning("Repository '" + name + "' is not clean, but this repo is allowed to be dirty.")
     
     # finally we can switch
-    run_git_w_ec_check(['checkout', branch], repo_dir)
+    if not opts.worktree:
+        run_git_w_ec_check(['checkout', branch], repo_dir)
+    else:
+        # the branch may be checked out in the main checkout, a worktree stays on a detached HEAD 
+        # so that updates of the branch in one checkout do not move HEAD of the other 
+        run_git_w_ec_check(['checkout', '--detach', ORIGIN + '/' + branch], repo_dir)
+    return branch
 
 
-def update(name, opts):
+def checkout_commit(name, opts, commit):
+    # used when a manifest with pinned commits is given
+    log("Checking out commit '" + commit + "' from manifest")
+    repo_dir = os.path.join(opts.top_dir, name)
+    
+    ec = run(['git', 'cat-file', '-e', commit + '^{commit}'], repo_dir, verbose=False)
+    if ec != 0:
+        # e.g. shallow clones do not have older commits 
+        run_git_w_ec_check(['fetch', ORIGIN, commit], repo_dir)
+    
+    state = get_repo_state(name, opts)
+    if state.is_dirty() and not opts.ignore_dirty and name not in REPOSITORIES_ALLOWED_TO_BE_DIRTY:
+        fatal_error("Repository '" + name + "' is not clean, cannot check out commit from manifest.")
+        
+    run_git_w_ec_check(['checkout', '--detach', commit], repo_dir)
+
+
+def update(name, opts, branch):
     log("Updating repository '" + name + "'.")
-    run_git_w_ec_check(['pull'], os.path.join(opts.top_dir, name))
+    if opts.worktree:
+        # remote branches were already fetched, the worktree follows the remote branch
+        run_git_w_ec_check(['checkout', '--detach', ORIGIN + '/' + branch], os.path.join(opts.top_dir, name))
+    elif not opts.mirror_dir:
+        run_git_w_ec_check(['pull'], os.path.join(opts.top_dir, name))
+    else:
+        # remote branches were already fetched from the mirror, pull would access origin
+        run_git_w_ec_check(['merge', '--ff-only', '@{u}'], os.path.join(opts.top_dir, name))
     
 
+def add_worktree(name, opts):
+    # the worktree shares objects and refs with the main checkout
+    main_repo_path = os.path.join(opts.main_top_dir, name)
+    worktree_path = os.path.join(opts.top_dir, name)
+    log("Creating worktree '" + worktree_path + "' of repository '" + name + "'.")
+    
+    # forget worktrees whose directories were removed
+    run_git_w_ec_check(['worktree', 'prune'], main_repo_path)
+    run_git_w_ec_check(['worktree', 'add', '--detach', worktree_path], main_repo_path)
+
+
 def get_or_update_repository(name, opts, base_url, branch):
+    if opts.mirror_dir:
+        update_mirror(name, opts, base_url)
+    
     # does the directory exist?
-    repo_path = os.path.join(opts.top_dir, name)
-    if not os.path.exists(repo_path):
+    main_repo_path = os.path.join(opts.main_top_dir, name)
+    if not os.path.exists(main_repo_path):
         clone(name, opts, base_url)
     else:
         log("Repository '" + name + "' already exists, no need to clone it.")
+        
+    repo_path = os.path.join(opts.top_dir, name)
+    if opts.worktree and not os.path.exists(repo_path):
+        add_worktree(name, opts)
     
     fetch(name, opts)
     
-    # checkout the required branch
-    checkout(name, opts, branch)
+    # limit the working tree before the checkout so that unused files are not written at all
+    apply_sparse_checkout(name, opts)
     
-    # update 
-    if opts.update:
-        update(name, opts)
+    pinned = get_pinned_commit(name, opts)
+    if pinned:
+        # exact commit from manifest, there is nothing to update  
+        checkout_commit(name, opts, pinned)
+    else:
+        # checkout the required branch
+        branch = checkout(name, opts, branch)
+        
+        # update 
+        if opts.update:
+            update(name, opts, branch)
+    
+    # the checked out commit may reference directories that the commit before did not
+    add_referenced_sparse_checkout_dirs(name, opts)
+        
+    if opts.git_maintenance and is_maintenance_needed(repo_path):
+        maintain_repository(name, opts, base_url, branch)
+
+
+def is_fsmonitor_daemon_supported():
+    # the builtin daemon is available only on some platforms (MacOS and Windows)
+    global fsmonitor_daemon_supported
+    if fsmonitor_daemon_supported is None:
+        build_options = run_git_w_ascii_output(['version', '--build-options'], os.getcwd())
+        fsmonitor_daemon_supported = 'fsmonitor--daemon' in build_options
+    return fsmonitor_daemon_supported
+
+
+def measure_status_and_fetch_time(name, opts):
+    repo_dir = os.path.join(opts.top_dir, name)
+    
+    start = time.time()
+    run_git_w_ascii_output(['status', '--porcelain=v2'], repo_dir)
+    status_time = time.time() - start
+    
+    # the negotiation with the remote is measured, the repository is not changed
+    start = time.time()
+    fetch(name, opts, dry_run=True)
+    fetch_time = time.time() - start
+    
+    return status_time, fetch_time
+
+
+def is_maintenance_needed(repo_dir):
+    last = run_git_w_ascii_output(['config', '--get', GIT_CONFIG_LAST_MAINTENANCE], repo_dir)
+    if not last:
+        return True
+    return time.time() - float(last) > GIT_MAINTENANCE_INTERVAL_DAYS * 24 * 60 * 60
+
+
+def maintain_repository(name, opts, base_url, branch):
+    repo_dir = os.path.join(opts.top_dir, name)
+    if not os.path.exists(repo_dir):
+        warning("Repository '" + name + "' does not exist, skipping maintenance.")
+        return
+    
+    log("Running maintenance of repository '" + name + "'.")
+    status_before, fetch_before = measure_status_and_fetch_time(name, opts)
+    git_version = get_git_version()
+    
+    # consolidate packs and loose objects
+    run_git_w_ec_check(['repack', '-a', '-d', '-l'], repo_dir)
+    
+    # speeds up history walks in fetch, log and merge-base 
+    if git_version >= GIT_VERSION_CHANGED_PATHS:
+        run_git_w_ec_check(['commit-graph', 'write', '--reachable', '--changed-paths'], repo_dir)
+        run_git_w_ec_check(['config', 'fetch.writeCommitGraph', 'true'], repo_dir)
+    elif git_version >= GIT_VERSION_COMMIT_GRAPH:
+        warning("Git older than 2.27 cannot write changed-path filters, writing commit-graph without them.")
+        run_git_w_ec_check(['commit-graph', 'write', '--reachable'], repo_dir)
+    else:
+        warning("Git older than 2.18 cannot write commit-graph, skipping it.")
+    if git_version >= GIT_VERSION_MULTI_PACK_INDEX:
+        run_git_w_ec_check(['multi-pack-index', 'write'], repo_dir)
+    else:
+        warning("Git older than 2.21 cannot write multi-pack-index, skipping it.")
+    
+    # speeds up status
+    if git_version >= GIT_VERSION_UNTRACKED_CACHE:
+        run_git_w_ec_check(['config', 'core.untrackedCache', 'true'], repo_dir)
+        run_git_w_ec_check(['update-index', '--untracked-cache'], repo_dir)
+    else:
+        warning("Git older than 2.8 does not support the untracked cache, skipping it.")
+    if is_fsmonitor_daemon_supported():
+        run_git_w_ec_check(['config', 'core.fsmonitor', 'true'], repo_dir)
+    
+    run_git_w_ec_check(['config', GIT_CONFIG_LAST_MAINTENANCE, str(int(time.time()))], repo_dir)
+    
+    status_after, fetch_after = measure_status_and_fetch_time(name, opts)
+    maintenance_reports.append((name, status_before, status_after, fetch_before, fetch_after))
+
+
+def print_maintenance_report():
+    if not maintenance_reports:
+        return
+    
+    log("Maintenance report (times in seconds):")
+    print("  {:<22}{:>15}{:>15}{:>15}{:>15}".format(
+        'repository', 'status before', 'status after', 'fetch before', 'fetch after'))
+    for name, status_before, status_after, fetch_before, fetch_after in maintenance_reports:
+        print("  {:<22}{:>15.2f}{:>15.2f}{:>15.2f}{:>15.2f}".format(
+            name, status_before, status_after, fetch_before, fetch_after))
+    maintenance_reports.clear()
+    sys.stdout.flush()
 
 
 def pull_repository(name, opts, base_url, branch):
-    run_git_w_ec_check(['pull'], os.path.join(opts.top_dir, name))
+    if opts.worktree:
+        # worktrees are on a detached HEAD, see checkout
+        fetch(name, opts)
+        checkout(name, opts, branch)
+    else:
+        run_git_w_ec_check(['pull'], os.path.join(opts.top_dir, name))
 
 
 def push_repository(name, opts, base_url, branch):
@@ -167,64 +674,134 @@ def tag_repository(name, opts, base_url, branch):
 
 def merge_repository(name, opts, base_url, branch):
     # not all branches must be present
-    out = run_git_w_ascii_output(['merge', branch], os.path.join(opts.top_dir, name))
-    print(out)
+    repo_dir = os.path.join(opts.top_dir, name)
+    ec = run(['git', 'rev-parse', '--verify', '--quiet', branch + '^{commit}'], repo_dir, verbose=False)
+    if ec != 0:
+        log("Branch '" + branch + "' does not exist in repository '" + name + "', nothing to merge.")
+        return OUTCOME_SKIPPED
+    run_git_w_ec_check(['merge', branch], repo_dir)
 
 
-def run_on_all_repositories(opts, function):
+def get_all_repository_tasks(opts):
+    # returns list of tuples (name, base_url, branch) in the order 
+    # in which the repositories are processed
     if opts.ssh:
         base_url_w_prefix = BASE_URL_SSH
     else:
         base_url_w_prefix = BASE_URL_HTTPS
-    
+
+    tasks = []
     for name in BASE_REPOSITORIES:
-        log("--- Preparing repository '" + name + "' ---")
-        function(name, opts, base_url_w_prefix, opts.branch)    
+        tasks.append((name, base_url_w_prefix, opts.branch))
 
     for name in FORKED_REPOSITORIES:
-        log("--- Preparing repository '" + name + "' ---")
-        
         if not opts.branch.startswith(BRANCH_PREFIX_MCELL4):
             # use mcell_ prefix
             branch_name = FORKED_REPOSITORY_BRANCH_PREFIX + opts.branch
         else:
             branch_name = opts.branch
-            
-        function(name, opts, base_url_w_prefix, branch_name)
-    
+
+        tasks.append((name, base_url_w_prefix, branch_name))
+
     if opts.use_private_repos:
-        log("--- Preparing repository '" + REPO_NAME_MCELL_TEST_PRIVATE + "' ---")
-        function(REPO_NAME_MCELL_TEST_PRIVATE, opts, PRIVATE_BASE_URL_SSH, opts.branch) 
-    
+        tasks.append((REPO_NAME_MCELL_TEST_PRIVATE, PRIVATE_BASE_URL_SSH, opts.branch))
+
+    return tasks
+
+
+def prepare_repository(function, name, opts, base_url, branch):
+    log("--- Preparing repository '" + name + "' ---")
+    return function(name, opts, base_url, branch)
+
+
+def print_bulk_operation_report(opts, results):
+    print("")
+    print("  {:<22}{:<10}{:>10}{:>8}{:>8}".format('repository', 'outcome', 'time [s]', 'ahead', 'behind'))
+    for res in results:
+        if res.ok:
+            outcome = res.value if res.value else OUTCOME_OK
+        else:
+            outcome = OUTCOME_FAILED
+            
+        ahead = '-'
+        behind = '-'
+        if os.path.exists(os.path.join(opts.top_dir, res.name)):
+            state = get_repo_state(res.name, opts)
+            if state.upstream:
+                ahead = str(state.ahead)
+                behind = str(state.behind)
+            
+        print("  {:<22}{:<10}{:>10.1f}{:>8}{:>8}".format(res.name, outcome, res.elapsed_sec, ahead, behind))
+    print("")
+    sys.stdout.flush()
+
+
+def run_on_all_repositories(opts, function, report=False):
+    # with report set, failures of individual repositories do not stop processing
+    # of other repositories and a summary table is printed at the end
+    tasks = get_all_repository_tasks(opts)
+
+    if opts.repo_jobs <= 1 and not report:
+        for name, base_url, branch in tasks:
+            prepare_repository(function, name, opts, base_url, branch)
+        return
+
+    # the repositories are independent, process them concurrently,
+    # output of each repository is printed once it is finished
+    log("Processing " + str(len(tasks)) + " repositories using " + str(opts.repo_jobs) + " parallel jobs")
+    results = run_in_parallel(
+        [(name, prepare_repository, (function, name, opts, base_url, branch))
+         for name, base_url, branch in tasks],
+        opts.repo_jobs
+    )
+
+    if report:
+        print_bulk_operation_report(opts, results)
+
+    failed = [res for res in results if not res.ok]
+    if failed:
+        for res in failed:
+            print("* Error: repository '" + res.name + "' failed: " + res.error)
+        fatal_error("Processing of " + str(len(failed)) + " out of " + str(len(results)) + " repositories failed.")
 
 
 def get_or_update(opts):
     check_git_version()
+    if opts.offline and not opts.mirror_dir:
+        fatal_error("Offline mode requires a mirror directory to be set.")
     run_on_all_repositories(opts, get_or_update_repository)
+    print_maintenance_report()
+    write_manifest(opts)
     
 
+def maintain(opts):
+    check_git_version()
+    run_on_all_repositories(opts, maintain_repository)
+    print_maintenance_report()
+
+
 def pull(opts):
     check_git_version()
-    run_on_all_repositories(opts, pull_repository)
+    run_on_all_repositories(opts, pull_repository, report=True)
 
 
 def push(opts):
     check_git_version()
-    run_on_all_repositories(opts, push_repository)
+    run_on_all_repositories(opts, push_repository, report=True)
 
     
 def reset_hard(opts):
     check_git_version()
-    run_on_all_repositories(opts, reset_hard_repository)
+    run_on_all_repositories(opts, reset_hard_repository, report=True)
 
 
 def tag(opts):
     check_git_version()
-    run_on_all_repositories(opts, tag_repository)
+    run_on_all_repositories(opts, tag_repository, report=True)
 
 def merge(opts):
     check_git_version()
-    run_on_all_repositories(opts, merge_repository)
+    run_on_all_repositories(opts, merge_repository, report=True)
     
 def create_version_file(opts):
     if not os.path.exists(opts.work_dir):
@@ -241,11 +818,65 @@ def create_version_file(opts):
         res = run_with_ascii_output(cmd, cwd='.')
         if cmd:
             f.write("GCC: " + res.split('\n')[0] + "\n")
+        f.write("Linker: " + linker.get_linker_description(opts) + "\n")
         
         f.write("\n")
         
         for repo_name in ALL_REPOSITORIES:
-            branch = run_git_w_ascii_output(['describe', '--all'], cwd=os.path.join(opts.top_dir, repo_name))
-            commit = run_git_w_ascii_output(['log', '-1', '--pretty="%H"'], cwd=os.path.join(opts.top_dir, repo_name))
-            f.write(repo_name + ": " + commit + " (" + branch + ")\n")
+            # branch.oid is available also for shallow clones where the history is not present
+            state = get_repo_state(repo_name, opts)
+            f.write(repo_name + ": " + state.head_sha + " (" + state.get_branch_description() + ")\n")
     
+
+
+def get_manifest_repositories(opts):
+    repos = list(ALL_REPOSITORIES)
+    if opts.use_private_repos:
+        repos.append(REPO_NAME_MCELL_TEST_PRIVATE)
+    return repos
+
+
+def create_manifest(opts):
+    # returns dictionary repo name -> {'sha', 'branch', 'dirty'}
+    manifest = {}
+    for name in get_manifest_repositories(opts):
+        if not os.path.exists(os.path.join(opts.top_dir, name)):
+            continue
+        state = get_repo_state(name, opts)
+        manifest[name] = { 
+            'sha': state.head_sha, 
+            'branch': state.branch, 
+            'dirty': state.is_dirty() 
+        }
+    return manifest
+
+
+def write_manifest(opts):
+    if not os.path.exists(opts.work_dir):
+        os.makedirs(opts.work_dir)
+        
+    manifest_file = os.path.join(opts.work_dir, MANIFEST_FILE)
+    log("Writing manifest '" + manifest_file + "'.")
+    with open(manifest_file, 'w') as f:
+        json.dump({ 'repositories': create_manifest(opts) }, f, indent=2, sort_keys=True)
+
+
+def load_manifest(manifest_file):
+    with open(manifest_file, 'r') as f:
+        return json.load(f)['repositories']
+
+
+def get_pinned_commit(name, opts):
+    # returns None if no manifest was given or the manifest does not contain the repository  
+    if not opts.pinned_manifest_file:
+        return None
+    
+    global pinned_manifest
+    if pinned_manifest is None:
+        pinned_manifest = load_manifest(opts.pinned_manifest_file)
+        
+    if name in pinned_manifest:
+        return pinned_manifest[name]['sha']
+    else:
+        warning("Repository '" + name + "' is not in manifest '" + opts.pinned_manifest_file + "'.")
+        return None
@@ -0,0 +1,157 @@
+"""
+Copyright (C) 2019 by
+The Salk Institute for Biological Studies and
+Pittsburgh Supercomputing Center, Carnegie Mellon University
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+This module runs build steps with declared dependencies, steps whose 
+dependencies are finished run concurrently and the core budget is 
+divided among them according to their weights. The output of concurrent 
+steps is printed as it is produced with a [step] prefix and written to 
+work/logs/<step>.log.
+"""
+
+import concurrent.futures
+
+from utils import *
+from build_settings import *
+import memory
+import compiler_cache
+import stamps
+
+
+class BuildStep:
+    def __init__(self, name, function, deps=None, weight=1, repos=None, outputs=None, extra=None):
+        self.name = name
+        # called with opts as its only argument, the returned value is passed to the caller 
+        self.function = function
+        # names of steps that must finish before this step is started
+        self.deps = deps if deps is not None else []
+        # relative share of the core budget
+        self.weight = weight
+        # repositories whose changes invalidate the stamp of the step, 
+        # the step is always run when None
+        self.repos = repos
+        # paths that must exist for the step to be reused
+        self.outputs = outputs if outputs is not None else []
+        # json-serializable inputs outside of the repositories and options that invalidate the stamp
+        self.extra = extra
+
+
+def get_step_cores(step, other_steps, total_cores):
+    # the cores are assigned when the step starts and are not rebalanced once the other steps finish 
+    # because make and ninja get -j only at their start, with --jobserver the tokens of finished 
+    # steps are used by the remaining ones
+    total_weight = step.weight + sum(s.weight for s in other_steps)
+    return max(1, int(total_cores * step.weight / total_weight))
+
+
+def run_step_function(step, opts, nr_cores):
+    if step.repos is not None:
+        reusable, value = stamps.check_stamp(opts, step.name, step.repos, step.deps, step.extra, step.outputs)
+        if reusable:
+            return value
+
+    if opts.memory_aware:
+        nr_cores = memory.limit_cores_by_memory(opts, step.name, nr_cores)
+    
+    set_thread_nr_cores(nr_cores)
+    reset_max_child_rss()
+    cache_state = compiler_cache.begin_step(opts, step.name)
+    try:
+        res = step.function(opts)
+    finally:
+        set_thread_nr_cores(None)
+        compiler_cache.end_step(opts, step.name, cache_state)
+        if opts.memory_aware:
+            memory.release_memory(step.name)
+    
+    if opts.memory_aware:
+        memory.record_compile_job_memory(opts, step.name, get_max_child_rss_kb())
+
+    if step.repos is not None:
+        stamps.record_stamp(opts, step.name, step.repos, step.deps, step.extra, value=res)
+    return res
+
+
+def get_step_log_file(opts, step):
+    return os.path.join(opts.work_dir, BUILD_STEP_LOGS_DIR, step.name + '.log')
+
+
+def run_step(step, opts, nr_cores, stream):
+    output = StreamedTaskOutput(step.name, stream, get_step_log_file(opts, step))
+    try:
+        return run_task_with_buffered_output(step.name, run_step_function, (step, opts, nr_cores), output)
+    finally:
+        output.close()
+
+
+def run_build_steps_serially(steps, opts):
+    results = {}
+    for step in steps:
+        results[step.name] = run_step_function(step, opts, get_nr_cores())
+    return results
+
+
+def run_build_steps(steps, opts, total_cores):
+    # returns dictionary step name -> value returned by the step function,
+    # terminates with an error when a step fails, steps that depend on a failed step are not run 
+    names = set(s.name for s in steps)
+    for step in steps:
+        for dep in step.deps:
+            if dep not in names:
+                fatal_error("Build step '" + step.name + "' depends on unknown step '" + dep + "'.")
+    
+    pending = list(steps)
+    running = {} # future -> step
+    finished = {} # name -> ParallelTaskResult
+    skipped = []
+    
+    orig_stdout = sys.stdout
+    sys.stdout = ThreadBufferedStdout(orig_stdout)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(steps)) as executor:
+            while pending or running:
+                # skip steps whose dependencies failed
+                for step in list(pending):
+                    if any(dep in finished and not finished[dep].ok or dep in skipped for dep in step.deps):
+                        log("Skipping build step '" + step.name + "' because its dependencies failed.")
+                        skipped.append(step.name)
+                        pending.remove(step)
+                
+                # start all steps whose dependencies are finished
+                ready = [s for s in pending if all(dep in finished for dep in s.deps)]
+                active = list(running.values()) + ready
+                for step in ready:
+                    if opts.memory_aware and running:
+                        memory.wait_while_memory_pressure_is_high(
+                            step.name, lambda: any(not f.done() for f in running))
+                    nr_cores = get_step_cores(step, [s for s in active if s is not step], total_cores)
+                    log("Starting build step '" + step.name + "' using " + str(nr_cores) + " cores.")
+                    running[executor.submit(run_step, step, opts, nr_cores, orig_stdout)] = step
+                    pending.remove(step)
+                
+                if not running:
+                    break
+                
+                done, _ = concurrent.futures.wait(running.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    res = future.result()
+                    finished[step.name] = res
+                    log("Build step '" + step.name + "' " + ("finished" if res.ok else "failed") + 
+                        " after " + str(int(res.elapsed_sec)) + " s, its output is in '" + get_step_log_file(opts, step) + "'.")
+    finally:
+        sys.stdout = orig_stdout
+    
+    failed = [name for name, res in finished.items() if not res.ok]
+    if failed or skipped:
+        fatal_error("Build steps failed: " + ', '.join(failed) + 
+                    ('; not run: ' + ', '.join(skipped) if skipped else ''))
+    
+    return { name: res.value for name, res in finished.items() }
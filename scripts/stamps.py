@@ -0,0 +1,174 @@
+"""
+Copyright (C) 2019 by
+The Salk Institute for Biological Studies and
+Pittsburgh Supercomputing Center, Carnegie Mellon University
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+Stamps of build and bundle steps, a step is skipped when its inputs did not
+change since its last successful run.
+
+The fingerprint of a step combines tree hashes and uncommitted changes of
+its repositories, options that influence the build, toolchain identity,
+the build scripts themselves and run ids of the steps it depends on
+(a dependent step runs again whenever its dependency ran again).
+"""
+
+import os
+import json
+import time
+import hashlib
+import subprocess
+
+from utils import *
+from build_settings import *
+import artifact_cache
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# options that change the outputs of build and bundle steps
+FINGERPRINT_OPTIONS = [
+    'debug',
+    'do_not_split_dwarf',
+    'gdb_index',
+    'mcell_python',
+    'only_pypi_wheel',
+    'only_cellblender_mcell',
+    'do_not_build_gamer',
+    'release_version',
+    'generator',
+    'resolved_linker',
+    # not an output change, timed builds must compile all files
+    'compile_time_report',
+    'use_lto',
+    'pgo',
+    'pgo_training_models',
+    'isa_variants',
+    'mcell_build_infrastructure_tuned_flags_dir',
+    'prebuilt_blender_w_python_base',
+    'prebuilt_blender_w_python_override'
+]
+
+
+def get_repo_fingerprint(opts, name):
+    repo_dir = os.path.join(opts.top_dir, name)
+    if not os.path.exists(repo_dir):
+        return 'missing'
+
+    # outputs are hashed as raw bytes, diffs and file names need not be ascii
+    h = hashlib.sha256()
+    h.update(subprocess.check_output(['git', 'rev-parse', 'HEAD^{tree}'], cwd=repo_dir))
+    # uncommitted changes of tracked files and contents of untracked files
+    h.update(subprocess.check_output(['git', 'diff', 'HEAD', '--binary'], cwd=repo_dir))
+    untracked = subprocess.check_output(['git', 'ls-files', '--others', '--exclude-standard', '-z'], cwd=repo_dir)
+    for path in sorted(p for p in untracked.split(b'\0') if p):
+        full_path = os.path.join(os.fsencode(repo_dir), path)
+        h.update(path)
+        if os.path.isfile(full_path) and not os.path.islink(full_path):
+            with open(full_path, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def get_scripts_fingerprint():
+    # changes in the build scripts may change the outputs of all steps
+    h = hashlib.sha256()
+    files = [os.path.join(os.path.dirname(THIS_DIR), 'run.py')]
+    files += [os.path.join(THIS_DIR, f) for f in sorted(os.listdir(THIS_DIR)) if f.endswith('.py') or f.endswith('.sh')]
+    for path in files:
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def get_stamp_file(opts, name):
+    return os.path.join(opts.work_dir, STAMPS_DIR, name + '.json')
+
+
+def read_stamp(opts, name):
+    # returns None when the step has no stamp
+    stamp_file = get_stamp_file(opts, name)
+    if not os.path.exists(stamp_file):
+        return None
+    try:
+        with open(stamp_file, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def remove_stamp(opts, name):
+    stamp_file = get_stamp_file(opts, name)
+    if os.path.exists(stamp_file):
+        os.remove(stamp_file)
+
+
+def compute_fingerprint(opts, repos, deps, extra):
+    dep_ids = {}
+    for dep in deps:
+        stamp = read_stamp(opts, dep)
+        dep_ids[dep] = stamp['run_id'] if stamp else None
+
+    return artifact_cache.compute_key({
+        'repos': { name: get_repo_fingerprint(opts, name) for name in repos },
+        'deps': dep_ids,
+        'options': { attr: getattr(opts, attr, None) for attr in FINGERPRINT_OPTIONS },
+        'compiler': artifact_cache.get_compiler_identity(),
+        'platform': artifact_cache.get_platform_identity(),
+        'scripts': get_scripts_fingerprint(),
+        'extra': extra
+    })
+
+
+def is_step_forced(opts, name):
+    return 'all' in opts.force_steps or name in opts.force_steps
+
+
+def check_stamp(opts, name, repos=None, deps=None, extra=None, outputs=None):
+    # returns pair (reusable, value returned by the last run of the step),
+    # the stamp is removed when the step must be run so that a failed run does not leave it behind
+    repos = repos if repos is not None else []
+    deps = deps if deps is not None else []
+    outputs = outputs if outputs is not None else []
+    stamp = read_stamp(opts, name)
+    if stamp and not is_step_forced(opts, name) and \
+            stamp['fingerprint'] == compute_fingerprint(opts, repos, deps, extra) and \
+            all(os.path.exists(path) for path in outputs):
+        log("Step '" + name + "' reused, its inputs did not change since its last run.")
+        return True, stamp['value']
+
+    remove_stamp(opts, name)
+    return False, None
+
+
+def record_stamp(opts, name, repos=None, deps=None, extra=None, value=None):
+    # the fingerprint is computed after the step finished because in-source builds
+    # (cellblender, mesh_tools) create untracked files in their repositories
+    repos = repos if repos is not None else []
+    deps = deps if deps is not None else []
+    stamp_file = get_stamp_file(opts, name)
+    if not os.path.exists(os.path.dirname(stamp_file)):
+        os.makedirs(os.path.dirname(stamp_file), exist_ok=True)
+
+    with open(stamp_file, 'w') as f:
+        json.dump({
+            'fingerprint': compute_fingerprint(opts, repos, deps, extra),
+            'run_id': str(time.time()) + '-' + str(os.getpid()),
+            'value': value
+        }, f, indent=2)
+
+
+def run_with_stamp(opts, name, function, repos=None, deps=None, extra=None, outputs=None):
+    # returns value of function, function is not called when the step can be reused
+    reusable, value = check_stamp(opts, name, repos, deps, extra, outputs)
+    if reusable:
+        return value
+
+    value = function()
+    record_stamp(opts, name, repos, deps, extra, value)
+    return value
@@ -14,13 +14,87 @@ Python scripts.
 """
 
 import os
+import io
 import sys
+import time
 import subprocess
 import shutil
 import platform
 import multiprocessing
+import tempfile
+import threading
+import concurrent.futures
 from threading import Timer
 from subprocess import Popen, PIPE
+
+
+# set by set_jobserver
+jobserver_env = {}
+jobserver_fds = ()
+
+# output of worker threads started by run_in_parallel is collected here
+# so that it can be printed as one block per task
+thread_output = threading.local()
+
+# serializes lines written by StreamedTaskOutput
+streamed_output_lock = threading.Lock()
+
+
+class ThreadBufferedStdout:
+    # replaces sys.stdout while run_in_parallel is active, 
+    # writes from threads that have a buffer set go to that buffer 
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, s):
+        buf = getattr(thread_output, 'buffer', None)
+        if buf is not None:
+            return buf.write(s)
+        else:
+            return self.stream.write(s)
+
+    def flush(self):
+        if getattr(thread_output, 'buffer', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def is_output_buffered():
+    return getattr(thread_output, 'buffer', None) is not None
+
+
+class StreamedTaskOutput:
+    # used as the buffer of a long running task, e.g. a build step, 
+    # each line is written at once to the log file and with a [name] prefix to stream
+    def __init__(self, name, stream, log_file):
+        self.prefix = '[' + name + '] '
+        self.stream = stream
+        if not os.path.exists(os.path.dirname(log_file)):
+            os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        self.log = open(log_file, 'w', errors='replace')
+        self.partial_line = ''
+
+    def write(self, s):
+        self.log.write(s)
+        self.log.flush()
+        lines = (self.partial_line + s).split('\n')
+        self.partial_line = lines.pop()
+        if lines:
+            with streamed_output_lock:
+                self.stream.write(''.join(self.prefix + line + '\n' for line in lines))
+                self.stream.flush()
+        return len(s)
+
+    def getvalue(self):
+        # everything was already printed
+        return ''
+
+    def close(self):
+        if self.partial_line:
+            self.write('\n')
+        self.log.close()
           
 
 def get_cwd_no_link():
@@ -58,22 +132,71 @@ def run_with_ascii_output_err(cmd, cwd):
     return Popen(cmd, cwd=cwd, stderr=PIPE).communicate()[1].strip().decode('ascii')
 
 
-def execute(cmd, cwd, timeout_sec, timeout_is_fatal, outfile, shell=False, env=None):
+def execute(cmd, cwd, timeout_sec, timeout_is_fatal, outfile, shell=False, env=None, pass_fds=()):
+    # the child process writes directly into the file descriptor, 
+    # so the output of a thread with a buffer is read through a pipe line by line 
+    buffered = outfile is sys.stdout and is_output_buffered()
+    if buffered:
+        outfile = thread_output.buffer
+
     if shell:
         # for shell=True, the command must be a single string
         cmd = str.join(" ", cmd)
-    
-    proc = Popen(cmd, shell=shell, cwd=cwd, stdout=outfile, stderr=subprocess.STDOUT, env=env)
+
+    proc = Popen(cmd, shell=shell, cwd=cwd, stdout=PIPE if buffered else outfile, stderr=subprocess.STDOUT, env=env, pass_fds=pass_fds)
     timer = Timer(timeout_sec, kill_proc, [proc, outfile, timeout_is_fatal])
     try:
         timer.start()
-        exit_code = proc.wait()
+        if buffered:
+            for line in io.TextIOWrapper(proc.stdout, errors='replace'):
+                outfile.write(line)
+        exit_code = wait_for_process(proc)
     finally:
         timer.cancel()
         
     return exit_code
 
 
+def rusage_max_rss_kb(rusage):
+    # ru_maxrss is in bytes on MacOS and in kilobytes on Linux
+    if platform.system() == 'Darwin':
+        return int(rusage.ru_maxrss / 1024)
+    else:
+        return rusage.ru_maxrss
+
+
+def wait_for_process(proc):
+    # returns exit code, on systems that support it also records resource usage
+    # of the process and all its children that can be obtained with get_last_rusage
+    if not hasattr(os, 'wait4'):
+        thread_output.last_rusage = None
+        return proc.wait()
+    
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    thread_output.last_rusage = rusage
+    
+    # peak memory of the largest process, e.g. of a compiler run by make 
+    max_rss_kb = rusage_max_rss_kb(rusage)
+    if max_rss_kb > getattr(thread_output, 'max_child_rss_kb', 0):
+        thread_output.max_child_rss_kb = max_rss_kb
+    return proc.returncode
+
+
+def get_last_rusage():
+    # resource usage of the last command executed by this thread or None 
+    return getattr(thread_output, 'last_rusage', None)
+
+
+def reset_max_child_rss():
+    thread_output.max_child_rss_kb = 0
+
+
+def get_max_child_rss_kb():
+    # the largest peak memory of a single process run by this thread since reset_max_child_rss 
+    return getattr(thread_output, 'max_child_rss_kb', 0)
+
+
 # can be simplified by using subprocess.run from Python 3.5
 def run(
         cmd, 
@@ -91,6 +214,9 @@ def run(
         log("    Executing: '" + str.join(" ", cmd) + "' " + str(cmd) + " in '" + cwd + "'")
 
     extended_env = os.environ.copy()
+    # make and ninja started by us become clients of the jobserver
+    extended_env.update(jobserver_env)
+    extended_env.update(get_thread_env())
     if extra_env is not None:
         # append extra env vars
         for k,v in extra_env.items():
@@ -107,13 +233,13 @@ def run(
             f.write(str.join(" ", cmd) + "\n")  # first item is the command being executed
             
             # run the actual command
-            exit_code = execute(cmd, cwd, timeout_sec, timeout_is_fatal, f, shell=shell, env=extended_env)
+            exit_code = execute(cmd, cwd, timeout_sec, timeout_is_fatal, f, shell=shell, env=extended_env, pass_fds=jobserver_fds)
 
         if (print_redirected_output):
             print_file(full_fout_path)
             
     else:
-        exit_code = execute(cmd, cwd, timeout_sec, timeout_is_fatal, sys.stdout, shell=shell, env=extended_env)
+        exit_code = execute(cmd, cwd, timeout_sec, timeout_is_fatal, sys.stdout, shell=shell, env=extended_env, pass_fds=jobserver_fds)
 
     if verbose:
         log("Exit code: " + str(exit_code))
@@ -142,7 +268,109 @@ def check_ec(ec, cmd):
         fatal_error("Error: command '" + cmd_str + "' failed, terminating.")
         
         
+class ParallelTaskResult:
+    def __init__(self, name):
+        self.name = name
+        self.ok = False
+        self.value = None
+        self.error = ''
+        self.output = ''
+        self.elapsed_sec = 0.0
+
+
+def run_task_with_buffered_output(name, function, args, buffer=None):
+    # buffer is io.StringIO when not given, its content is returned as the output of the task 
+    res = ParallelTaskResult(name)
+    thread_output.buffer = buffer if buffer is not None else io.StringIO()
+    start = time.time()
+    try:
+        res.value = function(*args)
+        res.ok = True
+    except SystemExit:
+        # fatal_error was called, the message is already in the output
+        res.error = 'failed'
+    except Exception as e:
+        res.error = type(e).__name__ + ': ' + str(e)
+        thread_output.buffer.write("* Error: " + res.error + "\n")
+    finally:
+        res.elapsed_sec = time.time() - start
+        res.output = thread_output.buffer.getvalue()
+        thread_output.buffer = None
+    return res
+
+
+def run_in_parallel(tasks, max_workers, print_output=True):
+    # tasks is a list of tuples (name, function, args),
+    # output of each task is buffered and printed once the task finishes,
+    # errors (including calls to fatal_error) do not terminate other tasks,
+    # returns a list of ParallelTaskResult in the same order as tasks
+    orig_stdout = sys.stdout
+    sys.stdout = ThreadBufferedStdout(orig_stdout)
+    results = {}
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = {
+                executor.submit(run_task_with_buffered_output, name, function, args): name
+                for name, function, args in tasks
+            }
+            for future in concurrent.futures.as_completed(futures):
+                res = future.result()
+                results[res.name] = res
+                if print_output:
+                    orig_stdout.write(res.output)
+                    orig_stdout.flush()
+    finally:
+        sys.stdout = orig_stdout
+
+    return [results[name] for name, _, _ in tasks]
+
+
+def set_jobserver(env, fds):
+    # set by jobserver.Jobserver while it is running, 
+    # env contains MAKEFLAGS and fds are the jobserver pipe file descriptors
+    global jobserver_env, jobserver_fds
+    jobserver_env = env
+    jobserver_fds = fds
+
+
+def get_jobserver_makeflags():
+    # empty when no jobserver is running
+    return jobserver_env.get('MAKEFLAGS', '')
+
+
+def get_make_parallel_args():
+    # with a jobserver, make must not get -j otherwise it would create its own jobserver,
+    # limits of --memory-aware are applied by the jobserver to its tokens
+    if 'MAKEFLAGS' in jobserver_env:
+        return []
+    else:
+        return ['-j' + str(get_nr_cores())]
+
+
+def set_thread_nr_cores(nr_cores):
+    # used by the build scheduler to give each build step its share of cores,
+    # None restores the default
+    thread_output.nr_cores = nr_cores
+
+
+def set_thread_env(env):
+    # environment variables added to commands run by the current thread, 
+    # e.g. per build step settings, None restores the default
+    thread_output.env = env
+
+
+def get_thread_env():
+    env = getattr(thread_output, 'env', None)
+    if env is not None:
+        return env
+    return {}
+
+
 def get_nr_cores():
+    nr_cores = getattr(thread_output, 'nr_cores', None)
+    if nr_cores is not None:
+        return nr_cores
+    
     cpu_count = multiprocessing.cpu_count()
     if cpu_count > 1:
         return int(cpu_count/2)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (C) 2021 by
+The Salk Institute for Biological Studies
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/licenses/MIT.
+"""
+
+"""
+Selects the mcell build optimized for the instruction set of this CPU.
+
+Variants are installed in isa/<variant> next to this file, the generic
+build in this directory is used when no variant is supported.
+
+Usage:
+  mcell_isa.py [mcell arguments]  - runs the best mcell executable (MCell3 models)
+  mcell_isa.py --print-path       - prints directory to be used as MCELL_PATH
+
+  import mcell_isa                - in Python, before 'import mcell',
+  mcell_isa.setup()                 makes the best mcell module importable
+"""
+
+import os
+import sys
+import platform
+import subprocess
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+ISA_SUBDIR = 'isa'
+
+# x86-64 microarchitecture levels from the best one,
+# each level requires also all features of the lower levels
+X86_64_LEVELS = [
+    ('x86-64-v4', ['avx512f', 'avx512bw', 'avx512cd', 'avx512dq', 'avx512vl']),
+    ('x86-64-v3', ['avx', 'avx2', 'bmi1', 'bmi2', 'f16c', 'fma', 'abm', 'movbe', 'xsave']),
+    ('x86-64-v2', ['cx16', 'lahf_lm', 'popcnt', 'sse4_1', 'sse4_2', 'ssse3']),
+    ('x86-64', [])
+]
+
+
+def get_cpu_flags():
+    flags = set()
+    if os.path.exists('/proc/cpuinfo'):
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if line.startswith('flags'):
+                    flags.update(line.split(':', 1)[1].split())
+                    break
+    elif platform.system() == 'Darwin':
+        for key in ['machdep.cpu.features', 'machdep.cpu.leaf7_features', 'machdep.cpu.extfeatures']:
+            try:
+                out = subprocess.check_output(['sysctl', '-n', key], stderr=subprocess.DEVNULL).decode('ascii')
+            except (OSError, subprocess.CalledProcessError):
+                continue
+            for flag in out.lower().split():
+                # names used by MacOS differ from Linux
+                flag = flag.replace('.', '_')
+                flags.add({ 'avx1_0': 'avx', 'lzcnt': 'abm', 'lahf': 'lahf_lm' }.get(flag, flag))
+    return flags
+
+
+def get_supported_levels():
+    # returns levels supported by this CPU from the best one
+    flags = get_cpu_flags()
+    supported = []
+    required = set()
+    for level, features in reversed(X86_64_LEVELS):
+        required.update(features)
+        if not required.issubset(flags):
+            break
+        supported.insert(0, level)
+    return supported
+
+
+def get_mcell_dir():
+    # returns directory of the best installed variant or of the generic build
+    isa_dir = os.path.join(THIS_DIR, ISA_SUBDIR)
+    if os.path.isdir(isa_dir) and platform.machine().lower() in ['x86_64', 'amd64']:
+        for level in get_supported_levels():
+            variant_dir = os.path.join(isa_dir, level)
+            if os.path.isdir(variant_dir):
+                return variant_dir
+    return THIS_DIR
+
+
+def setup():
+    # the mcell module is loaded from MCELL_PATH/lib
+    mcell_dir = get_mcell_dir()
+    os.environ['MCELL_PATH'] = mcell_dir
+    sys.path.insert(0, os.path.join(mcell_dir, 'lib'))
+    return mcell_dir
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1] == '--print-path':
+        print(get_mcell_dir())
+        sys.exit(0)
+
+    mcell = os.path.join(get_mcell_dir(), 'mcell' + ('.exe' if os.name == 'nt' else ''))
+    sys.exit(subprocess.call([mcell] + sys.argv[1:]))